@@ -3,7 +3,7 @@ from django.db import models
 from django.conf import settings
 from django.db.models import Sum
 from django.core.exceptions import ValidationError
-from app_home.models import generate_random_code
+from app_home.codes import next_code
 
 # ----------------- DEBT: PRODUCT -----------------
 class SupplierProductDebt(models.Model):
@@ -46,11 +46,7 @@ class ProductDebtDetail(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = generate_random_code()
-                if not ProductDebtDetail.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("TTSP")
         self.full_clean()
         super().save(*args, **kwargs)
 
@@ -102,11 +98,7 @@ class FacilityDebtDetail(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = generate_random_code()
-                if not FacilityDebtDetail.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("TTVT")
         self.full_clean()
         super().save(*args, **kwargs)
 
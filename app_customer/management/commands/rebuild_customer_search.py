@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app_customer.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Tính lại Customer.search_text và bảng trigram CustomerSearchToken (backfill / sau khi sửa dữ liệu bằng update())."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer", type=int, action="append", dest="customers",
+                            help="Chỉ tính lại customer_id này (có thể lặp lại).")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        done = rebuild_search_index(options.get("customers"), batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Đã cập nhật chỉ mục tìm kiếm cho {done} khách hàng."))
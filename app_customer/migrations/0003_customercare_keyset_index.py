@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customercare',
+            index=models.Index(fields=['created', 'id'], name='app_custome_created_25ac73_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill(apps, schema_editor):
+    from app_customer.search import rebuild_search_index
+    rebuild_search_index(registry=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0003_customercare_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='search_text',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=300),
+        ),
+        migrations.CreateModel(
+            name='CustomerSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=3)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='app_customer.customer')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='customersearchtoken',
+            constraint=models.UniqueConstraint(fields=('token', 'customer'), name='uniq_customer_search_token'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
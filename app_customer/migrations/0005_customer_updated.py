@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0004_customer_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -115,6 +115,7 @@ class CustomerRunningNumber(models.Model):
         
 class Customer(models.Model):
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)  # mốc sửa cuối (ETag lịch lễ tân có tên / SĐT khách)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
 
     code = models.CharField(max_length=255, unique=True, blank=True)
@@ -153,6 +154,8 @@ class Customer(models.Model):
     treatment_status = models.ForeignKey(TreatmentState, on_delete=models.SET_NULL, null=True, blank=True) # trạng thái khi khách hàng đã là khách đang mua hoặc đã mua
     is_active = models.BooleanField(default=True)
     carreer = models.CharField(max_length=255, null=True, blank=True)
+    # 'tên-không-dấu mã sđt' (app_customer.search), cập nhật trong save(); tìm chuỗi con qua CustomerSearchToken
+    search_text = models.CharField(max_length=300, blank=True, default='', editable=False, db_index=True)
     
     def __str__(self):
         status_display = dict(MAIN_STATUS).get(int(self.main_status), "Unknown")
@@ -192,11 +195,32 @@ class Customer(models.Model):
         yy = date.today().year % 100  # Lấy 2 chữ số cuối của năm
         return f"KH{seq:03d}-{yy:02d}"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ search_text lúc load để chỉ ghi lại trigram khi tên / mã / SĐT đổi
+        instance._loaded_search_text = instance.__dict__.get('search_text')
+        return instance
+
     def save(self, *args, **kwargs):
-        """Override save để tự động sinh mã nếu chưa có"""
+        """Override save để tự động sinh mã nếu chưa có, đồng thời cập nhật search_text + trigram"""
+        from app_customer.search import customer_search_text, refresh_search_tokens
+
         if not self.code:
             self.code = self._gen_code()
+        update_fields = kwargs.get('update_fields')
+        touches_search = update_fields is None or bool({'name', 'code', 'mobile'} & set(update_fields))
+        if touches_search:
+            self.search_text = customer_search_text(self.name, self.code, self.mobile)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'search_text'}
+        # save(update_fields=[...]) vẫn phải ghi mốc `updated`
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'updated'}
         super().save(*args, **kwargs)
+        if touches_search and self.search_text != getattr(self, '_loaded_search_text', None):
+            refresh_search_tokens([self.pk], using=kwargs.get('using') or self._state.db)
+            self._loaded_search_text = self.search_text
 
     @property
     def referral_label(self):
@@ -217,6 +241,17 @@ class Customer(models.Model):
     class Meta:
         app_label = "app_customer"
         
+class CustomerSearchToken(models.Model):
+    """Trigram của Customer.search_text: tìm chuỗi con bằng index (token, customer) thay vì LIKE '%...%' quét bảng."""
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=3)
+
+    class Meta:
+        app_label = "app_customer"
+        constraints = [
+            models.UniqueConstraint(fields=['token', 'customer'], name='uniq_customer_search_token'),
+        ]
+
 class Referral(models.Model):
     """
     Nguồn giới thiệu CHÍNH (duy nhất) cho mỗi Customer.
@@ -299,6 +334,12 @@ class CustomerCare(models.Model):
 
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="customer_care")
     solidarity = models.CharField(max_length=100, choices=CUSTOMER_SOLIDARIETY, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created', 'id']),  # keyset pagination (-created, -id)
+        ]
+
     def __str__(self):
         return f"{self.customer.name}|{self.type}"
     
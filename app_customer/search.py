@@ -0,0 +1,117 @@
+import re
+import unicodedata
+from typing import Iterable, Optional, Set
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count
+
+GRAM = 3
+SEARCH_TEXT_MAX = 300
+_MOBILE_TERM = re.compile(r'[\d\s+().-]+')
+
+
+def fold(text) -> str:
+    """Bỏ dấu tiếng Việt (kể cả đ/Đ), chữ thường, gộp khoảng trắng: 'Nguyễn  Văn Đức' -> 'nguyen van duc'."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFD', str(text).replace('đ', 'd').replace('Đ', 'D'))
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    return ' '.join(text.lower().split())
+
+
+def normalize_mobile(mobile) -> str:
+    """Chỉ giữ chữ số; đầu số quốc tế 84xxxxxxxxx -> 0xxxxxxxxx."""
+    digits = ''.join(ch for ch in str(mobile or '') if ch.isdigit())
+    if digits.startswith('84') and len(digits) >= 11:
+        digits = '0' + digits[2:]
+    return digits
+
+
+def customer_search_text(name, code, mobile) -> str:
+    """Giá trị cột Customer.search_text: 'tên-không-dấu mã sđt'."""
+    parts = [fold(name), fold(code), normalize_mobile(mobile)]
+    return ' '.join(p for p in parts if p)[:SEARCH_TEXT_MAX]
+
+
+def normalize_term(term) -> str:
+    """Từ khoá tìm kiếm theo cùng quy tắc với search_text (chuỗi toàn số điện thoại thì chuẩn hoá như SĐT)."""
+    term = (term or '').strip()
+    if term and _MOBILE_TERM.fullmatch(term):
+        return normalize_mobile(term)
+    return fold(term)
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def refresh_search_tokens(customer_ids: Iterable[int], using=None) -> int:
+    """Ghi lại bảng trigram cho các khách truyền vào từ search_text đang lưu (xoá + bulk_create)."""
+    Customer = apps.get_model('app_customer', 'Customer')
+    CustomerSearchToken = apps.get_model('app_customer', 'CustomerSearchToken')
+    customer_ids = {i for i in customer_ids if i}
+    if not customer_ids:
+        return 0
+    rows = Customer.objects.using(using).filter(id__in=customer_ids).values_list('id', 'search_text')
+    tokens = [CustomerSearchToken(customer_id=cid, token=g) for cid, text in rows for g in trigrams(text or '')]
+    with transaction.atomic(using=using):
+        CustomerSearchToken.objects.using(using).filter(customer_id__in=customer_ids).delete()
+        CustomerSearchToken.objects.using(using).bulk_create(tokens, batch_size=2000)
+    return len(tokens)
+
+
+def search_customers(term, queryset=None):
+    """
+    Khách khớp term theo tên không dấu / mã / SĐT (không phân biệt hoa thường, có dấu hay không).
+      - term >= 3 ký tự: lọc ứng viên qua bảng trigram (index (token, customer)) rồi xác nhận bằng search_text
+      - term ngắn hơn: khớp bất kỳ đâu trong search_text (như tìm kiếm cũ; quét bảng nhưng chỉ 1–2 ký tự)
+    Dùng trực tiếp (queryset Customer) hoặc lồng vào view khác: Q(customer__in=search_customers(term)).
+    """
+    Customer = apps.get_model('app_customer', 'Customer')
+    CustomerSearchToken = apps.get_model('app_customer', 'CustomerSearchToken')
+    qs = queryset if queryset is not None else Customer.objects.all()
+    needle = normalize_term(term)
+    if not needle:
+        return qs
+    grams = trigrams(needle)
+    if not grams:
+        return qs.filter(search_text__contains=needle)
+    candidates = (CustomerSearchToken.objects
+                  .filter(token__in=grams)
+                  .values('customer_id')
+                  .annotate(n=Count('token'))
+                  .filter(n=len(grams))
+                  .values('customer_id'))
+    return qs.filter(id__in=candidates, search_text__contains=needle)
+
+
+def rebuild_search_index(customer_ids: Optional[Iterable[int]] = None, batch_size: int = 1000, registry=None) -> int:
+    """
+    Tính lại search_text + bảng trigram theo lô id (backfill / sau khi sửa dữ liệu bằng update()).
+    registry: apps lịch sử khi gọi từ migration.
+    """
+    registry = registry or apps
+    Customer = registry.get_model('app_customer', 'Customer')
+    CustomerSearchToken = registry.get_model('app_customer', 'CustomerSearchToken')
+    qs = Customer.objects.order_by('id')
+    if customer_ids is not None:
+        qs = qs.filter(id__in=list(customer_ids))
+    ids = list(qs.values_list('id', flat=True))
+    done = 0
+    for i in range(0, len(ids), batch_size):
+        chunk = list(Customer.objects.filter(id__in=ids[i:i + batch_size])
+                     .only('id', 'name', 'code', 'mobile', 'search_text'))
+        changed = []
+        for c in chunk:
+            text = customer_search_text(c.name, c.code, c.mobile)
+            if text != c.search_text:
+                c.search_text = text
+                changed.append(c)
+        tokens = [CustomerSearchToken(customer_id=c.id, token=g) for c in chunk for g in trigrams(c.search_text)]
+        with transaction.atomic():
+            Customer.objects.bulk_update(changed, ['search_text'], batch_size=batch_size)
+            CustomerSearchToken.objects.filter(customer_id__in=[c.id for c in chunk]).delete()
+            CustomerSearchToken.objects.bulk_create(tokens, batch_size=2000)
+        done += len(chunk)
+    return done
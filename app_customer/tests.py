@@ -1,3 +1,25 @@
-from django.test import TestCase
+from django.test import TransactionTestCase
 
-# Create your tests here.
+from app_customer.models import Customer
+from app_customer.search import search_customers
+
+
+class SearchCustomersTests(TransactionTestCase):
+
+    def setUp(self):
+        self.duc = Customer.objects.create(name="Trần Minh Đức", mobile="0912345678")
+        self.an = Customer.objects.create(name="Lê An", mobile="0987000111")
+
+    def ids(self, term):
+        return set(search_customers(term).values_list("id", flat=True))
+
+    def test_short_term_matches_anywhere(self):
+        self.assertEqual(self.ids("ức"), {self.duc.id})
+        self.assertEqual(self.ids("45"), {self.duc.id})
+        self.assertEqual(self.ids("11"), {self.an.id})
+
+    def test_trigram_term_ignores_accents(self):
+        self.assertEqual(self.ids("minh duc"), {self.duc.id})
+        self.assertEqual(self.ids("Đức"), {self.duc.id})
+        self.assertEqual(self.ids("0987"), {self.an.id})
+        self.assertEqual(self.ids("xyz"), set())
@@ -16,7 +16,8 @@ from django.utils.dateparse import parse_date
 from rest_framework.exceptions import APIException
 
 from drf_spectacular.utils import extend_schema
-from app_home.pagination import CustomPagination
+from app_home.mixins import SparseFieldsMixin
+from app_home.pagination import CustomPagination, KeysetLimitOffsetPagination
 from django.db import transaction, IntegrityError
 from django.db.models import Count
 from rest_framework.decorators import action
@@ -25,6 +26,7 @@ from .docs import customer_level_schema, customer_care_schema, feedback_schema,
 
 from .models import CustomerRequest, LeadStatus, Referral, TreatmentState, Customer, CustomerCare, FeedBack, CustomerProblem, Referral, LeadSourceActor
 from .serializers import CustomerRequestSerializer, LeadStatusSerializer, TreatmentStateSerializer, CustomerSerializer, CustomerCareSerializer, FeedBackSerializer, CustomerProblemSerializer, LeadSourceActorSerializer
+from .search import search_customers
 from .models import LeadStatus, TreatmentState, Customer, CustomerCare, FeedBack, CustomerLevel, CustomerProblem
 from .serializers import LeadStatusSerializer, TreatmentStateSerializer, CustomerSerializer, CustomerCareSerializer,FeedBackSerializer, CustomerLevelSerializer
 from django.db.models import F
@@ -173,10 +175,27 @@ class CustomerProblemViewSet(viewsets.ModelViewSet):
     # destroy/retrieve/list/update/partial_update dùng mặc định của ModelViewSet
 # @customer_schema()
 @extend_schema(tags=["app_customer"])
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     serializer_class = CustomerSerializer
     pagination_class = CustomPagination
     permission_classes = [IsAuthenticated]
+    # ?fields= / ?omit=: customer_care_list, service_names, customer_problems_detail mỗi field 1 query / dòng;
+    # latest_service_type, treatment_progress, payment_status, next_visit_date mỗi field 1-3 query / dòng
+    _referral_costs = {'select_related': (
+        'primary_referral', 'primary_referral__ref_customer', 'primary_referral__ref_hr',
+        'primary_referral__ref_actor', 'primary_referral__ref_actor__source',
+    )}
+    sparse_field_costs = {
+        'lead_status_name': {'select_related': ('lead_status',)},
+        'treatment_status_name': {'select_related': ('treatment_status',)},
+        'time_frame_detail': {'select_related': ('time_frame',)},
+        'service': {'prefetch_related': ('service',)},
+        'form_referral_type': _referral_costs,
+        'form_source_id': _referral_costs,
+        'form_introducer_id': _referral_costs,
+        'introducer_label': _referral_costs,
+        'lead_source_name': _referral_costs,
+    }
 
     def get_queryset(self):
         params = self.request.query_params
@@ -192,9 +211,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
             filters &= Q(created__date__range=[start_date, end_date])
         if search_term:
             filters &= (
-                Q(name__icontains=search_term) |
-                Q(code__icontains=search_term) |
-                Q(mobile__icontains=search_term) |
+                Q(id__in=search_customers(search_term).values('id')) |
                 Q(carreer__icontains=search_term)
             )
         if main_status:
@@ -400,11 +417,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
 
         # search theo mã/tên/SĐT
         if search:
-            qs_cus = qs_cus.filter(
-                Q(code__icontains=search) |
-                Q(name__icontains=search) |
-                Q(mobile__icontains=search)
-            )
+            qs_cus = search_customers(search, qs_cus)
 
         # 2) Subquery lấy ID phác đồ gần nhất theo từng KH (lọc theo ngày / loại DV nếu có)
         tr_sq = TreatmentRequest.objects.filter(customer_id=OuterRef("pk"))
@@ -565,6 +578,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
 class CustomerCareViewSet(viewsets.ModelViewSet):
     serializer_class = CustomerCareSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetLimitOffsetPagination  # ?limit/offset như cũ, ?cursor= keyset
     queryset = CustomerCare.objects.all()
 
     def get_queryset(self):
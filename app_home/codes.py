@@ -0,0 +1,125 @@
+"""
+Sinh mã chứng từ theo bộ đếm từng tiền tố (CodeSequence), thay cho vòng lặp
+`random -> exists()`.
+
+- Mỗi process giữ sẵn 1 khối CODE_SEQUENCE_BLOCK_SIZE số / tiền tố: trường hợp thường
+  không có query nào, hết khối mới đặt khối mới bằng 1 UPDATE.
+- Đặt khối trên 1 connection riêng (autocommit) nên khoá dòng bộ đếm chỉ giữ trong vài ms,
+  không dính vào transaction đang mở của request -> không chờ / deadlock giữa các request.
+- Định dạng `{prefix}{seq:06d}-{yy}` (vd BILL_000123-25) có dấu '-' nên không trùng
+  với các mã ngẫu nhiên / theo thời gian cũ.
+- Số có thể nhảy cóc (khối chưa dùng hết khi process dừng, transaction rollback) nhưng không trùng.
+"""
+import threading
+from datetime import date
+from typing import List, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import F
+
+BLOCK_SIZE = getattr(settings, 'CODE_SEQUENCE_BLOCK_SIZE', 20)
+
+_blocks = {}                      # prefix -> [next, last]
+_blocks_lock = threading.Lock()
+_local = threading.local()
+
+
+def format_code(prefix: str, seq: int) -> str:
+    return f"{prefix}{seq:06d}-{date.today().year % 100:02d}"
+
+
+def _side_connection():
+    """
+    Connection riêng cho việc đặt khối. SQLite chỉ có 1 writer (connection riêng sẽ bị
+    transaction đang mở khoá lại) nên dùng luôn connection hiện tại.
+    """
+    if connections[DEFAULT_DB_ALIAS].vendor == 'sqlite':
+        return None
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = connections.create_connection(DEFAULT_DB_ALIAS)
+        _local.conn = conn
+    conn.close_if_unusable_or_obsolete()
+    return conn
+
+
+def _reserve_on(conn, prefix: str, size: int) -> int:
+    from app_home.models import CodeSequence
+    qn = conn.ops.quote_name
+    table = qn(CodeSequence._meta.db_table)
+    for _ in range(2):
+        conn.set_autocommit(False)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {table} SET {qn('value')} = {qn('value')} + %s WHERE {qn('prefix')} = %s",
+                            [size, prefix])
+                if cur.rowcount:
+                    cur.execute(f"SELECT {qn('value')} FROM {table} WHERE {qn('prefix')} = %s", [prefix])
+                    last = cur.fetchone()[0]
+                else:
+                    cur.execute(f"INSERT INTO {table} ({qn('prefix')}, {qn('value')}) VALUES (%s, %s)",
+                                [prefix, size])
+                    last = size
+            conn.commit()
+            return last
+        except IntegrityError:
+            # worker khác vừa tạo dòng cho tiền tố này -> thử lại bằng UPDATE
+            conn.rollback()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.set_autocommit(True)
+    raise IntegrityError(f"Không đặt được khối mã cho tiền tố {prefix}")
+
+
+def _reserve_inline(prefix: str, size: int) -> int:
+    from app_home.models import CodeSequence
+    with transaction.atomic():
+        if not CodeSequence.objects.filter(prefix=prefix).update(value=F('value') + size):
+            try:
+                with transaction.atomic():
+                    CodeSequence.objects.create(prefix=prefix, value=size)
+                return size
+            except IntegrityError:
+                CodeSequence.objects.filter(prefix=prefix).update(value=F('value') + size)
+        return CodeSequence.objects.filter(prefix=prefix).values_list('value', flat=True).get()
+
+
+def _reserve(prefix: str, count: int) -> Tuple[int, int]:
+    """Đặt `count` số liên tiếp; trả (số đầu, số cuối)."""
+    conn = _side_connection()
+    last = _reserve_on(conn, prefix, count) if conn is not None else _reserve_inline(prefix, count)
+    return last - count + 1, last
+
+
+def allocate_codes(prefix: str, n: int) -> List[str]:
+    """Cấp n mã cho tiền tố (dùng cho import / bulk_create)."""
+    if n <= 0:
+        return []
+    if _side_connection() is None:
+        # không giữ khối trong process khi bộ đếm nằm chung transaction (rollback sẽ trả số về)
+        first, last = _reserve(prefix, n)
+        return [format_code(prefix, s) for s in range(first, last + 1)]
+
+    out = []
+    with _blocks_lock:
+        block = _blocks.get(prefix)
+        if block:
+            take = min(n, block[1] - block[0] + 1)
+            out = list(range(block[0], block[0] + take))
+            block[0] += take
+            if block[0] > block[1]:
+                del _blocks[prefix]
+        missing = n - len(out)
+        if missing:
+            first, last = _reserve(prefix, max(missing, BLOCK_SIZE))
+            out += list(range(first, first + missing))
+            if first + missing <= last:
+                _blocks[prefix] = [first + missing, last]
+    return [format_code(prefix, s) for s in out]
+
+
+def next_code(prefix: str) -> str:
+    return allocate_codes(prefix, 1)[0]
@@ -0,0 +1,124 @@
+import csv
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable, Iterator, Sequence, Tuple
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+# (key trong dict dòng, tiêu đề cột)
+Columns = Sequence[Tuple[str, str]]
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+CHUNK_SIZE = 2000
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Chỉ để DRF chấp nhận ?format=csv (content negotiation); dữ liệu thật
+    được view trả về bằng StreamingHttpResponse qua `ExportMixin.export_response`.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class XLSXRenderer(BaseRenderer):
+    media_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    format = 'xlsx'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class _Echo:
+    """File-like giả cho csv.writer: trả thẳng dòng vừa ghi."""
+    def write(self, value):
+        return value
+
+
+def _csv_value(v):
+    if v is None:
+        return ''
+    if isinstance(v, datetime):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(v, date):
+        return v.isoformat()
+    return v
+
+
+def _xlsx_value(v):
+    if isinstance(v, (str, int, float, Decimal, date, datetime)) or v is None:
+        return v
+    return str(v)
+
+
+def stream_csv(rows: Iterable[dict], columns: Columns) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    # BOM để Excel nhận đúng UTF-8 (tiếng Việt)
+    yield '\ufeff' + writer.writerow([title for _, title in columns])
+    for row in rows:
+        yield writer.writerow([_csv_value(row.get(key)) for key, _ in columns])
+
+
+def stream_xlsx(rows: Iterable[dict], columns: Columns, sheet_title: str = 'Data',
+                block_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    openpyxl write-only: mỗi dòng ghi ngay xuống file tạm của sheet nên bộ nhớ không tăng theo số dòng.
+    File xlsx là zip nên chỉ có byte đầu sau khi ghi xong; sau đó đọc file tạm ra theo từng block.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_title[:31])
+    ws.append([title for _, title in columns])
+    for row in rows:
+        ws.append([_xlsx_value(row.get(key)) for key, _ in columns])
+
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            block = tmp.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+class ExportMixin:
+    """
+    Thêm chế độ ?format=csv|xlsx cho APIView trả báo cáo.
+    View kiểm tra `self.export_format(request)` và trả `self.export_response(...)`
+    với rows là generator (thường từ queryset.iterator(chunk_size=CHUNK_SIZE)).
+    """
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [CSVRenderer, XLSXRenderer]
+    export_chunk_size = CHUNK_SIZE
+
+    def export_format(self, request):
+        fmt = getattr(getattr(request, 'accepted_renderer', None), 'format', None)
+        return fmt if fmt in EXPORT_FORMATS else None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # lỗi (400 / 404 / 403...) khi client xin ?format=csv|xlsx: trả JSON thay vì đưa dict cho renderer file
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if isinstance(response, Response) and isinstance(response.accepted_renderer, (CSVRenderer, XLSXRenderer)):
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = JSONRenderer.media_type
+        return response
+
+    def export_response(self, fmt: str, rows: Iterable[dict], columns: Columns, filename: str):
+        if fmt == 'csv':
+            response = StreamingHttpResponse(stream_csv(rows, columns), content_type='text/csv; charset=utf-8')
+        else:
+            response = StreamingHttpResponse(stream_xlsx(rows, columns, sheet_title=filename),
+                                             content_type=XLSXRenderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+        return response
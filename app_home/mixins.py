@@ -0,0 +1,127 @@
+from typing import Dict, Iterable, Optional, Sequence, Set
+
+from django.db.models import Prefetch
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.serializers import ListSerializer
+
+# field trả về -> các phần của queryset chỉ phục vụ field đó
+#   'select_related'   : đường dẫn select_related ('customer', 'customer__balance')
+#   'prefetch_related' : lookup prefetch (so với prefetch_to / prefetch_through của Prefetch)
+#   'annotate'         : tên annotate, dùng với `sparse_annotations()`
+#   'columns'          : cột của model chỉ field đó đọc (bỏ khỏi only() hoặc defer())
+FieldCosts = Dict[str, Dict[str, Sequence[str]]]
+
+COST_KINDS = ('select_related', 'prefetch_related', 'annotate', 'columns')
+
+
+def _split(value: Optional[str]) -> Set[str]:
+    return {v.strip() for v in (value or '').split(',') if v.strip()}
+
+
+def _select_paths(tree: dict, prefix: str = '') -> Iterable[str]:
+    for name, sub in tree.items():
+        path = f'{prefix}{name}'
+        yield path
+        yield from _select_paths(sub, f'{path}__')
+
+
+def _prefetch_keys(lookup) -> Set[str]:
+    if isinstance(lookup, Prefetch):
+        return {lookup.prefetch_to, lookup.prefetch_through}
+    return {lookup}
+
+
+class SparseFieldsMixin:
+    """
+    Sparse fieldsets cho ViewSet / GenericAPIView (chỉ áp dụng cho GET):
+      ?fields=id,code,customer_details  -> chỉ trả các field này
+      ?omit=doctor_process_details      -> trả đủ trừ các field này
+    Field không được yêu cầu bị bỏ khỏi serializer trước khi đánh giá, nên SerializerMethodField của nó không chạy.
+    View khai báo `sparse_field_costs` để bỏ luôn select_related / prefetch / annotate / cột chỉ phục vụ field đó;
+    1 lookup chỉ bị bỏ khi MỌI field khai báo nó đều không được trả, lookup không khai báo thì giữ nguyên.
+    Prune select_related / prefetch / cột chạy ở filter_queryset (list + retrieve);
+    annotate thì view tự lọc bằng `sparse_annotations()` trong get_queryset.
+    """
+    sparse_field_costs: FieldCosts = {}
+    sparse_fields_param = 'fields'
+    sparse_omit_param = 'omit'
+
+    # ---- field được yêu cầu
+    def _sparse_params(self):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return None, None
+        if not hasattr(self, '_sparse_cache'):
+            params = request.query_params
+            only = _split(params.get(self.sparse_fields_param)) or None
+            omit = _split(params.get(self.sparse_omit_param)) or None
+            self._sparse_cache = (only, omit)
+        return self._sparse_cache
+
+    def sparse_active(self) -> bool:
+        only, omit = self._sparse_params()
+        return bool(only or omit)
+
+    def sparse_wants(self, field_name: str) -> bool:
+        only, omit = self._sparse_params()
+        if only is not None and field_name not in only:
+            return False
+        return not (omit and field_name in omit)
+
+    def _sparse_dropped(self, kind: str) -> Set[str]:
+        """Lookup loại `kind` mà không field nào đang được trả cần tới."""
+        needed, declared = set(), set()
+        for field_name, costs in self.sparse_field_costs.items():
+            lookups = costs.get(kind, ())
+            declared.update(lookups)
+            if self.sparse_wants(field_name):
+                needed.update(lookups)
+        return declared - needed
+
+    # ---- serializer
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if self.sparse_active():
+            target = serializer.child if isinstance(serializer, ListSerializer) else serializer
+            fields = target.fields
+            for name in [n for n in fields if not self.sparse_wants(n)]:
+                fields.pop(name)
+        return serializer
+
+    # ---- queryset
+    def sparse_annotations(self, annotations: Dict[str, object]) -> Dict[str, object]:
+        if not self.sparse_active():
+            return annotations
+        dropped = self._sparse_dropped('annotate')
+        return {k: v for k, v in annotations.items() if k not in dropped}
+
+    def sparse_queryset(self, queryset):
+        if not self.sparse_active() or not self.sparse_field_costs:
+            return queryset
+
+        dropped = self._sparse_dropped('select_related')
+        tree = queryset.query.select_related
+        if dropped and isinstance(tree, dict):
+            paths = [p for p in _select_paths(tree) if p not in dropped]
+            queryset = queryset.select_related(None)
+            if paths:
+                queryset = queryset.select_related(*paths)
+
+        dropped = self._sparse_dropped('prefetch_related')
+        lookups = queryset._prefetch_related_lookups
+        if dropped and lookups:
+            kept = [lk for lk in lookups if not (_prefetch_keys(lk) & dropped)]
+            if len(kept) != len(lookups):
+                queryset = queryset.prefetch_related(None).prefetch_related(*kept)
+
+        dropped = self._sparse_dropped('columns')
+        if dropped:
+            names, defer = queryset.query.deferred_loading
+            if not defer:
+                queryset = queryset.only(*[n for n in names if n not in dropped])
+            else:
+                queryset = queryset.defer(*dropped)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        return self.sparse_queryset(super().filter_queryset(queryset))
@@ -308,3 +308,15 @@ class TestService(models.Model):
 
     def __str__(self):
         return self.name
+
+
+# bộ đếm sinh mã theo tiền tố (xem app_home/codes.py)
+class CodeSequence(models.Model):
+    prefix = models.CharField(max_length=32, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.prefix}: {self.value}"
+
+    class Meta:
+        app_label = "app_home"
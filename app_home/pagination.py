@@ -1,5 +1,16 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import hashlib
+import json
+from typing import Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class CustomPagination(PageNumberPagination):
     page_size_query_param = 'pageSize'  # Tên tham số truyền vào cho kích thước trang
@@ -15,4 +26,176 @@ class CustomPagination(PageNumberPagination):
             'page': self.page.number,
             'pageSize': self.page.paginator.per_page,
             'results': data
-        })
\ No newline at end of file
+        })
+
+
+# Tổng số dòng của chế độ cursor được cache theo câu SQL (không ORDER BY) trong ngần này giây
+KEYSET_COUNT_CACHE_SECONDS = getattr(settings, 'KEYSET_COUNT_CACHE_SECONDS', 60)
+_COUNT_KEY = 'app_home.keyset_count.{}'
+
+
+class KeysetPagination(BasePagination):
+    """
+    Phân trang keyset (cursor) trên (created, id): trang thứ bao nhiêu cũng chỉ là
+    `WHERE (created, id) < (c, i) ORDER BY created DESC, id DESC LIMIT n+1`, không OFFSET, không COUNT(*) mỗi trang.
+      ?cursor=           -> trang đầu ở chế độ cursor
+      ?cursor=<opaque>   -> trang theo links.next / links.previous
+      ?total=0           -> bỏ đếm tổng (total = null); mặc định total là COUNT(*) cache theo câu truy vấn
+    Không có ?cursor thì dùng `fallback_class` (paginator cũ của view) nên client cũ không đổi gì.
+    Response giữ dạng của CustomPagination: {links, total, page (null), pageSize, results}.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'pageSize'
+    total_query_param = 'total'
+    page_size = 50
+    max_page_size = 500
+    ordering: Sequence[str] = ('-created', '-id')
+    fallback_class = CustomPagination
+
+    def __init__(self):
+        self._fallback = None
+
+    # ---- cursor
+    def encode_cursor(self, position: Sequence, reverse: bool) -> str:
+        raw = json.dumps({'p': [str(v) for v in position], 'r': int(reverse)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request, model) -> Tuple[Optional[list], bool]:
+        """(position, reverse) từ ?cursor=; giá trị được parse theo field của model (created -> datetime, id -> int)."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+            data = json.loads(raw)
+            position, reverse = data['p'], bool(data.get('r'))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound('Cursor không hợp lệ.')
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound('Cursor không hợp lệ.')
+        try:
+            position = [model._meta.get_field(key.lstrip('-')).to_python(value)
+                        for key, value in zip(self.ordering, position)]
+        except (FieldDoesNotExist, ValidationError, TypeError):
+            raise NotFound('Cursor không hợp lệ.')
+        if any(value is None for value in position):
+            raise NotFound('Cursor không hợp lệ.')
+        return position, reverse
+
+    def _position(self, row) -> list:
+        names = [o.lstrip('-') for o in self.ordering]
+        if isinstance(row, dict):
+            return [row[n] for n in names]
+        return [getattr(row, n) for n in names]
+
+    def _after(self, position: Sequence, reverse: bool) -> Q:
+        """(f1, f2, ...) đứng sau position theo thứ tự ordering (đảo chiều khi reverse)."""
+        cond = Q()
+        for i, key in enumerate(self.ordering):
+            name = key.lstrip('-')
+            desc = key.startswith('-') != reverse
+            step = Q(**{n.lstrip('-'): v for n, v in zip(self.ordering[:i], position[:i])})
+            step &= Q(**{f'{name}__{"lt" if desc else "gt"}': position[i]})
+            cond |= step
+        return cond
+
+    # ---- paginator
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            self._fallback = self.fallback_class()
+            return self._fallback.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request, queryset.model)
+
+        order = [o[1:] if o.startswith('-') else f'-{o}' for o in self.ordering] if reverse else list(self.ordering)
+        qs = queryset.order_by(*order)
+        if position is not None:
+            qs = qs.filter(self._after(position, reverse))
+        rows = list(qs[:self.size + 1])
+        has_more = len(rows) > self.size
+        rows = rows[:self.size]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = position is not None, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        self.next_cursor = self.encode_cursor(self._position(rows[-1]), False) if rows and has_next else None
+        self.previous_cursor = self.encode_cursor(self._position(rows[0]), True) if rows and has_previous else None
+        self.total = self.get_total(queryset, request)
+        return rows
+
+    def get_total(self, queryset, request) -> Optional[int]:
+        if request.query_params.get(self.total_query_param) in ('0', 'false'):
+            return None
+        try:
+            sql, params = queryset.order_by().query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = _COUNT_KEY.format(hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest())
+        total = cache.get(key)
+        if total is None:
+            total = queryset.order_by().count()
+            cache.set(key, total, KEYSET_COUNT_CACHE_SECONDS)
+        return total
+
+    def _link(self, cursor: Optional[str]) -> Optional[str]:
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, CustomPagination.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        if self._fallback is not None:
+            return self._fallback.get_next_link()
+        return self._link(self.next_cursor)
+
+    def get_previous_link(self):
+        if self._fallback is not None:
+            return self._fallback.get_previous_link()
+        return self._link(self.previous_cursor)
+
+    def get_paginated_response(self, data):
+        if self._fallback is not None:
+            return self._fallback.get_paginated_response(data)
+        return Response({
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'total': self.total,
+            'page': None,
+            'pageSize': self.size,
+            'results': data
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return self.fallback_class().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        return self.fallback_class().get_schema_operation_parameters(view) + [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Cursor phân trang keyset (để trống = trang đầu).',
+                'schema': {'type': 'string'},
+            },
+        ]
+
+
+class KeysetLimitOffsetPagination(KeysetPagination):
+    """Như KeysetPagination, cho các view đang dùng LimitOffsetPagination mặc định."""
+    fallback_class = LimitOffsetPagination
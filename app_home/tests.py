@@ -1,3 +1,149 @@
-from django.test import TestCase
+import base64
+import json
+from datetime import date, timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from app_home import codes
+from app_home.exports import ExportMixin
+from app_home.models import CodeSequence, LeadSource
+from app_home.pagination import KeysetPagination
+
+
+class _ReportView(ExportMixin, APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request):
+        if not request.query_params.get("startDate"):
+            return Response({"detail": "startDate is required"}, status=400)
+        return self.export_response(self.export_format(request), iter([{"a": 1}]), [("a", "A")], "report")
+
+
+class ExportMixinTests(SimpleTestCase):
+    factory = APIRequestFactory()
+
+    def get(self, params):
+        response = _ReportView.as_view()(self.factory.get("/report/", params))
+        if hasattr(response, "render"):
+            response.render()
+        return response
+
+    def test_error_with_export_format_is_json(self):
+        for fmt in ("csv", "xlsx"):
+            response = self.get({"format": fmt})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response["Content-Type"], "application/json")
+            self.assertEqual(response.data, {"detail": "startDate is required"})
+
+    def test_csv_export_streams(self):
+        response = self.get({"format": "csv", "startDate": "2025-01-01"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content).decode("utf-8-sig"), "A\r\n1\r\n")
+
+
+class KeysetPaginationTests(TestCase):
+    factory = APIRequestFactory()
+
+    def setUp(self):
+        now = timezone.now()
+        sources = [LeadSource.objects.create(name=f"S{i}") for i in range(7)]
+        # 3 dòng trùng created để kiểm tra phân trang theo id khi hoà
+        stamps = [now, now - timedelta(minutes=1), now - timedelta(minutes=1), now - timedelta(minutes=1),
+                  now - timedelta(minutes=2), now - timedelta(minutes=3), now - timedelta(minutes=3)]
+        for source, stamp in zip(sources, stamps):
+            LeadSource.objects.filter(pk=source.pk).update(created=stamp)
+        self.expected = list(LeadSource.objects.order_by("-created", "-id").values_list("id", flat=True))
+
+    def page(self, cursor="", size=2):
+        paginator = KeysetPagination()
+        request = Request(self.factory.get("/sources/", {"cursor": cursor, "pageSize": size, "total": "0"}))
+        rows = paginator.paginate_queryset(LeadSource.objects.all(), request)
+
+        def cursor_of(link):
+            return parse_qs(urlparse(link).query)["cursor"][0] if link else None
+        return [r.id for r in rows], cursor_of(paginator.get_next_link()), cursor_of(paginator.get_previous_link())
+
+    def test_forward_then_backward(self):
+        pages, cursor = [], ""
+        while cursor is not None:
+            ids, cursor, previous = self.page(cursor)
+            pages.append(ids)
+        self.assertEqual([i for ids in pages for i in ids], self.expected)
+        self.assertEqual(len(pages), 4)
+
+        # lùi lại từ trang cuối bằng links.previous
+        back = []
+        while previous is not None:
+            ids, _, previous = self.page(previous)
+            back.insert(0, ids)
+        self.assertEqual(back, pages[:-1])
+
+    def test_invalid_cursor_is_not_found(self):
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+        for cursor in ("???", encode({"p": ["abc", "1"]}), encode({"p": [str(timezone.now()), "x"]}),
+                       encode({"p": ["", "1"]}), encode({"p": [[1], "1"]}), encode({"p": ["1"]})):
+            with self.assertRaises(NotFound, msg=cursor):
+                self.page(cursor)
+
+
+class CodeSequenceTests(TransactionTestCase):
+
+    def setUp(self):
+        codes._blocks.clear()
+        self.addCleanup(codes._blocks.clear)
+        yy = date.today().year % 100
+        self.suffix = f"-{yy:02d}"
+
+    def use_blocks(self, size):
+        """Bật chế độ giữ khối trong process như trên MySQL/Postgres (sqlite đặt số trực tiếp)."""
+        for target, value in (("_side_connection", lambda: connection), ("BLOCK_SIZE", size)):
+            patcher = mock.patch.object(codes, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stored(self, prefix):
+        return CodeSequence.objects.get(prefix=prefix).value
+
+    def test_format(self):
+        self.assertEqual(codes.next_code("BILL_"), f"BILL_000001{self.suffix}")
+        self.assertEqual(codes.allocate_codes("BILL_", 2), [f"BILL_000002{self.suffix}", f"BILL_000003{self.suffix}"])
+        self.assertEqual(codes.next_code("PH_"), f"PH_000001{self.suffix}")
+        self.assertEqual(codes.allocate_codes("PH_", 0), [])
+
+    def test_new_block_when_exhausted(self):
+        self.use_blocks(3)
+        self.assertEqual([codes.next_code("TR_") for _ in range(3)], [f"TR_{i:06d}{self.suffix}" for i in (1, 2, 3)])
+        self.assertEqual(self.stored("TR_"), 3)  # 1 khối cho 3 mã
+        self.assertEqual(codes.next_code("TR_"), f"TR_000004{self.suffix}")
+        self.assertEqual(self.stored("TR_"), 6)
+
+    def test_allocate_across_block_boundary_has_no_duplicates(self):
+        self.use_blocks(3)
+        first = [codes.next_code("PMT_") for _ in range(2)]
+        # worker khác đặt khối 4-6 trong lúc process này còn số 3
+        CodeSequence.objects.filter(prefix="PMT_").update(value=6)
+        batch = codes.allocate_codes("PMT_", 5)
+        self.assertEqual(batch, [f"PMT_{i:06d}{self.suffix}" for i in (3, 7, 8, 9, 10)])
+        self.assertEqual(len(set(first + batch)), 7)
+        self.assertEqual(self.stored("PMT_"), 10)
+        self.assertNotIn("PMT_", codes._blocks)  # khối mới được dùng hết
+
+    def test_year_rollover_keeps_counting(self):
+        with mock.patch.object(codes, "date") as fake_date:
+            fake_date.today.return_value = date(2025, 12, 31)
+            december = codes.next_code("BILL_")
+            fake_date.today.return_value = date(2026, 1, 1)
+            january = codes.next_code("BILL_")
+        self.assertEqual((december, january), ("BILL_000001-25", "BILL_000002-26"))
@@ -0,0 +1,241 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Iterator, Optional, Tuple
+
+from django.conf import settings
+
+# Link tải hợp đồng (presigned URL) hết hạn sau ngần này giây
+CONTRACT_URL_TTL = getattr(settings, 'HR_CONTRACT_URL_TTL', 300)
+# Cache file hợp đồng trên đĩa của web worker (LRU theo dung lượng)
+CONTRACT_CACHE_DIR = getattr(settings, 'HR_CONTRACT_CACHE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'thabicare_contracts'))
+CONTRACT_CACHE_MAX_BYTES = getattr(settings, 'HR_CONTRACT_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+# Thư mục thay cho S3 khi chạy local / kiểm thử (key = đường dẫn tương đối trong thư mục)
+CONTRACT_LOCAL_ROOT = getattr(settings, 'HR_CONTRACT_LOCAL_ROOT', None)
+
+CHUNK_SIZE = 64 * 1024
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class ContractNotFound(Exception):
+    pass
+
+
+class ContractStoreError(Exception):
+    """Kho lưu trữ lỗi khi đọc hợp đồng (S3 từ chối quyền, throttling, ...), khác với không có file."""
+    pass
+
+
+_NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3ContractStore:
+    """
+    Đọc file hợp đồng trên S3. `client` là boto3 S3 client (mặc định tạo 1 lần / process từ settings);
+    truyền client khác (moto, stub) để kiểm thử.
+    """
+    def __init__(self, client=None, bucket: Optional[str] = None):
+        self._client = client
+        self.bucket = bucket or settings.AWS_STORAGE_BUCKET_NAME
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client(
+                's3',
+                aws_access_key_id=settings.AWS_S3_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_S3_SECRET_ACCESS_KEY,
+                region_name=getattr(settings, 'AWS_S3_REGION_NAME', None),
+            )
+        return self._client
+
+    @staticmethod
+    def _raise_for(key: str, error) -> None:
+        code = error.response.get('Error', {}).get('Code')
+        if code in _NOT_FOUND_CODES:
+            raise ContractNotFound(key) from error
+        raise ContractStoreError(f'{key}: {code}') from error
+
+    def head(self, key: str) -> Tuple[int, str]:
+        """(dung lượng, etag) của file."""
+        from botocore.exceptions import ClientError
+        try:
+            meta = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            self._raise_for(key, e)
+        return meta['ContentLength'], meta['ETag'].strip('"')
+
+    def presigned_url(self, key: str, expires: int, filename: Optional[str] = None) -> Optional[str]:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if filename:
+            params['ResponseContentDisposition'] = f'inline; filename="{filename}"'
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+    def download(self, key: str, fileobj) -> None:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.download_fileobj(self.bucket, key, fileobj)
+        except ClientError as e:
+            self._raise_for(key, e)
+
+
+class LocalContractStore:
+    """Cùng giao diện với S3ContractStore trên 1 thư mục local (dev / kiểm thử); không có presigned URL."""
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ContractNotFound(key)
+        return path
+
+    def head(self, key: str) -> Tuple[int, str]:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise ContractNotFound(key)
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+        return os.path.getsize(path), md5.hexdigest()
+
+    def presigned_url(self, key: str, expires: int, filename: Optional[str] = None) -> Optional[str]:
+        return None
+
+    def download(self, key: str, fileobj) -> None:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise ContractNotFound(key)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, fileobj, CHUNK_SIZE)
+
+
+_store = None
+
+
+def get_contract_store():
+    global _store
+    if _store is None:
+        _store = LocalContractStore(CONTRACT_LOCAL_ROOT) if CONTRACT_LOCAL_ROOT else S3ContractStore()
+    return _store
+
+
+def set_contract_store(store) -> None:
+    """Thay store (kiểm thử / chạy với thư mục local); None = tạo lại theo settings."""
+    global _store
+    _store = store
+
+
+class ContractDiskCache:
+    """
+    Cache file trên đĩa trước S3, khoá theo (key, etag) nên file đổi nội dung là tự thành key mới.
+    LRU theo mtime (chạm lại khi đọc trúng), xoá file cũ nhất tới khi tổng dung lượng <= max_bytes.
+    """
+    def __init__(self, root: str = CONTRACT_CACHE_DIR, max_bytes: int = CONTRACT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str, etag: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(f'{key}|{etag}'.encode()).hexdigest())
+
+    def get(self, key: str, etag: str, store=None) -> str:
+        """Đường dẫn file local của (key, etag); tải từ store nếu chưa có."""
+        path = self.path_for(key, etag)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.root, exist_ok=True)
+        store = store or get_contract_store()
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.part-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                store.download(key, f)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Xoá file ít dùng nhất tới khi tổng dung lượng <= max_bytes; trả số file đã xoá."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and not entry.name.startswith('.part-'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            return removed
+
+
+contract_cache = ContractDiskCache()
+
+
+def refresh_contract_meta(hr, store=None) -> Tuple[Optional[int], Optional[str]]:
+    """Đọc (size, etag) của hợp đồng từ store và ghi vào contract_size / contract_etag (update, không gọi save)."""
+    HrUserProfile = type(hr)
+    size = etag = None
+    if hr.contract:
+        size, etag = (store or get_contract_store()).head(hr.contract.name)
+    HrUserProfile.objects.filter(pk=hr.pk).update(contract_size=size, contract_etag=etag)
+    hr.contract_size, hr.contract_etag = size, etag
+    return size, etag
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) (end tính cả) của header Range 1 đoạn 'bytes=a-b' / 'bytes=a-' / 'bytes=-n'.
+    None = không có / không hỗ trợ (nhiều đoạn) -> trả cả file; ValueError = đoạn không thoả mãn (416).
+    """
+    if not header:
+        return None
+    m = _RANGE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_file(path: str, start: int, length: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
@@ -0,0 +1,98 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+
+from django.apps import apps
+
+from app_treatment.services import technique_daily
+
+ZERO = Decimal('0')
+
+
+def expert_services(expert_ids: Iterable[int], start: Optional[date] = None,
+                    end: Optional[date] = None) -> Dict[int, Dict[str, list]]:
+    """
+    {hr_id: {loại dịch vụ: [buổi ...]}} của nhiều nhân sự bằng 1 query
+    (cùng cấu trúc với HrUserProfileSerializer.get_expert_services cũ).
+    """
+    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    expert_ids = [i for i in expert_ids if i]
+    if not expert_ids:
+        return {}
+    qs = (STS.objects
+          .filter(expert_id__in=expert_ids)
+          .select_related(
+              "techical_setting",
+              "session__booking__customer",
+              "session__treatment_request__service",
+              "session__treatment_request__bill__customer",
+          )
+          .order_by("id"))
+    if start and end:
+        qs = qs.annotate(exec_day=technique_daily.execution_day('session__')).filter(exec_day__range=[start, end])
+
+    data = defaultdict(lambda: defaultdict(dict))   # hr_id -> loại -> session_id -> bucket
+    for sts in qs:
+        sess = sts.session
+        tr = sess.treatment_request
+        service = tr.service if tr else None
+        service_type = getattr(service, "type", None) or "UNKNOWN"
+        booking = sess.booking
+        bill = getattr(tr, "bill", None)
+        customer = getattr(booking, "customer", None) or (getattr(bill, "customer", None) if bill else None)
+
+        bucket = data[sts.expert_id][service_type].setdefault(sess.id, {
+            "session_id": sess.id,
+            "customer_name": getattr(customer, "name", None),
+            "service_name": getattr(service, "name", None),
+            "created_at": getattr(bill, "created", None),
+            "participation_count": 0,
+            "total_price": 0,
+            "techniques": {},
+        })
+        # Với FK expert: 100% thời lượng/tiền cho 1 người
+        bucket["participation_count"] += sts.calculate_expert_time() or 1
+        bucket["total_price"] += sts.calculate_expert_payment() or 0
+
+        ts = sts.techical_setting
+        t_bucket = bucket["techniques"].setdefault(ts.id, {
+            "technique_id": ts.id,
+            "technique_name": ts.name,
+            "technique_price": ts.price,
+            "usage_count": 0,
+        })
+        t_bucket["usage_count"] += 1
+
+    out = {}
+    for hr_id, by_type in data.items():
+        out[hr_id] = {
+            s_type: [dict(v, techniques=list(v["techniques"].values())) for v in sessions.values()]
+            for s_type, sessions in by_type.items()
+        }
+    return out
+
+
+def attach_expert_stats(hrs: Iterable, start: Optional[date] = None, end: Optional[date] = None,
+                        with_services: bool = True) -> None:
+    """
+    Gắn thống kê kỹ thuật cho cả trang nhân sự trước khi serialize:
+      hr._expert_stats    = {done_exp (TLCB), done_ser (TLDS), salary} từ TechniqueExecutionDaily (1 query GROUP BY expert)
+      hr._expert_services = như get_expert_services (1 query STS cho cả trang)
+    HR cần select_related('position') để lấy hệ số.
+    """
+    hrs = list(hrs)
+    ids = [hr.pk for hr in hrs]
+    totals = technique_daily.expert_totals(start, end, ids) if ids else {}
+    services = expert_services(ids, start, end) if with_services else None
+    for hr in hrs:
+        t = totals.get(hr.pk)
+        amount = t['amount'] if t else ZERO
+        coeff = Decimal(str(hr._latest_coeff()))
+        hr._expert_stats = {
+            'done_exp': t['count_tlcb'] if t else 0,
+            'done_ser': t['count_tlds'] if t else 0,
+            'salary': (amount * coeff).quantize(Decimal('0.01')),
+        }
+        if services is not None:
+            hr._expert_services = services.get(hr.pk, {})
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from app_hr.contracts import ContractNotFound, refresh_contract_meta
+from app_hr.models import HrUserProfile
+
+
+class Command(BaseCommand):
+    help = "Đọc size / etag file hợp đồng từ S3 cho các nhân sự có hợp đồng (backfill contract_size / contract_etag)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Đọc lại cả các dòng đã có etag.")
+
+    def handle(self, *args, **options):
+        qs = HrUserProfile.objects.exclude(contract="").exclude(contract__isnull=True).only("id", "contract")
+        if not options["all"]:
+            qs = qs.filter(contract_etag__isnull=True)
+        done = missing = 0
+        for hr in qs.iterator():
+            try:
+                refresh_contract_meta(hr)
+                done += 1
+            except ContractNotFound:
+                missing += 1
+                self.stdout.write(self.style.WARNING(f"  HR#{hr.id}: không tìm thấy {hr.contract.name}"))
+        self.stdout.write(self.style.SUCCESS(f"Đã cập nhật {done} hợp đồng, {missing} file không tồn tại."))
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_hr', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hruserprofile',
+            name='contract_etag',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='hruserprofile',
+            name='contract_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
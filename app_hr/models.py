@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 from datetime import date
 from decimal import Decimal
 
@@ -12,6 +13,7 @@ from django.db.models.functions import Coalesce
 from app_home.models import UserProfile, get_file_path, Position
 
 DEC = DecimalField(max_digits=18, decimal_places=2)
+logger = logging.getLogger(__name__)
 
 class HrRunningNumber(models.Model):
     KIND_CHOICES = [
@@ -72,6 +74,9 @@ class HrUserProfile(models.Model):
     contract_end = models.DateField(null=True, blank=True)
     contract_status = models.CharField(max_length=2, choices=CONTRACT_STATUS, null=True, blank=True)
     contract_type = models.CharField(max_length=2, choices=CONTRACT_TYPE, null=True, blank=True)
+    # Metadata file hợp đồng (đọc từ S3 khi đổi file) để danh sách không phải chạm tới S3
+    contract_size = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    contract_etag = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     start_date = models.DateField(null=True, blank=True)
     level = models.CharField(max_length=255, null=True, blank=True)
@@ -81,17 +86,19 @@ class HrUserProfile(models.Model):
 
     # ---------- Helpers ----------
     def _base_qs(self, start: date | None = None, end: date | None = None):
-        if not self.user_id:
-            from django.db.models import QuerySet
-            return django_apps.get_model('app_treatment', 'SessionTechicalSetting').objects.none()
-
         SessionTechicalSetting = django_apps.get_model('app_treatment', 'SessionTechicalSetting')
+        if not self.pk:
+            return SessionTechicalSetting.objects.none()
+
+        # expert là FK tới HrUserProfile -> lọc theo id hồ sơ nhân sự (không phải user_id)
         qs = SessionTechicalSetting.objects.filter(
-            expert_id=self.user_id,
+            expert_id=self.pk,
             has_come=True,
         )
         if start and end:
-            qs = qs.filter(session__booking__receiving_day__range=[start, end])
+            # cùng quy ước ngày với bảng lương (TechniqueExecutionDaily)
+            from app_treatment.services.technique_daily import execution_day
+            qs = qs.annotate(exec_day=execution_day('session__')).filter(exec_day__range=[start, end])
         return qs
 
     def _latest_coeff(self) -> float:
@@ -154,8 +161,30 @@ class HrUserProfile(models.Model):
         yy = date.today().year % 100
         return f"{prefix}{seq:03d}-{yy:02d}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ tên file hợp đồng lúc load để chỉ đọc lại size / etag khi đổi file
+        if 'contract' in instance.__dict__:
+            instance._loaded_contract = instance.__dict__['contract'] or None
+        return instance
+
     def save(self, *args, **kwargs):
+        from app_hr.contracts import refresh_contract_meta
         # Chỉ sinh code khi tạo mới và chưa có code
         if self.pk is None and not self.code:
             self.code = self._gen_code()
+        adding = self._state.adding
         super().save(*args, **kwargs)
+
+        if not adding and not hasattr(self, '_loaded_contract'):
+            return  # contract bị defer lúc load: không biết file có đổi không
+        name = self.contract.name if self.contract else None
+        loaded = None if adding else self._loaded_contract
+        self._loaded_contract = name
+        if name != loaded:
+            try:
+                refresh_contract_meta(self)
+            except Exception:
+                # Không chặn lưu hồ sơ; endpoint hợp đồng sẽ đọc lại metadata khi cần
+                logger.exception("Không đọc được metadata hợp đồng của nhân sự #%s", self.pk)
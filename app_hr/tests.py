@@ -1,3 +1,177 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from django.contrib.auth.models import User
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from app_hr.contracts import ContractDiskCache, ContractNotFound, ContractStoreError, LocalContractStore, \
+    S3ContractStore, parse_range, set_contract_store
+from app_hr.models import HrUserProfile
+
+
+CONTENT = bytes(range(256)) * 4  # 1024 byte
+
+
+class ContractEndpointTests(TestCase):
+    """Endpoint hợp đồng chạy trên LocalContractStore (thay cho S3) + cache đĩa riêng cho mỗi test."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "store", "contracts"))
+        with open(os.path.join(self.root, "store", "contracts", "a.pdf"), "wb") as f:
+            f.write(CONTENT)
+        set_contract_store(LocalContractStore(os.path.join(self.root, "store")))
+        self.addCleanup(set_contract_store, None)
+        patcher = mock.patch("app_hr.views.contract_cache", ContractDiskCache(os.path.join(self.root, "cache")))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(User.objects.create(username="admin", is_staff=True, is_superuser=True))
+        self.hr = HrUserProfile.objects.create(full_name="A", contract="contracts/a.pdf")
+        self.url = f"/api/app-hr/v1/hr-management/{self.hr.pk}/contract/"
+
+    def stream(self, **headers):
+        response = self.client_api.get(self.url, {"stream": "1"}, **headers)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_metadata_read_on_save(self):
+        hr = HrUserProfile.objects.get(pk=self.hr.pk)
+        self.assertEqual(hr.contract_size, len(CONTENT))
+        data = self.client_api.get(self.url).json()
+        self.assertEqual((data["size"], data["etag"]), (len(CONTENT), hr.contract_etag))
+        self.assertTrue(data["url"].endswith("?stream=1"))
+
+    def test_full_and_ranged_stream(self):
+        response, body = self.stream()
+        self.assertEqual((response.status_code, body), (200, CONTENT))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response, body = self.stream(HTTP_RANGE="bytes=10-19")
+        self.assertEqual((response.status_code, body), (206, CONTENT[10:20]))
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(CONTENT)}")
+
+        response, body = self.stream(HTTP_RANGE="bytes=-5")
+        self.assertEqual((response.status_code, body), (206, CONTENT[-5:]))
+
+        response, body = self.stream(HTTP_RANGE="bytes=1000-")
+        self.assertEqual((response.status_code, body), (206, CONTENT[1000:]))
+
+        response, _ = self.stream(HTTP_RANGE=f"bytes={len(CONTENT)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(CONTENT)}")
+
+    def test_if_none_match(self):
+        response, _ = self.stream()
+        etag = response["ETag"]
+        response, body = self.stream(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, body), (304, b""))
+        self.assertEqual(self.stream(HTTP_IF_NONE_MATCH='"other"')[0].status_code, 200)
+
+    def test_path_outside_store_is_not_found(self):
+        with open(os.path.join(self.root, "secret.pdf"), "wb") as f:
+            f.write(b"secret")
+        store = LocalContractStore(os.path.join(self.root, "store"))
+        for key in ("../secret.pdf", "contracts/../../secret.pdf", os.path.join(self.root, "secret.pdf")):
+            with self.assertRaises(ContractNotFound, msg=key):
+                store.head(key)
+        HrUserProfile.objects.filter(pk=self.hr.pk).update(contract="../secret.pdf", contract_etag=None)
+        self.assertEqual(self.client_api.get(self.url).status_code, 404)
+
+
+class ParseRangeTests(TestCase):
+
+    def test_parse_range(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))  # nhiều đoạn -> cả file
+        self.assertIsNone(parse_range("items=0-1", 100))
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-200", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+        for header in ("bytes=100-", "bytes=5-4", "bytes=-0"):
+            with self.assertRaises(ValueError, msg=header):
+                parse_range(header, 100)
+
+
+class ContractDiskCacheTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, "store"))
+        for name in "abcd":
+            with open(os.path.join(self.root, "store", name), "wb") as f:
+                f.write(name.encode() * 100)
+        self.store = LocalContractStore(os.path.join(self.root, "store"))
+        self.cache = ContractDiskCache(os.path.join(self.root, "cache"), max_bytes=300)
+
+    def cached(self):
+        return {name for name in "abcd" if os.path.exists(self.cache.path_for(name, "1"))}
+
+    def get(self, name, mtime):
+        path = self.cache.get(name, "1", store=self.store)
+        os.utime(path, (mtime, mtime))  # mtime tăng dần thay cho thời gian đọc thực
+        return path
+
+    def test_evicts_least_recently_used(self):
+        for t, name in enumerate("abc"):
+            self.get(name, 1000 + t)
+        self.get("a", 2000)  # đọc lại: a thành mới nhất
+        path = self.get("d", 3000)
+        self.assertEqual(self.cached(), {"a", "c", "d"})
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"d" * 100)
+
+    def test_keeps_file_just_downloaded(self):
+        self.cache.max_bytes = 50
+        path = self.cache.get("a", "1", store=self.store)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.cache.evict(keep=path), 0)
+
+
+class _FailingStore(LocalContractStore):
+    """Store lỗi như S3 từ chối quyền / throttling."""
+
+    def head(self, key):
+        raise ContractStoreError(key)
+
+
+class ContractStoreErrorTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        set_contract_store(_FailingStore(self.root))
+        self.addCleanup(set_contract_store, None)
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(User.objects.create(username="admin", is_staff=True, is_superuser=True))
+
+    def test_save_logs_instead_of_failing(self):
+        with self.assertLogs("app_hr.models", level="ERROR"):
+            hr = HrUserProfile.objects.create(full_name="A", contract="contracts/a.pdf")
+        self.assertIsNone(HrUserProfile.objects.get(pk=hr.pk).contract_etag)
+
+    def test_store_error_is_bad_gateway(self):
+        with self.assertLogs("app_hr.models", level="ERROR"):
+            hr = HrUserProfile.objects.create(full_name="A", contract="contracts/a.pdf")
+        response = self.client_api.get(f"/api/app-hr/v1/hr-management/{hr.pk}/contract/")
+        self.assertEqual(response.status_code, 502)
+
+    def test_s3_client_errors(self):
+        def failing(code):
+            client = mock.Mock()
+            client.head_object.side_effect = ClientError({"Error": {"Code": code}}, "HeadObject")
+            return S3ContractStore(client=client, bucket="b")
 
-# Create your tests here.
+        with self.assertRaises(ContractNotFound):
+            failing("404").head("k")
+        for code in ("403", "SlowDown"):
+            with self.assertRaises(ContractStoreError):
+                failing(code).head("k")
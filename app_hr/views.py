@@ -1,8 +1,18 @@
+import mimetypes
+import os
+
 from .serializers import HrUserProfileSerializer
+from .expert_stats import attach_expert_stats
+from .contracts import (
+    CONTRACT_URL_TTL, ContractNotFound, ContractStoreError, contract_cache, get_contract_store, iter_file, parse_range,
+    refresh_contract_meta,
+)
+from app_home.mixins import SparseFieldsMixin
 from app_home.pagination import CustomPagination
 from django.db import transaction
 from django.contrib.auth.models import User
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from django.utils.dateparse import parse_date
 from app_home.views import CollaboratorReadOnlyPermission
 from app_home.serializers import  UserSerializer
 from drf_spectacular.utils import extend_schema
@@ -10,7 +20,8 @@ from django.db.models import Q, Value, Sum, Count, F
 from django.db.models.functions import Concat
 from rest_framework import viewsets, status
 from .models import HrUserProfile
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.response import Response
 from .docs import hr_management_schema
 from django.contrib.auth import get_user_model
@@ -22,18 +33,57 @@ from app_customer.models import Customer, Referral, LeadSourceActor
 
 User = get_user_model()
 from app_treatment.models import ARItem, PaymentHistory
+from app_treatment.services.ar_periods import day_range
+from app_treatment.services.referral_attribution import referrer_totals
 from rest_framework.views import APIView
 
 @extend_schema(tags=["app_hr"])
 @hr_management_schema()
-class HrUserProfileViewSet(viewsets.ModelViewSet):
+class HrUserProfileViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     serializer_class = HrUserProfileSerializer
     pagination_class = CustomPagination
     permission_classes = [IsAuthenticated, CollaboratorReadOnlyPermission]
+    # ?fields= / ?omit=: expert_done_session_exp / _ser, expert_salary, expert_services mỗi field vài query / dòng
+    sparse_field_costs = {
+        'user': {'select_related': ('user',)},
+        'position': {'select_related': ('position__department',)},
+        'department': {'select_related': ('position__department',)},
+    }
+
+    EXPERT_STAT_FIELDS = ('expert_done_session_exp', 'expert_done_session_ser', 'expert_salary')
+
+    def stats_window(self):
+        """?startDate / ?endDate: khoảng ngày tính thống kê kỹ thuật (bỏ trống = toàn bộ)."""
+        start = parse_date(self.request.query_params.get('startDate') or '')
+        end = parse_date(self.request.query_params.get('endDate') or '')
+        return (start, end) if start and end else (None, None)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['stats_window'] = self.stats_window()
+        return context
+
+    def _attach_stats(self, hrs):
+        if self.request.method not in SAFE_METHODS:
+            return
+        wants_stats = any(self.sparse_wants(f) for f in self.EXPERT_STAT_FIELDS)
+        wants_services = self.sparse_wants('expert_services')
+        if wants_stats or wants_services:
+            attach_expert_stats(hrs, *self.stats_window(), with_services=wants_services)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # thống kê cả trang: 1 query GROUP BY expert + 1 query dịch vụ, thay vì vài query / dòng
+        self._attach_stats(page if page is not None else [])
+        return page
+
+    def get_object(self):
+        obj = super().get_object()
+        if self.action == 'retrieve':
+            self._attach_stats([obj])
+        return obj
 
     def get_queryset(self):
-        start_date = self.request.query_params.get('startDate')
-        end_date = self.request.query_params.get('endDate')
         search_term = self.request.query_params.get('searchTerm', None)
         format = self.request.query_params.get('format', None)
         #Phòng ban đang không có trong serializer nên hỏi FE có nên trả về phòng ban trong phòng nhân sự không ?
@@ -42,13 +92,10 @@ class HrUserProfileViewSet(viewsets.ModelViewSet):
         contract_status = self.request.query_params.get('contractStatus', None) 
         user_type = self.request.query_params.get('type', None)
         #Vì ko có full_name trong hr model nên phải trích từ user_profile: full_name để filtering
-        queryset = HrUserProfile.objects.all()
+        queryset = HrUserProfile.objects.select_related('user', 'position__department')
 
         filters = Q()
 
-        if start_date and end_date:
-            filters &= Q(date__range=[start_date, end_date])
-            
         if user_type:
             filters &= Q(type=user_type)
 
@@ -78,6 +125,75 @@ class HrUserProfileViewSet(viewsets.ModelViewSet):
             filters &= Q(contract_status=contract_status)
         return queryset.filter(filters).order_by('-created')
 
+    @action(detail=True, methods=['get'], url_path='contract')
+    def contract(self, request, pk=None):
+        """
+        File hợp đồng của nhân sự:
+          mặc định   -> {name, size, etag, url, expires_in}: url là presigned URL S3 hết hạn sau expires_in giây
+          ?stream=1  -> trả file qua cache đĩa của server, hỗ trợ Range (206) và If-None-Match (304)
+        """
+        hr = self.get_object()
+        if not hr.contract:
+            return Response({"detail": "Nhân sự chưa có hợp đồng."}, status=status.HTTP_404_NOT_FOUND)
+        key = hr.contract.name
+        name = os.path.basename(key)
+        try:
+            if not hr.contract_etag:
+                refresh_contract_meta(hr)
+        except ContractNotFound:
+            return Response({"detail": "Không tìm thấy file hợp đồng."}, status=status.HTTP_404_NOT_FOUND)
+        except ContractStoreError:
+            return Response({"detail": "Không đọc được file hợp đồng từ kho lưu trữ, vui lòng thử lại."},
+                            status=status.HTTP_502_BAD_GATEWAY)
+
+        if request.query_params.get('stream') not in ('1', 'true'):
+            url = get_contract_store().presigned_url(key, CONTRACT_URL_TTL, filename=name)
+            if url is None:  # store local không có presigned URL -> stream qua server
+                url = request.build_absolute_uri(f"{request.path}?stream=1")
+            return Response({
+                "name": name,
+                "size": hr.contract_size,
+                "etag": hr.contract_etag,
+                "url": url,
+                "expires_in": CONTRACT_URL_TTL,
+            })
+
+        etag = f'"{hr.contract_etag}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
+        try:
+            path = contract_cache.get(key, hr.contract_etag)
+        except ContractNotFound:
+            return Response({"detail": "Không tìm thấy file hợp đồng."}, status=status.HTTP_404_NOT_FOUND)
+        except ContractStoreError:
+            return Response({"detail": "Không đọc được file hợp đồng từ kho lưu trữ, vui lòng thử lại."},
+                            status=status.HTTP_502_BAD_GATEWAY)
+        size = os.path.getsize(path)
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        start, end = byte_range or (0, size - 1)
+        length = max(end - start + 1, 0)
+        response = StreamingHttpResponse(
+            iter_file(path, start, length),
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        )
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=0'
+        response['Content-Disposition'] = f'inline; filename="{name}"'
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        return response
+
     def perform_create(self, serializer):
         serializer.save()
         
@@ -102,17 +218,43 @@ def get_collaborator_list(request):
     serializer = UserSerializer(collaborators, many=True)
     return Response(serializer.data, status=status.HTTP_200_OK)
 
+def _paginate(view, request, queryset):
+    """Phân trang CustomPagination khi client gửi ?page / ?pageSize; không gửi thì trả cả danh sách như cũ."""
+    paginator = CustomPagination()
+    if not {paginator.page_query_param, paginator.page_size_query_param} & set(request.query_params):
+        return None, list(queryset)
+    return paginator, paginator.paginate_queryset(queryset, request, view=view)
+
+
+def _respond(paginator, result):
+    return paginator.get_paginated_response(result) if paginator else Response(result)
+
+
+def _window(request):
+    start = parse_date(request.query_params.get("startDate") or "")
+    end = parse_date(request.query_params.get("endDate") or "")
+    return start, end
+
+
+EMPTY_ATTRIBUTION = {"customers": 0, "invoices": 0, "revenue": 0}
+
+INVOICE_TYPE_LABELS = {
+    "treatmentrequest": "Hóa đơn phác đồ",
+    "diagnosis_medicine": "Thành phần thuốc",
+    "doctorprocess": "Hóa đơn thuốc",
+}
+
+
 class CollaboratorRevenueListAPI(APIView):
+    """Danh sách CTV + số khách giới thiệu, số hoá đơn, doanh thu trong kỳ (đọc ReferralAttribution)."""
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        start_date = request.query_params.get("startDate")
-        end_date = request.query_params.get("endDate")
+        start_date, end_date = _window(request)
         search = (request.query_params.get("searchTerm") or "").strip()
 
-        # 0) LẤY TẤT CẢ CTV từ HrUserProfile - nguồn duy nhất
+        # LẤY TẤT CẢ CTV từ HrUserProfile - nguồn duy nhất
         ctv_qs = HrUserProfile.objects.filter(type='collaborator')
-        
         if search:
             ctv_qs = ctv_qs.filter(
                 Q(full_name__icontains=search) |
@@ -120,77 +262,14 @@ class CollaboratorRevenueListAPI(APIView):
                 Q(mobile__icontains=search) |
                 Q(code__icontains=search)
             )
-        
-        # Lấy ID của HrUserProfile
-        ctv_ids = list(ctv_qs.values_list("id", flat=True))
-
-        # 1) Lấy danh sách khách hàng được CTV giới thiệu thông qua Referral
-        # ref_hr_id giờ trỏ đến HrUserProfile.id
-        ci_qs = Referral.objects.filter(ref_hr_id__in=ctv_ids).values("ref_hr_id", "customer_id")
-        customers_by_ctv = defaultdict(set)
-        for rel in ci_qs:
-            customers_by_ctv[rel["ref_hr_id"]].add(rel["customer_id"])
-
-        # 2) ARItem của toàn bộ khách hàng đã được CTV giới thiệu
-        all_customer_ids = {cid for s in customers_by_ctv.values() for cid in s}
-        ar_qs = ARItem.objects.filter(customer_id__in=all_customer_ids) if all_customer_ids else ARItem.objects.none()
-
-        # 3) Doanh thu theo khách hàng = SUM PaymentHistory.paid_amount
-        revenue_by_customer = {}
-        if ar_qs.exists():
-            pmt_filters = Q(ar_item__customer_id__in=all_customer_ids)
-            if start_date and end_date:
-                pmt_filters &= Q(created__date__range=[start_date, end_date])
-            elif start_date:
-                pmt_filters &= Q(created__date__gte=start_date)
-            elif end_date:
-                pmt_filters &= Q(created__date__lte=end_date)
-
-            pmt_qs = (
-                PaymentHistory.objects
-                .filter(pmt_filters)
-                .values("ar_item__customer_id")
-                .annotate(revenue=Sum("paid_amount"))
-            )
-            revenue_by_customer = {
-                r["ar_item__customer_id"]: r["revenue"] or 0
-                for r in pmt_qs
-            }
-
-        # 4) Đếm số hóa đơn (ARItem) theo khách hàng
-        ar_count_by_customer = {}
-        if ar_qs.exists():
-            invoice_count = (
-                ar_qs.values("customer_id")
-                     .annotate(cnt=Count("id", distinct=True))
-            )
-            ar_count_by_customer = {r["customer_id"]: r["cnt"] for r in invoice_count}
-
-        # 5) Khởi tạo dữ liệu cho TẤT CẢ CTV
-        data = {}
-        for ctv_id in ctv_ids:
-            data[ctv_id] = {
-                "total_revenue": 0,
-                "invoices": 0,
-                "referrals": 0
-            }
-
-        # 6) Tổng hợp thông tin cho từng CTV
-        for ctv_id, cust_set in customers_by_ctv.items():
-            if ctv_id not in data:
-                continue
-            
-            total_rev = sum(revenue_by_customer.get(c, 0) or 0 for c in cust_set)
-            total_inv = sum(ar_count_by_customer.get(c, 0) for c in cust_set)
-            
-            data[ctv_id]["total_revenue"] = total_rev
-            data[ctv_id]["invoices"] = total_inv
-            data[ctv_id]["referrals"] = len(cust_set)
-
-        # 7) Tạo kết quả - TRẢ VỀ TẤT CẢ CTV
+        paginator, ctvs = _paginate(self, request, ctv_qs.order_by("-created"))
+
+        # Khách / hoá đơn (toàn bộ) và doanh thu trong kỳ của cả trang: 1 query trên bảng gộp
+        stats = referrer_totals("hr", [c.id for c in ctvs], start_date, end_date)
+
         result = []
-        for ctv in ctv_qs.order_by("-created"):
-            row = data.get(ctv.id, {"invoices": 0, "total_revenue": 0, "referrals": 0})
+        for ctv in ctvs:
+            row = stats.get(ctv.id, EMPTY_ATTRIBUTION)
             result.append({
                 "id": ctv.id,
                 "code": ctv.code,
@@ -198,241 +277,114 @@ class CollaboratorRevenueListAPI(APIView):
                 "email": ctv.email,
                 "mobile": ctv.mobile,
                 "invoices": row["invoices"],
-                "total_revenue": row["total_revenue"],
-                "referrals": row["referrals"],
+                "total_revenue": row["revenue"],
+                "referrals": row["customers"],
             })
-        
-        return Response(result)
-    
+        return _respond(paginator, result)
+
+
+def _referred_customer_details(view, request, referral_field, referrer_id):
+    """
+    Chi tiết khách do 1 người giới thiệu (CTV / actor): hoá đơn ARItem + doanh thu từng hoá đơn trong kỳ.
+    Luôn phân trang theo khách (CustomPagination); số query cố định cho mỗi trang dù người giới thiệu
+    có bao nhiêu khách (ARItem và PaymentHistory lấy gộp cho cả trang).
+    """
+    start_date, end_date = _window(request)
+    search = (request.query_params.get("searchTerm") or "").strip()
+
+    cust_qs = Customer.objects.filter(**{f"primary_referral__{referral_field}": referrer_id})
+    if search:
+        cust_qs = cust_qs.filter(Q(name__icontains=search) | Q(mobile__icontains=search))
+    paginator = CustomPagination()
+    customers = paginator.paginate_queryset(cust_qs.only("id", "name", "mobile").order_by("id"), request, view=view)
+
+    ars_by_customer = defaultdict(list)
+    for ar in (ARItem.objects
+               .filter(customer_id__in=[c.id for c in customers])
+               .values("id", "customer_id", "created", "content_type_id")
+               .order_by("id")):
+        ars_by_customer[ar["customer_id"]].append(ar)
+
+    # Doanh thu theo ARItem = SUM PaymentHistory.paid_amount (lọc theo kỳ nếu có)
+    ar_ids = [ar["id"] for ars in ars_by_customer.values() for ar in ars]
+    ar_rev_map = dict(
+        PaymentHistory.objects
+        .filter(ar_item_id__in=ar_ids)
+        .filter(day_range("created", start_date, end_date))
+        .values("ar_item_id")
+        .annotate(revenue=Sum("paid_amount"))
+        .values_list("ar_item_id", "revenue")
+    ) if ar_ids else {}
+
+    invoice_types = {}
+    for ct_id in {ar["content_type_id"] for ars in ars_by_customer.values() for ar in ars}:
+        model = ContentType.objects.get_for_id(ct_id).model  # cache của ContentTypeManager
+        invoice_types[ct_id] = INVOICE_TYPE_LABELS.get(model.lower(), model.title())
+
+    result = []
+    for c in customers:
+        details = []
+        total_rev = 0
+        for ar in ars_by_customer.get(c.id, []):
+            invoice_type = invoice_types[ar["content_type_id"]]
+            rev = ar_rev_map.get(ar["id"], 0) or 0
+            total_rev += rev
+            details.append({
+                "created": ar["created"],
+                "invoice_type": invoice_type,
+                "revenue": rev,
+            })
+
+        result.append({
+            "customer_id": c.id,
+            "name": c.name,
+            "mobile": c.mobile,
+            "total_invoices": len(details),
+            "total_revenue": total_rev,
+            "details": details,
+        })
+    return paginator.get_paginated_response(result)
+
+
 class CollaboratorCustomerDetailAPI(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, user_id):
-        start_date = request.query_params.get("startDate")
-        end_date = request.query_params.get("endDate")
-        search = (request.query_params.get("searchTerm") or "").strip()
-
         # KH do CTV này giới thiệu thông qua Referral
-        cust_ids = (Referral.objects
-                    .filter(ref_hr_id=user_id)
-                    .values_list("customer_id", flat=True))
+        return _referred_customer_details(self, request, "ref_hr_id", user_id)
 
-        cust_qs = Customer.objects.filter(id__in=cust_ids)
-        if search:
-            cust_qs = cust_qs.filter(Q(name__icontains=search) | Q(mobile__icontains=search))
-
-        # ARItem của các khách hàng này
-        ar_qs = ARItem.objects.filter(customer_id__in=cust_qs.values("id"))
-
-        # Doanh thu theo ARItem = SUM PaymentHistory.paid_amount (lọc theo kỳ nếu có)
-        pmt_filters = Q(ar_item_id__in=ar_qs.values("id"))
-        if start_date and end_date:
-            pmt_filters &= Q(created__date__range=[start_date, end_date])
-        elif start_date:
-            pmt_filters &= Q(created__date__gte=start_date)
-        elif end_date:
-            pmt_filters &= Q(created__date__lte=end_date)
-
-        ar_revenue = (
-            PaymentHistory.objects.filter(pmt_filters)
-            .values("ar_item_id")
-            .annotate(revenue=Sum("paid_amount"))
-        )
-        ar_rev_map = {r["ar_item_id"]: r["revenue"] or 0 for r in ar_revenue}
 
-        # Build details per customer
-        result = []
-        for c in cust_qs:
-            cust_ar = list(
-                ar_qs.filter(customer_id=c.id)
-                     .values("id", "created", "content_type_id", "description")
-            )
-            details = []
-            total_rev = 0
-
-            for ar in cust_ar:
-                ct = ContentType.objects.get_for_id(ar["content_type_id"])
-                invoice_type = {
-                    "treatmentrequest": "Hóa đơn phác đồ",
-                    "diagnosis_medicine": "Thành phần thuốc",
-                    "doctorprocess": "Hóa đơn thuốc",
-                }.get(ct.model.lower(), ct.model.title())
-
-                rev = ar_rev_map.get(ar["id"], 0) or 0
-                total_rev += rev
-                details.append({
-                    "created": ar["created"],
-                    "invoice_type": invoice_type,
-                    "revenue": rev,
-                })
-
-            result.append({
-                "customer_id": c.id,
-                "name": c.name,
-                "mobile": c.mobile,
-                "total_invoices": len(cust_ar),
-                "total_revenue": total_rev,
-                "details": details,
-            })
-        return Response(result)
-    
 class ActorLeadSourcePerformanceAPI(APIView):
+    """Danh sách actor LeadSource + số khách giới thiệu, doanh thu trong kỳ (đọc ReferralAttribution)."""
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        start_date = request.query_params.get("startDate")
-        end_date = request.query_params.get("endDate")
+        start_date, end_date = _window(request)
         search = (request.query_params.get("searchTerm") or "").strip()
 
-        # 1) Lọc tất cả các Actor từ LeadSourceActor
-        actors_qs = LeadSourceActor.objects.all()  # Lấy tất cả actor từ LeadSourceActor
-
+        actors_qs = LeadSourceActor.objects.select_related("source")
         if search:
-            actors_qs = actors_qs.filter(
-                Q(name__icontains=search)
-            )
+            actors_qs = actors_qs.filter(Q(name__icontains=search))
+        paginator, actors = _paginate(self, request, actors_qs.order_by("id"))
 
-        actor_ids = list(actors_qs.values_list("id", flat=True))  # Sử dụng ID của LeadSourceActor
+        stats = referrer_totals("actor", [a.id for a in actors], start_date, end_date)
 
-        # 2) Lấy danh sách khách hàng (customer) mà các actor đã giới thiệu thông qua Referral
-        ci_qs = (
-            Referral.objects.filter(ref_actor_id__in=actor_ids)
-            .values("ref_actor_id", "customer_id")
-        )
-        customers_by_actor = defaultdict(set)
-        for rel in ci_qs:
-            customers_by_actor[rel["ref_actor_id"]].add(rel["customer_id"])
-
-        # 3) Lấy ARItem từ tất cả các khách hàng đã giới thiệu
-        all_customer_ids = {cid for s in customers_by_actor.values() for cid in s}
-        ar_qs = ARItem.objects.filter(customer_id__in=all_customer_ids) if all_customer_ids else ARItem.objects.none()
-
-        # 4) Doanh thu: sum PaymentHistory
-        revenue_by_customer = {}
-        if ar_qs.exists():
-            pmt_filters = Q(ar_item__customer_id__in=all_customer_ids)
-            if start_date and end_date:
-                pmt_filters &= Q(created__date__range=[start_date, end_date])
-            elif start_date:
-                pmt_filters &= Q(created__date__gte=start_date)
-            elif end_date:
-                pmt_filters &= Q(created__date__lte=end_date)
-
-            pmt_qs = (
-                PaymentHistory.objects
-                .filter(pmt_filters)
-                .values("ar_item__customer_id")
-                .annotate(revenue=Sum("paid_amount"))
-            )
-            revenue_by_customer = {
-                r["ar_item__customer_id"]: r["revenue"] or 0
-                for r in pmt_qs
-            }
-
-        # 5) Đếm số lượng khách hàng (customer) được giới thiệu bởi từng actor
-        data = {
-            actor_id: {
-                "actor_id": actor_id,
-                "total_revenue": 0,
-                "total_customers": 0,
-                "lead_source": None,  # Thêm thông tin LeadSource vào
-            }
-            for actor_id in actor_ids
-        }
-
-        # 6) Tính doanh thu và số lượng khách cho từng actor
-        for actor_id, customer_set in customers_by_actor.items():
-            total_revenue = sum(revenue_by_customer.get(c, 0) for c in customer_set)
-            total_customers = len(customer_set)
-            # Lấy thông tin LeadSource từ Actor
-            actor = LeadSourceActor.objects.get(id=actor_id)
-            lead_source = actor.source.name if actor.source else "N/A"  # Thêm LeadSource
-
-            data[actor_id]["total_revenue"] = total_revenue
-            data[actor_id]["total_customers"] = total_customers
-            data[actor_id]["lead_source"] = lead_source
-
-        # 7) Join thông tin Actor (LeadSourceActor)
         result = []
-        for actor in actors_qs.order_by("id"):
-            actor_data = data.get(actor.id, {"total_revenue": 0, "total_customers": 0, "lead_source": "N/A"})
+        for actor in actors:
+            row = stats.get(actor.id, EMPTY_ATTRIBUTION)
             result.append({
                 "actor_id": actor.id,
                 "full_name": actor.name,  # Sử dụng tên actor từ trường 'name'
-                "total_revenue": actor_data["total_revenue"],
-                "total_customers": actor_data["total_customers"],
-                "lead_source": actor_data["lead_source"],
+                "total_revenue": row["revenue"],
+                "total_customers": row["customers"],
+                "lead_source": actor.source.name if actor.source_id else "N/A",
             })
-        return Response(result)
-    
+        return _respond(paginator, result)
+
+
 class ActorCustomerDetailAPI(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, user_id):
-        start_date = request.query_params.get("startDate")
-        end_date = request.query_params.get("endDate")
-        search = (request.query_params.get("searchTerm") or "").strip()
-
         # KH do Actor này giới thiệu thông qua Referral
-        cust_ids = (Referral.objects
-                    .filter(ref_actor_id=user_id)
-                    .values_list("customer_id", flat=True))
-
-        cust_qs = Customer.objects.filter(id__in=cust_ids)
-        if search:
-            cust_qs = cust_qs.filter(Q(name__icontains=search) | Q(mobile__icontains=search))
-
-        # ARItem của các khách hàng này
-        ar_qs = ARItem.objects.filter(customer_id__in=cust_qs.values("id"))
-
-        # Doanh thu theo ARItem = SUM PaymentHistory.paid_amount (lọc theo kỳ nếu có)
-        pmt_filters = Q(ar_item_id__in=ar_qs.values("id"))
-        if start_date and end_date:
-            pmt_filters &= Q(created__date__range=[start_date, end_date])
-        elif start_date:
-            pmt_filters &= Q(created__date__gte=start_date)
-        elif end_date:
-            pmt_filters &= Q(created__date__lte=end_date)
-
-        ar_revenue = (
-            PaymentHistory.objects.filter(pmt_filters)
-            .values("ar_item_id")
-            .annotate(revenue=Sum("paid_amount"))
-        )
-        ar_rev_map = {r["ar_item_id"]: r["revenue"] or 0 for r in ar_revenue}
-
-        # Build details per customer
-        result = []
-        for c in cust_qs:
-            cust_ar = list(
-                ar_qs.filter(customer_id=c.id)
-                     .values("id", "created", "content_type_id", "description")
-            )
-            details = []
-            total_rev = 0
-
-            for ar in cust_ar:
-                ct = ContentType.objects.get_for_id(ar["content_type_id"])
-                invoice_type = {
-                    "treatmentrequest": "Hóa đơn phác đồ",
-                    "diagnosis_medicine": "Thành phần thuốc",
-                    "doctorprocess": "Hóa đơn thuốc",
-                }.get(ct.model.lower(), ct.model.title())
-
-                rev = ar_rev_map.get(ar["id"], 0) or 0
-                total_rev += rev
-                details.append({
-                    "created": ar["created"],
-                    "invoice_type": invoice_type,
-                    "revenue": rev,
-                })
-
-            result.append({
-                "customer_id": c.id,
-                "name": c.name,
-                "mobile": c.mobile,
-                "total_invoices": len(cust_ar),
-                "total_revenue": total_rev,
-                "details": details,
-            })
-        return Response(result)
\ No newline at end of file
+        return _referred_customer_details(self, request, "ref_actor_id", user_id)
@@ -1,8 +1,9 @@
 from django.db import models, transaction
 from django.db.models import F, Q
 from django.conf import settings
-from app_home.models import TreatmentPackage, generate_random_code,\
+from app_home.models import TreatmentPackage,\
 Unit
+from app_home.codes import next_code
 from django.utils import timezone
 from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
@@ -66,11 +67,7 @@ class Service(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = generate_random_code()
-                if not Service.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("DV")
         super().save(*args, **kwargs)
 
     class Meta:
@@ -114,11 +111,7 @@ class Product(models.Model):
     def save(self, *args, **kwargs):
         print('hello')
         if not self.code:
-            while True:
-                new_code = generate_random_code()
-                if not Product.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("SP")
         super().save(*args, **kwargs)
 
     class Meta:
@@ -287,11 +280,7 @@ class Warehouse(models.Model):
         return f"{self.supplier.name} - {self.product.name} - {self.quantity}"
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = generate_random_code()
-                if not Warehouse.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("KHO")
         super().save(*args, **kwargs)
     class Meta:
         app_label = "app_product"
@@ -338,11 +327,7 @@ class StockIn(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = f"SI{timezone.now().strftime('%Y%m%d%H%M%S')}"
-                if not StockIn.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("SI")
         super().save(*args, **kwargs)
 
     def get_total(self) -> Decimal:
@@ -572,11 +557,7 @@ class StockOut(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            while True:
-                new_code = f"SO{timezone.now().strftime('%Y%m%d%H%M%S')}"
-                if not StockOut.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("SO")
         super().save(*args, **kwargs)
 
     # Thành tiền thực tế (đúng với FE “Thành tiền”)
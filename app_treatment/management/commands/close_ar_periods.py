@@ -0,0 +1,56 @@
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from app_treatment.models import ARItem, ARPeriodClose, PaymentHistory
+from app_treatment.services.ar_periods import close_period, month_start, next_month, prev_month, reopen_from
+
+
+def _parse_month(value: str) -> date:
+    try:
+        return datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise CommandError(f"Tháng không hợp lệ: {value} (định dạng YYYY-MM)")
+
+
+class Command(BaseCommand):
+    help = "Khoá sổ công nợ theo tháng: ghi ARPeriodSnapshot cho các tháng đã kết thúc chưa khoá."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--through", help="Khoá tới hết tháng này (YYYY-MM). Mặc định: tháng trước.")
+        parser.add_argument("--reopen-from", dest="reopen_from",
+                            help="Mở lại & tính lại từ tháng này (YYYY-MM), dùng khi có chứng từ ghi lùi ngày.")
+
+    def handle(self, *args, **options):
+        through = _parse_month(options["through"]) if options.get("through") else prev_month(timezone.now().date())
+        if through >= month_start(timezone.now().date()):
+            raise CommandError("Chỉ khoá được tháng đã kết thúc.")
+
+        if options.get("reopen_from"):
+            n = reopen_from(_parse_month(options["reopen_from"]))
+            self.stdout.write(f"Đã mở lại {n} kỳ.")
+
+        last = ARPeriodClose.objects.order_by("-period").values_list("period", flat=True).first()
+        if last:
+            period = next_month(last)
+        else:
+            firsts = [
+                ARItem.objects.aggregate(m=Min("created"))["m"],
+                PaymentHistory.objects.aggregate(m=Min("created"))["m"],
+            ]
+            firsts = [f for f in firsts if f]
+            if not firsts:
+                self.stdout.write("Chưa có dữ liệu công nợ.")
+                return
+            period = month_start(min(firsts).date())
+
+        closed = 0
+        while period <= through:
+            rows = close_period(period)
+            self.stdout.write(f"  {period:%Y-%m}: {rows} khách hàng")
+            closed += 1
+            period = next_month(period)
+
+        self.stdout.write(self.style.SUCCESS(f"Đã khoá {closed} kỳ."))
@@ -0,0 +1,42 @@
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app_treatment.models import PayrollRun
+from app_treatment.services.ar_periods import month_start, prev_month
+from app_treatment.services.payroll_runs import close_period, reopen_from
+
+
+def _parse_month(value: str) -> date:
+    try:
+        return datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise CommandError(f"Tháng không hợp lệ: {value} (định dạng YYYY-MM)")
+
+
+class Command(BaseCommand):
+    help = "Chốt lương hiệu suất theo tháng: ghi PayrollRun / PayrollLine cho tháng đã kết thúc."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--period", help="Chốt đúng tháng này (YYYY-MM). Mặc định: tháng trước.")
+        parser.add_argument("--recompute", action="store_true", help="Chốt lại nếu tháng đã chốt.")
+        parser.add_argument("--reopen-from", dest="reopen_from",
+                            help="Mở lại các kỳ từ tháng này (YYYY-MM), bảng lương quay về tính trực tiếp.")
+
+    def handle(self, *args, **options):
+        if options.get("reopen_from"):
+            n = reopen_from(_parse_month(options["reopen_from"]))
+            self.stdout.write(self.style.SUCCESS(f"Đã mở lại {n} kỳ lương."))
+            if not options.get("period"):
+                return
+
+        period = _parse_month(options["period"]) if options.get("period") else prev_month(timezone.now().date())
+        if period >= month_start(timezone.now().date()):
+            raise CommandError("Chỉ chốt được tháng đã kết thúc.")
+        if not options["recompute"] and PayrollRun.objects.filter(period=period).exists():
+            raise CommandError(f"Kỳ {period:%Y-%m} đã chốt (dùng --recompute để chốt lại).")
+
+        run = close_period(period)
+        self.stdout.write(self.style.SUCCESS(
+            f"Đã chốt kỳ {run.period:%Y-%m}: {run.line_count} nhân sự, tổng lương {run.total_salary}."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from app_treatment.models import Bill
+from app_treatment.services.bill_totals import recompute_bill_totals
+
+
+class Command(BaseCommand):
+    help = "Tính lại toàn bộ BillTotals (dùng khi triển khai lần đầu hoặc sau khi sửa dữ liệu thủ công)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer", type=int, action="append", dest="customers",
+                            help="Chỉ tính lại cho customer_id này (có thể lặp lại).")
+        parser.add_argument("--batch-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        customer_ids = options.get("customers")
+        if not customer_ids:
+            customer_ids = list(Bill.objects
+                                .filter(customer_id__isnull=False)
+                                .values_list("customer_id", flat=True)
+                                .distinct()
+                                .order_by("customer_id"))
+
+        batch_size = options["batch_size"]
+        updated = 0
+        for i in range(0, len(customer_ids), batch_size):
+            updated += recompute_bill_totals(customer_ids[i:i + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f"Đã cập nhật BillTotals cho {updated} bill."))
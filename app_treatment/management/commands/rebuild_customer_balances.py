@@ -0,0 +1,58 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app_customer.models import Customer
+from app_treatment.models import CustomerBalance
+
+FIELDS = ("total_billed", "total_paid", "open_ar_count", "last_payment_at")
+EMPTY = {"total_billed": Decimal(0), "total_paid": Decimal(0), "open_ar_count": 0, "last_payment_at": None}
+
+
+class Command(BaseCommand):
+    help = "Tính lại CustomerBalance từ BillTotals / ARItem / Bill / PaymentHistory và đối chiếu với số đang lưu."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verify-only", action="store_true",
+                            help="Chỉ đối chiếu, không ghi; lỗi nếu có chênh lệch.")
+        parser.add_argument("--customer", type=int, action="append", dest="customers")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        verify_only = options["verify_only"]
+        customer_ids = options.get("customers") or list(
+            Customer.objects.order_by("id").values_list("id", flat=True)
+        )
+
+        batch_size = options["batch_size"]
+        mismatched = []
+        for i in range(0, len(customer_ids), batch_size):
+            batch = customer_ids[i:i + batch_size]
+            expected = CustomerBalance.compute(batch)
+            stored = {
+                row["customer_id"]: row
+                for row in CustomerBalance.objects.filter(customer_id__in=batch).values("customer_id", *FIELDS)
+            }
+            diff = []
+            for cid in batch:
+                exp = expected.get(cid, EMPTY)
+                cur = stored.get(cid)
+                if cur is None:
+                    if exp != EMPTY:
+                        diff.append(cid)
+                elif any(cur[f] != exp[f] for f in FIELDS):
+                    diff.append(cid)
+            mismatched.extend(diff)
+            if diff and not verify_only:
+                CustomerBalance.rebuild(diff)
+
+        for cid in mismatched[:50]:
+            self.stdout.write(f"  customer #{cid}: lệch số dư")
+        if verify_only:
+            if mismatched:
+                raise CommandError(f"{len(mismatched)} khách hàng lệch số dư.")
+            self.stdout.write(self.style.SUCCESS("Số dư khớp hoàn toàn."))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Đã đối chiếu {len(customer_ids)} khách hàng, sửa {len(mismatched)} dòng."
+            ))
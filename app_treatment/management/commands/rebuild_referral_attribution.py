@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from app_treatment.services.referral_attribution import rebuild
+
+
+class Command(BaseCommand):
+    help = ("Tính lại ReferralAttribution (khách / hoá đơn / doanh thu theo CTV, actor và ngày) từ Referral, "
+            "ARItem và PaymentHistory (backfill khi triển khai hoặc sau khi sửa dữ liệu thủ công).")
+
+    def handle(self, *args, **options):
+        rows = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Đã ghi {rows} dòng ReferralAttribution."))
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app_treatment.services.technique_daily import rebuild
+
+
+def _parse_date(value: str):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError(f"Ngày không hợp lệ: {value} (định dạng YYYY-MM-DD)")
+
+
+class Command(BaseCommand):
+    help = ("Tính lại TechniqueExecutionDaily từ SessionTechicalSetting (backfill khi triển khai "
+            "hoặc sau khi sửa dữ liệu buổi / lịch hẹn bằng update()).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start", help="Từ ngày (YYYY-MM-DD). Mặc định: từ đầu.")
+        parser.add_argument("--to", dest="end", help="Đến ngày (YYYY-MM-DD). Mặc định: hết dữ liệu.")
+
+    def handle(self, *args, **options):
+        start = _parse_date(options["start"]) if options.get("start") else None
+        end = _parse_date(options["end"]) if options.get("end") else None
+        if start and end and start > end:
+            raise CommandError("--from phải <= --to")
+        rows = rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(f"Đã ghi {rows} dòng TechniqueExecutionDaily."))
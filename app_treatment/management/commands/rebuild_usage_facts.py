@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from app_treatment.models import TreatmentRequest
+from app_treatment.services.usage_facts import refresh_usage_facts
+
+
+class Command(BaseCommand):
+    help = "Tính lại TreatmentUsageFact cho mọi phác đồ (backfill khi triển khai / sau khi sửa dữ liệu thủ công)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer", type=int, action="append", dest="customers",
+                            help="Chỉ tính lại phác đồ của customer_id này (có thể lặp lại).")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        qs = TreatmentRequest.objects.order_by("id")
+        if options.get("customers"):
+            qs = qs.filter(customer_id__in=options["customers"])
+        tr_ids = list(qs.values_list("id", flat=True))
+
+        batch_size = options["batch_size"]
+        updated = 0
+        for i in range(0, len(tr_ids), batch_size):
+            updated += refresh_usage_facts(tr_ids[i:i + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f"Đã cập nhật TreatmentUsageFact cho {updated} phác đồ."))
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:18
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillTotals',
+            fields=[
+                ('bill', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='totals', serialize=False, to='app_treatment.bill')),
+                ('total_service_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('total_product_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('customer_total_billed', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('customer_total_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('amount_remaining', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
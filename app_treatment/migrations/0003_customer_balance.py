@@ -0,0 +1,39 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:21
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0002_initial'),
+        ('app_treatment', '0002_bill_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerBalance',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='app_customer.customer')),
+                ('total_billed', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('open_ar_count', models.IntegerField(default=0)),
+                ('last_payment_at', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='billtotals',
+            name='amount_remaining',
+        ),
+        migrations.RemoveField(
+            model_name='billtotals',
+            name='customer_total_billed',
+        ),
+        migrations.RemoveField(
+            model_name='billtotals',
+            name='customer_total_paid',
+        ),
+    ]
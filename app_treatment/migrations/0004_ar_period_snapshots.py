@@ -0,0 +1,68 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:26
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0002_initial'),
+        ('app_treatment', '0003_customer_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ARPeriodClose',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(unique=True)),
+                ('customer_count', models.PositiveIntegerField(default=0)),
+                ('closed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-period'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ARPeriodSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(help_text='Ngày 1 của tháng')),
+                ('opening', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('debit', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('credit', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('closing', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='aritem',
+            index=models.Index(fields=['customer', 'created'], name='app_treatme_custome_04e9a7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aritem',
+            index=models.Index(fields=['created'], name='app_treatme_created_d3229e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenthistory',
+            index=models.Index(fields=['customer', 'created'], name='app_treatme_custome_5225a8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenthistory',
+            index=models.Index(fields=['created'], name='app_treatme_created_584886_idx'),
+        ),
+        migrations.AddField(
+            model_name='arperiodsnapshot',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ar_snapshots', to='app_customer.customer'),
+        ),
+        migrations.AddIndex(
+            model_name='arperiodsnapshot',
+            index=models.Index(fields=['period', 'customer'], name='app_treatme_period_14e9d6_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='arperiodsnapshot',
+            constraint=models.UniqueConstraint(fields=('customer', 'period'), name='uniq_ar_snapshot_customer_period'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:34
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0004_ar_period_snapshots'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='paymenthistory',
+            name='uniq_one_payment_per_bill',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:40
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_customer', '0002_initial'),
+        ('app_treatment', '0005_payment_allocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreatmentUsageFact',
+            fields=[
+                ('treatment_request', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='usage_fact', serialize=False, to='app_treatment.treatmentrequest')),
+                ('tr_created_at', models.DateTimeField()),
+                ('package_price', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('final_price', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('total_sessions', models.PositiveIntegerField(default=0)),
+                ('used_sessions', models.PositiveIntegerField(default=0)),
+                ('paid_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('used_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_facts', to='app_customer.customer')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='treatmentusagefact',
+            index=models.Index(fields=['tr_created_at', 'customer'], name='app_treatme_tr_crea_a109c8_idx'),
+        ),
+    ]
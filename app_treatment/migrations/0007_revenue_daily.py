@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:45
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0006_treatment_usage_fact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('paid_method', models.CharField(choices=[('cash', 'Tiền mặt'), ('transfer', 'Chuyển khoản')], max_length=25)),
+                ('source_ct_id', models.PositiveIntegerField(default=0)),
+                ('lead_source_id', models.PositiveIntegerField(default=0)),
+                ('ref_type', models.CharField(default='unknown', max_length=20)),
+                ('ref_hr_id', models.PositiveIntegerField(default=0)),
+                ('ref_actor_id', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('payment_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='revenuedaily',
+            index=models.Index(fields=['ref_hr_id', 'day'], name='app_treatme_ref_hr__0e2fb8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='revenuedaily',
+            index=models.Index(fields=['ref_actor_id', 'day'], name='app_treatme_ref_act_ba81e4_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='revenuedaily',
+            constraint=models.UniqueConstraint(fields=('day', 'paid_method', 'source_ct_id', 'lead_source_id', 'ref_type', 'ref_hr_id', 'ref_actor_id'), name='uniq_revenue_daily_dims'),
+        ),
+    ]
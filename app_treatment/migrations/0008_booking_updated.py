@@ -0,0 +1,22 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0007_revenue_daily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['receiving_day', 'set_date'], name='app_treatme_receivi_a3bc0a_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0008_booking_updated'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='aritem',
+            name='app_treatme_created_d3229e_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='paymenthistory',
+            name='app_treatme_created_584886_idx',
+        ),
+        migrations.AddIndex(
+            model_name='aritem',
+            index=models.Index(fields=['created', 'id'], name='app_treatme_created_ea92f6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['created', 'id'], name='app_treatme_created_d16521_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['created', 'id'], name='app_treatme_created_3371c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenthistory',
+            index=models.Index(fields=['created', 'id'], name='app_treatme_created_b4812f_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:13
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0009_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TechniqueExecutionDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('expert_id', models.PositiveIntegerField()),
+                ('ttype', models.CharField(default='', max_length=20)),
+                ('customer_id', models.PositiveIntegerField(default=0)),
+                ('techical_setting_id', models.PositiveIntegerField()),
+                ('execution_count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='techniqueexecutiondaily',
+            index=models.Index(fields=['day', 'expert_id'], name='app_treatme_day_6ab771_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='techniqueexecutiondaily',
+            index=models.Index(fields=['techical_setting_id'], name='app_treatme_techica_6fe2c8_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='techniqueexecutiondaily',
+            constraint=models.UniqueConstraint(fields=('expert_id', 'day', 'ttype', 'customer_id', 'techical_setting_id'), name='uniq_technique_execution_daily'),
+        ),
+    ]
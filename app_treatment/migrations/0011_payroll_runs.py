@@ -0,0 +1,70 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:18
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app_treatment', '0010_technique_execution_daily'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayrollRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(unique=True)),
+                ('line_count', models.PositiveIntegerField(default=0)),
+                ('total_salary', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('closed_at', models.DateTimeField(auto_now=True)),
+                ('closed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-period'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PayrollRunPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('techical_setting_id', models.PositiveIntegerField()),
+                ('ttype', models.CharField(default='', max_length=20)),
+                ('price', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='app_treatment.payrollrun')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PayrollLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hr_id', models.PositiveIntegerField()),
+                ('hr_type', models.CharField(default='employee', max_length=20)),
+                ('department_id', models.PositiveIntegerField(default=0)),
+                ('employee_code', models.CharField(blank=True, max_length=20, null=True)),
+                ('full_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('email', models.CharField(blank=True, max_length=254, null=True)),
+                ('position', models.CharField(blank=True, max_length=255, null=True)),
+                ('contract', models.CharField(blank=True, max_length=50, null=True)),
+                ('coefficient', models.FloatField(default=1.0)),
+                ('count_tlcb', models.IntegerField(default=0)),
+                ('count_tlds', models.IntegerField(default=0)),
+                ('total_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('salary', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='app_treatment.payrollrun')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='payrollrunprice',
+            constraint=models.UniqueConstraint(fields=('run', 'techical_setting_id'), name='uniq_payroll_price_run_ts'),
+        ),
+        migrations.AddConstraint(
+            model_name='payrollline',
+            constraint=models.UniqueConstraint(fields=('run', 'hr_id'), name='uniq_payroll_line_run_hr'),
+        ),
+    ]
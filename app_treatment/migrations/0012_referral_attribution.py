@@ -0,0 +1,30 @@
+# Generated by Django 4.1.7 on 2026-10-18 20:26
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_treatment', '0011_payroll_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralAttribution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ref_kind', models.CharField(choices=[('hr', 'CTV/HR'), ('actor', 'Actor thuộc LeadSource')], max_length=10)),
+                ('ref_id', models.PositiveIntegerField()),
+                ('day', models.DateField()),
+                ('customers', models.IntegerField(default=0)),
+                ('invoices', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=25)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='referralattribution',
+            constraint=models.UniqueConstraint(fields=('ref_kind', 'ref_id', 'day'), name='uniq_referral_attribution'),
+        ),
+    ]
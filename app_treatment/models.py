@@ -7,7 +7,7 @@ from django.utils import timezone
 from django.contrib.auth.models import User
 from django.db.models import Q, Count, F
 from django.core.exceptions import ValidationError
-from django.db.models.functions import Coalesce
+from django.db.models.functions import Coalesce, Greatest
 from django.db.models import Sum, Value, DecimalField
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -16,23 +16,18 @@ from django.dispatch import receiver
 from typing import Optional, List, Dict, Tuple
 
 from app_customer.models import Customer
-from app_home.models import Department, Discount, Floor, TestService, TimeFrame, TreatmentPackage, Unit, generate_random_code
+from app_home.models import Department, Discount, Floor, TestService, TimeFrame, TreatmentPackage, Unit
 from app_product.models import Product, Service, ServiceTreatmentPackage, TechicalSetting
 from django.db import transaction
 
 from django.conf import settings
 
-from django.utils.crypto import get_random_string
+from app_home.codes import next_code
+
+from app_treatment.services.pricing import price_of
+from app_treatment.services.bill_totals import compute_customer_amounts
+from app_treatment.services.done_status import mark_dirty
 
-def unique_code(model, prefix: str, field: str = "code", length: int = 8) -> str:
-    """
-    Sinh mã duy nhất cho model theo field 'code'.
-    Ví dụ: unique_code(Bill, "BILL_") -> "BILL_AB12CD34"
-    """
-    while True:
-        code = f"{prefix}{get_random_string(length).upper()}"
-        if not model.objects.filter(**{field: code}).exists():
-            return code
 
 class Booking(models.Model):
     BOOKING_TYPE = [
@@ -55,10 +50,31 @@ class Booking(models.Model):
     receiving_day = models.DateField(null=True, blank=True, verbose_name="Ngày tiếp nhận")
     #use when customer want to set a date to come
     set_date = models.TimeField(null=True, blank=True, verbose_name="Giờ hẹn đến")
+    # mốc sửa cuối, dùng làm ETag cho lịch lễ tân (BookingViewSet.calendar)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ ngày lúc load để đổi ngày thì vô hiệu hoá lịch của cả ngày cũ (services.scheduling)
+        instance._loaded_receiving_day = instance.__dict__.get('receiving_day')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # save(update_fields=[...]) vẫn phải ghi mốc `updated`
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'updated' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'updated']
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Booking for {self.customer.name}"
     class Meta:
         app_label = "app_treatment" 
+        indexes = [
+            models.Index(fields=['receiving_day', 'set_date']),
+            models.Index(fields=['created', 'id']),  # keyset pagination (-created, -id)
+        ]
 
 class ExaminationOrder(models.Model):
 
@@ -205,23 +221,12 @@ class DoctorProcess(models.Model):
     def __str__(self):
         return f"DP#{self.id} C{getattr(self.customer,'id',None)} v{self.version} ({'active' if self.is_active else 'archived'})"
 
-    # ====== Tổng tiền thuốc của *bản này*
+    # ====== Tổng tiền thuốc của *bản này* (tính qua services.pricing)
     def total_amount(self):
-        total = sum(
-            (dm.price or 0) * (dm.quantity or 0)
-            for dm in self.diagnosis_medicines.all()
-        )
-        return total
+        return price_of(self).original
 
     def total_after_discount(self):
-        total = self.total_amount()
-        d = getattr(self, "medicine_discount", None)
-        if d:
-            if d.type in ("percentage", "percent"):
-                total = total - (total * d.rate) / 100
-            elif d.type in ("fixed", "amount"):  # 👈 chấp nhận cả 'amount'
-                total = total - d.rate
-        return max(total, 0)
+        return price_of(self).final
 
     # ====== Helper: clone/fork một process mới từ process hiện tại
     @transaction.atomic
@@ -312,36 +317,11 @@ class ServiceAssign(models.Model):
     services_has_paid = models.BooleanField(default=False)
 
     def total_amount(self):
+        """Σ giá gói (ServiceTreatmentPackage) * số lượng của các dòng dịch vụ."""
+        return price_of(self).original
 
-        total = Decimal(0)
-        for diagnosis in self.diagnosis_services.all():
-            service = diagnosis.service
-            treatment_package = getattr(diagnosis, "treatment_package", None)
-
-            if service:
-                if treatment_package:
-                    # Lấy giá theo gói liệu trình
-                    try:
-                        stp = ServiceTreatmentPackage.objects.get(
-                            service=service, treatment_package=treatment_package
-                        )
-                        total += stp.price * diagnosis.quantity
-                    except ServiceTreatmentPackage.DoesNotExist:
-                        total += service.price * diagnosis.quantity  # fallback
-                else:
-                    total += service.price * diagnosis.quantity
-        return total
-
-        
     def total_after_discount(self):
-        total = self.total_amount()
-        if self.service_discount:
-            if self.service_discount.type == 'percentage':
-                discount_value = (total * self.service_discount.rate) / 100
-                return total - discount_value
-            elif self.service_discount.type == 'fixed':
-                return total - self.service_discount.rate
-        return total
+        return price_of(self).final
 
     
     class Meta:
@@ -382,6 +362,24 @@ class Bill(models.Model):
 
     class Meta:
         app_label = "app_treatment"
+        indexes = [
+            models.Index(fields=['created', 'id']),  # keyset pagination (-created, -id)
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ giá trị lúc load để CustomerBalance cộng/trừ chênh lệch khi save
+        instance._balance_snapshot = instance.balance_state()
+        return instance
+
+    def balance_state(self):
+        """(customer_id, paid_ammount) hoặc None nếu có field bị defer."""
+        d = self.__dict__
+        if 'customer_id' not in d or 'paid_ammount' not in d:
+            return None
+        return (d['customer_id'], d['paid_ammount'] or Decimal(0))
+
     def _ensure_customer(self):
         if not self.customer_id:
             return False
@@ -403,12 +401,17 @@ class Bill(models.Model):
         dp = self._get_active_doctor_process()
         return list(dp.service_assign.all()) if dp else []
 
+    def _get_active_amounts(self) -> Dict[str, Decimal]:
+        """Tiền dịch vụ / thuốc theo DoctorProcess đang hiệu lực (tính hàng loạt qua services.pricing)."""
+        if not self._ensure_customer():
+            return {'service': Decimal(0), 'product': Decimal(0)}
+        return compute_customer_amounts([self.customer_id])[self.customer_id]
+
     def get_total_product_amount(self) -> Decimal:
         """
         Tổng tiền thuốc/sản phẩm chỉ theo DoctorProcess đang hiệu lực.
         """
-        dp = self._get_active_doctor_process()
-        return dp.total_after_discount() if dp else Decimal(0)
+        return self._get_active_amounts()['product']
 
     def get_total_service_amount(self) -> Decimal:
         """
@@ -439,17 +442,15 @@ class Bill(models.Model):
         return getattr(dp, "assigned_doctor", None) if dp else None
 
     def get_total_service_amount(self) -> Decimal:
-        total = Decimal(0)
-        for assign in self._get_service_assigns():
-            total += assign.total_after_discount()
-        return total
+        return self._get_active_amounts()['service']
 
 
     def get_total_amount(self) -> Decimal:
         """
         Tổng tiền của BILL HIỆN TẠI (dịch vụ + sản phẩm).
         """
-        return self.get_total_service_amount() + self.get_total_product_amount()
+        amounts = self._get_active_amounts()
+        return amounts['service'] + amounts['product']
 
     def get_total_amount_real(self) -> Decimal:
         return self.get_total_amount()
@@ -465,21 +466,33 @@ class Bill(models.Model):
     # ==============================
     # B. TÍNH THEO TOÀN BỘ KHÁCH HÀNG (theo yêu cầu mới)
     # ==============================
+    def _get_balance(self):
+        """CustomerBalance của khách hàng (đọc mới từ DB, 1 query)."""
+        if not self._ensure_customer():
+            return None
+        return CustomerBalance.objects.filter(customer_id=self.customer_id).first()
+
     def get_customer_total_billed(self) -> Decimal:
         """
-        Tổng số tiền đã xuất hóa đơn cho KHÁCH HÀNG = sum(total của TẤT CẢ bill của khách hàng).
-        Vì total là hàm Python (không lưu trong DB), ta cộng bằng Python.
+        Tổng số tiền đã xuất hóa đơn cho KHÁCH HÀNG = sum(total của TẤT CẢ bill của khách hàng),
+        đọc từ sổ CustomerBalance (O(1)); total từng bill lấy từ BillTotals.
         """
-        total = Decimal(0)
-        # Tránh N+1 ở phần doctor_process nếu cần, nhưng ở đây khó prefetch vì total là hàm tuỳ logic.
-        for b in Bill.objects.filter(customer=self.customer).iterator():
-            total += b.get_total_amount_real()
-        return total
+        balance = self._get_balance()
+        if balance is not None:
+            return balance.total_billed
+        if not self._ensure_customer():
+            return Decimal(0)
+        agg = BillTotals.objects.filter(bill__customer_id=self.customer_id).aggregate(s=Sum('total_amount'))
+        return agg['s'] or Decimal(0)
 
     def get_customer_total_paid(self) -> Decimal:
         """
-        Tổng số tiền KHÁCH HÀNG đã thanh toán = sum(paid_ammount của tất cả bill).
+        Tổng số tiền KHÁCH HÀNG đã thanh toán = sum(paid_ammount của tất cả bill),
+        đọc từ sổ CustomerBalance (O(1)).
         """
+        balance = self._get_balance()
+        if balance is not None:
+            return balance.total_paid
         agg = Bill.objects.filter(customer=self.customer).aggregate(s=Sum('paid_ammount'))
         return agg['s'] or Decimal(0)
 
@@ -489,6 +502,9 @@ class Bill(models.Model):
         = Tổng tiền tất cả hóa đơn - Tổng đã thanh toán tất cả hóa đơn.
         Ví dụ của bạn: 1.000.000 - 200.000 = 800.000.
         """
+        balance = self._get_balance()
+        if balance is not None:
+            return balance.amount_remaining
         remaining = self.get_customer_total_billed() - self.get_customer_total_paid()
         return remaining if remaining > 0 else Decimal(0)
 
@@ -574,23 +590,46 @@ class Bill(models.Model):
         """
         ⚠️ ĐÃ ĐỔI NGỮ NGHĨA: fully_paid = KHÁCH HÀNG không còn nợ (tổng mọi bill đã được thanh toán hết).
         Nếu bạn muốn 'fully_paid' chỉ phản ánh RIÊNG bill này, đổi lại về: self.bill_amount_remaining() <= 0
+        Số dư đọc từ CustomerBalance (O(1)), cộng thêm phần paid_ammount của chính bill này chưa ghi sổ.
         """
-        self.fully_paid = self.amount_remaining() <= Decimal(0)
+        balance = self._get_balance()
+        billed = balance.total_billed if balance else self.get_customer_total_billed()
+        paid = balance.total_paid if balance else self.get_customer_total_paid()
+        old = getattr(self, '_balance_snapshot', None)
+        already_counted = old[1] if old and old[0] == self.customer_id else Decimal(0)
+        paid += (self.paid_ammount or Decimal(0)) - already_counted
+        self.fully_paid = billed - paid <= Decimal(0)
 
     def save(self, *args, **kwargs):
         self.clean()
         if not self.code:
-            while True:
-                new_code = f"BILL_{generate_random_code()}"
-                if not Bill.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("BILL_")
         super().save(*args, **kwargs)
         
+class BillTotals(models.Model):
+    """
+    Số tiền của Bill được lưu sẵn (denormalized) để danh sách Bill đọc thẳng từ DB.
+    Được tính lại trong cùng transaction khi thuốc / dịch vụ / chiết khấu thay đổi
+    (xem app_treatment.services.bill_totals và signals).
+    Số liệu cấp khách hàng (đã xuất / đã trả / còn nợ) nằm ở CustomerBalance.
+    """
+    bill = models.OneToOneField(Bill, on_delete=models.CASCADE, primary_key=True, related_name="totals")
+    total_service_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    total_product_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    total_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "app_treatment"
+
+    def __str__(self):
+        return f"Totals of {self.bill_id}: {self.total_amount}"
+
 class PaymentHistory(models.Model):
     """
-    Mỗi PaymentHistory = 1 đợt thanh toán.
-    Sau khi lưu, hệ thống phân bổ tiền vào các ARItem (công nợ) và tạo Bill cho đợt thanh toán này.
+    Mỗi PaymentHistory = 1 khoản thu cho 1 ARItem.
+    Tạo lẻ: save() cấn trừ vào ARItem và tạo Bill riêng cho khoản thu này.
+    Thu gộp nhiều ARItem: services.payments.allocate_payment (1 Bill, nhiều dòng).
     """
     bill = models.ForeignKey('app_treatment.Bill', related_name='payments',
                              on_delete=models.CASCADE, null=True, blank=True)
@@ -606,8 +645,10 @@ class PaymentHistory(models.Model):
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        constraints = [
-            models.UniqueConstraint(fields=['bill'], name='uniq_one_payment_per_bill'),
+        # 1 Bill (phiếu thu) có thể gồm nhiều dòng PaymentHistory khi thu gộp nhiều ARItem
+        indexes = [
+            models.Index(fields=['customer', 'created']),
+            models.Index(fields=['created', 'id']),  # keyset pagination (-created, -id)
         ]
 
     def clean(self):
@@ -618,7 +659,7 @@ class PaymentHistory(models.Model):
         return f"Payment {self.code or ''} {self.paid_amount} for AR#{self.ar_item_id}"
 
     def _gen_code(self, prefix: str = "PH_") -> str:
-        return unique_code(PaymentHistory, prefix)
+        return next_code(prefix)
 
     @transaction.atomic
     def save(self, *args, **kwargs):
@@ -658,9 +699,6 @@ class PaymentHistory(models.Model):
                 customer=self.customer,
                 paid_ammount=self.paid_amount,   # số tiền của đợt này
             )
-            if not getattr(bill, 'code', None):
-                bill.code = unique_code(Bill, "BILL_")
-                bill.save(update_fields=['code'])
             self.bill = bill
             super().save(update_fields=['bill'])
         else:
@@ -709,31 +747,11 @@ class TreatmentRequest(models.Model):
     
     def package_price_original(self) -> Decimal:
         """Giá gốc (không giảm)"""
-        if self.service_id:
-            if self.treatment_package_id:
-                stp = ServiceTreatmentPackage.objects.filter(
-                    service=self.service,
-                    treatment_package=self.treatment_package
-                ).first()
-                if stp and getattr(stp, "price", None) is not None:
-                    return stp.price
-            return getattr(self.service, "price", Decimal(0)) or Decimal(0)
-        return Decimal(0)
+        return price_of(self).original
     
     def package_price(self) -> Decimal:
         """Giá sau khi áp dụng discount"""
-        original = self.package_price_original()
-        
-        if not self.discount:
-            return original
-        
-        if self.discount.type in ('percentage', 'percent'):
-            discount_amount = (original * self.discount.rate) / Decimal('100')
-            return original - discount_amount
-        elif self.discount.type in ('fixed', 'amount'):
-            return max(Decimal('0'), original - self.discount.rate)
-        
-        return original
+        return price_of(self).final
     
     def recalc_ar(self):
         """
@@ -743,7 +761,7 @@ class TreatmentRequest(models.Model):
         - Nếu amount = 0: xoá ARItem (nếu chưa phát sinh thanh toán).
         """
 
-        amount = self.package_price() or Decimal('0')
+        amount = price_of(self).final or Decimal('0')
         ct = ContentType.objects.get_for_model(TreatmentRequest)
 
         qs = ARItem.objects.select_for_update().filter(
@@ -814,11 +832,7 @@ class TreatmentRequest(models.Model):
     def save(self, *args, **kwargs):
         self.clean()
         if not self.code:
-            while True:
-                new_code = f"TR_{generate_random_code()}"
-                if not TreatmentRequest.objects.filter(code=new_code).exists():
-                    self.code = new_code
-                    break
+            self.code = next_code("TR_")
         super().save(*args, **kwargs)
     def get_total_price_is_done_treatment_sessions(self):
 
@@ -844,7 +858,7 @@ def create_ar_on_treatment_created(sender, instance: 'TreatmentRequest', created
     if not instance.customer_id:
         return
     
-    amount = instance.package_price() or Decimal('0.00')
+    amount = price_of(instance).final or Decimal('0.00')
     if amount <= 0:
         return
     
@@ -867,6 +881,13 @@ class TreatmentSession(models.Model):
     index_no = models.PositiveIntegerField(default=1, db_index=True, verbose_name="Số thứ tự buổi")
     booking = models.OneToOneField(Booking, on_delete=models.SET_NULL,
                                    null=True, blank=True, verbose_name="Lịch hẹn")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ lịch lúc load: đổi lịch thì lượt kỹ thuật của buổi đổi ngày tính lương (services.technique_daily)
+        instance._loaded_booking_id = instance.__dict__.get('booking_id')
+        return instance
     
     def compute_is_done(self) -> bool:
         """
@@ -916,6 +937,23 @@ class SessionTechicalSetting(models.Model):
     duration_minutes = models.PositiveIntegerField(default=10, verbose_name="Thời gian (phút)")
     room = models.CharField(max_length=100, null=True, blank=True, verbose_name="Phòng")
     has_come = models.BooleanField(default=False, db_index=True, verbose_name="Trạng thái")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ has_come lúc load để TreatmentUsageFact chỉ tính lại khi trạng thái đổi
+        instance._loaded_has_come = instance.__dict__.get('has_come')
+        # và các field quyết định ô TechniqueExecutionDaily (services.technique_daily)
+        instance._loaded_execution = instance.execution_state()
+        return instance
+
+    def execution_state(self):
+        """(has_come, expert_id, session_id, techical_setting_id) hoặc None nếu có field bị defer."""
+        d = self.__dict__
+        fields = ('has_come', 'expert_id', 'session_id', 'techical_setting_id')
+        if any(f not in d for f in fields):
+            return None
+        return tuple(d[f] for f in fields)
     
     def clean(self):
         # đảm bảo chỉ chọn CTV
@@ -933,13 +971,14 @@ class SessionTechicalSetting(models.Model):
     
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        # bất kỳ thay đổi nào ở item cũng có thể ảnh hưởng đến is_done
-        self.session.refresh_done_status(commit=True)
+        # bất kỳ thay đổi nào ở item cũng có thể ảnh hưởng đến is_done (buổi -> phác đồ -> khách);
+        # gom theo transaction, tính 1 lần khi commit (services.done_status)
+        mark_dirty(sessions=[self.session_id])
 
     def delete(self, *args, **kwargs):
-        session = self.session
+        session_id = self.session_id
         super().delete(*args, **kwargs)
-        session.refresh_done_status(commit=True)
+        mark_dirty(sessions=[session_id])
     
     def __str__(self):
         return f"{self.session} - {self.techical_setting}"
@@ -994,7 +1033,25 @@ class ARItem(models.Model):
     status = models.CharField(max_length=10, choices=STATUS, default='open')
 
     class Meta:
-        indexes = [models.Index(fields=['customer', 'status'])]
+        indexes = [
+            models.Index(fields=['customer', 'status']),
+            models.Index(fields=['customer', 'created']),
+            models.Index(fields=['created', 'id']),  # keyset pagination (-created, -id)
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Giữ giá trị lúc load để CustomerBalance cộng/trừ chênh lệch khi save
+        instance._balance_snapshot = instance.balance_state()
+        return instance
+
+    def balance_state(self):
+        """(customer_id, is_open) hoặc None nếu có field bị defer."""
+        d = self.__dict__
+        if not all(k in d for k in ('customer_id', 'status')):
+            return None
+        return (d['customer_id'], d['status'] != 'closed')
 
     @property
     def amount_remaining(self) -> Decimal:
@@ -1018,3 +1075,349 @@ class ARItem(models.Model):
             self.status = 'open'
         self.save(update_fields=['amount_paid', 'status'])
         return pay_amount - can_apply
+
+
+class CustomerBalance(models.Model):
+    """
+    Sổ số dư công nợ theo khách hàng (1 dòng / khách):
+    - total_billed: Σ BillTotals.total_amount (tổng tiền mọi bill của khách)
+    - total_paid: Σ Bill.paid_ammount
+    - open_ar_count: số ARItem chưa 'closed'
+    - last_payment_at: lần PaymentHistory gần nhất
+    total_billed được ghi lại mỗi khi BillTotals của khách được tính lại (refresh_billed);
+    các cột còn lại cộng dồn bằng F() trong signals khi ARItem / Bill / PaymentHistory thay đổi.
+    `manage.py rebuild_customer_balances` tính lại & đối chiếu từ đầu.
+    """
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name="balance")
+    total_billed = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    total_paid = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    open_ar_count = models.IntegerField(default=0)
+    last_payment_at = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "app_treatment"
+
+    def __str__(self):
+        return f"Balance C{self.customer_id}: {self.total_billed} / {self.total_paid}"
+
+    @property
+    def amount_remaining(self) -> Decimal:
+        remaining = (self.total_billed or Decimal(0)) - (self.total_paid or Decimal(0))
+        return remaining if remaining > 0 else Decimal(0)
+
+    @classmethod
+    def apply_delta(cls, customer_id, *, paid=Decimal(0), open_items=0, payment_at=None, create=True):
+        """
+        Cộng dồn nguyên tử (UPDATE ... SET x = x + delta).
+        create=False khi xoá: không tạo lại dòng cho khách hàng đang bị xoá (cascade).
+        """
+        if not customer_id or not (paid or open_items or payment_at):
+            return
+        if create:
+            cls.objects.get_or_create(customer_id=customer_id)
+        updates = {"updated": timezone.now()}
+        if paid:
+            updates["total_paid"] = F("total_paid") + paid
+        if open_items:
+            updates["open_ar_count"] = F("open_ar_count") + open_items
+        if payment_at:
+            at = Value(payment_at, output_field=models.DateTimeField())
+            updates["last_payment_at"] = Greatest(Coalesce(F("last_payment_at"), at), at)
+        cls.objects.filter(customer_id=customer_id).update(**updates)
+
+    @classmethod
+    def refresh_billed(cls, customer_ids, create=True) -> None:
+        """
+        Ghi lại total_billed = Σ BillTotals.total_amount cho các khách hàng truyền vào
+        (sau khi BillTotals được tính lại, bill bị xoá hoặc chuyển khách).
+        """
+        customer_ids = {cid for cid in customer_ids if cid}
+        if not customer_ids:
+            return
+        billed = dict(BillTotals.objects
+                      .filter(bill__customer_id__in=customer_ids)
+                      .values_list('bill__customer_id')
+                      .annotate(s=Sum('total_amount')))
+        now = timezone.now()
+        for cid in customer_ids:
+            if create:
+                cls.objects.get_or_create(customer_id=cid)
+            cls.objects.filter(customer_id=cid).update(total_billed=billed.get(cid) or Decimal(0), updated=now)
+
+    @classmethod
+    def refresh_last_payment(cls, customer_id) -> None:
+        """Tính lại last_payment_at từ PaymentHistory còn lại (sau khi xoá khoản thu)."""
+        if not customer_id:
+            return
+        last = PaymentHistory.objects.filter(customer_id=customer_id).aggregate(m=models.Max("created"))["m"]
+        cls.objects.filter(customer_id=customer_id).update(last_payment_at=last, updated=timezone.now())
+
+    @classmethod
+    def compute(cls, customer_ids=None) -> Dict[int, Dict]:
+        """Tính số dư từ đầu bằng aggregate (dùng cho rebuild / verify)."""
+        ar = ARItem.objects.all()
+        bills = Bill.objects.filter(customer_id__isnull=False)
+        totals = BillTotals.objects.filter(bill__customer_id__isnull=False)
+        pays = PaymentHistory.objects.all()
+        if customer_ids is not None:
+            ar = ar.filter(customer_id__in=customer_ids)
+            bills = bills.filter(customer_id__in=customer_ids)
+            totals = totals.filter(bill__customer_id__in=customer_ids)
+            pays = pays.filter(customer_id__in=customer_ids)
+
+        out: Dict[int, Dict] = {}
+
+        def row(cid):
+            return out.setdefault(cid, {
+                "total_billed": Decimal(0), "total_paid": Decimal(0),
+                "open_ar_count": 0, "last_payment_at": None,
+            })
+
+        for r in totals.values("bill__customer_id").annotate(billed=Sum("total_amount")):
+            row(r["bill__customer_id"])["total_billed"] = r["billed"] or Decimal(0)
+        for r in ar.values("customer_id").annotate(n_open=Count("id", filter=~Q(status="closed"))):
+            row(r["customer_id"])["open_ar_count"] = r["n_open"]
+        for r in bills.values("customer_id").annotate(paid=Sum("paid_ammount")):
+            row(r["customer_id"])["total_paid"] = r["paid"] or Decimal(0)
+        for r in pays.values("customer_id").annotate(last=models.Max("created")):
+            row(r["customer_id"])["last_payment_at"] = r["last"]
+        return out
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, customer_ids) -> None:
+        """Ghi đè số dư của các khách hàng truyền vào bằng giá trị tính từ đầu."""
+        customer_ids = [cid for cid in customer_ids if cid]
+        computed = cls.compute(customer_ids)
+        empty = {"total_billed": Decimal(0), "total_paid": Decimal(0), "open_ar_count": 0, "last_payment_at": None}
+        for cid in customer_ids:
+            cls.objects.update_or_create(customer_id=cid, defaults=computed.get(cid, empty))
+
+
+class ARPeriodClose(models.Model):
+    """Đánh dấu 1 tháng công nợ đã khoá sổ (period = ngày 1 của tháng)."""
+    period = models.DateField(unique=True)
+    customer_count = models.PositiveIntegerField(default=0)
+    closed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "app_treatment"
+        ordering = ["-period"]
+
+    def __str__(self):
+        return f"AR closed {self.period:%Y-%m}"
+
+
+class ARPeriodSnapshot(models.Model):
+    """
+    Số dư công nợ theo khách hàng / tháng, ghi khi khoá sổ (`manage.py close_ar_periods`).
+    Chỉ có dòng cho khách có số dư đầu kỳ hoặc phát sinh trong tháng khác 0,
+    nên khách còn dư nợ luôn có dòng ở mọi tháng đã khoá.
+    """
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="ar_snapshots")
+    period = models.DateField(help_text="Ngày 1 của tháng")
+    opening = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    debit = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    credit = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    closing = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(fields=["customer", "period"], name="uniq_ar_snapshot_customer_period"),
+        ]
+        indexes = [models.Index(fields=["period", "customer"])]
+
+    def __str__(self):
+        return f"AR C{self.customer_id} {self.period:%Y-%m}: {self.closing}"
+
+
+class TreatmentUsageFact(models.Model):
+    """
+    Số liệu sử dụng của 1 phác đồ (TreatmentRequest) cho báo cáo doanh thu chưa thực hiện:
+    giá gói, số buổi, số buổi đã phát sinh, đã thanh toán, tiền đã sử dụng.
+    Tính lại (services.usage_facts) khi kỹ thuật đổi has_come, có thanh toán,
+    hoặc phác đồ / chiết khấu / gói / bảng giá thay đổi; `manage.py rebuild_usage_facts` để backfill.
+    """
+    treatment_request = models.OneToOneField(TreatmentRequest, on_delete=models.CASCADE, primary_key=True,
+                                             related_name="usage_fact")
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="usage_facts")
+    tr_created_at = models.DateTimeField()
+    package_price = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    final_price = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    total_sessions = models.PositiveIntegerField(default=0)
+    used_sessions = models.PositiveIntegerField(default=0)
+    paid_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    used_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "app_treatment"
+        indexes = [
+            models.Index(fields=['tr_created_at', 'customer']),
+        ]
+
+    def __str__(self):
+        return f"Usage TR#{self.treatment_request_id}: {self.used_sessions}/{self.total_sessions}"
+
+
+class TechniqueExecutionDaily(models.Model):
+    """
+    Lượt kỹ thuật đã thực hiện (SessionTechicalSetting has_come=True, có expert) gộp theo
+    chuyên gia / ngày / loại kỹ thuật (+ khách, kỹ thuật để xem chi tiết) — nguồn của bảng lương hiệu suất.
+    Ngày = Booking.receiving_day của buổi, buổi chưa có lịch thì ngày tạo phác đồ.
+    Tính lại theo ô (expert, ngày) khi commit (services.technique_daily); `manage.py rebuild_technique_daily` để backfill.
+    """
+    day = models.DateField()
+    expert_id = models.PositiveIntegerField()                   # HrUserProfile
+    ttype = models.CharField(max_length=20, default='')         # TechicalSetting.type (TLCB / TLDS)
+    customer_id = models.PositiveIntegerField(default=0)
+    techical_setting_id = models.PositiveIntegerField()
+    execution_count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['expert_id', 'day', 'ttype', 'customer_id', 'techical_setting_id'],
+                name='uniq_technique_execution_daily',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'expert_id']),
+            models.Index(fields=['techical_setting_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.day} expert={self.expert_id} {self.ttype}: {self.execution_count}"
+
+
+class PayrollRun(models.Model):
+    """
+    Kỳ lương hiệu suất đã chốt (period = ngày 1 của tháng), ghi khi khoá kỳ
+    (services.payroll_runs / `manage.py close_payroll_runs` / POST v1/payroll/close/).
+    Bảng lương của kỳ đã chốt đọc từ PayrollLine, không tính lại theo giá / hệ số hiện tại.
+    """
+    period = models.DateField(unique=True)
+    line_count = models.PositiveIntegerField(default=0)
+    total_salary = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    closed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    closed_at = models.DateTimeField(auto_now_add=True)
+    # lần chốt lại (recompute) gần nhất; người / lúc chốt lần đầu giữ nguyên ở closed_by / closed_at
+    recomputed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    recomputed_at = models.DateTimeField(null=True, blank=True)
+    recompute_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        app_label = "app_treatment"
+        ordering = ["-period"]
+
+    def __str__(self):
+        return f"Payroll closed {self.period:%Y-%m}"
+
+
+class PayrollLine(models.Model):
+    """
+    1 dòng bảng lương của kỳ đã chốt: thông tin nhân sự, hệ số và số liệu tại thời điểm chốt.
+    Lưu sẵn mã / tên / email / phòng ban để lọc & tìm kiếm kỳ cũ chỉ trên bảng này.
+    """
+    run = models.ForeignKey(PayrollRun, on_delete=models.CASCADE, related_name="lines")
+    hr_id = models.PositiveIntegerField()                       # HrUserProfile
+    hr_type = models.CharField(max_length=20, default='employee')
+    department_id = models.PositiveIntegerField(default=0)
+    employee_code = models.CharField(max_length=20, null=True, blank=True)
+    full_name = models.CharField(max_length=255, null=True, blank=True)
+    email = models.CharField(max_length=254, null=True, blank=True)
+    position = models.CharField(max_length=255, null=True, blank=True)
+    contract = models.CharField(max_length=50, null=True, blank=True)
+    coefficient = models.FloatField(default=1.0)
+    count_tlcb = models.IntegerField(default=0)
+    count_tlds = models.IntegerField(default=0)
+    total_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    salary = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(fields=["run", "hr_id"], name="uniq_payroll_line_run_hr"),
+        ]
+
+    def __str__(self):
+        return f"{self.run.period:%Y-%m} HR#{self.hr_id}: {self.salary}"
+
+
+class PayrollRunPrice(models.Model):
+    """Giá kỹ thuật đã dùng khi chốt kỳ lương (chỉ các kỹ thuật có lượt thực hiện trong kỳ)."""
+    run = models.ForeignKey(PayrollRun, on_delete=models.CASCADE, related_name="prices")
+    techical_setting_id = models.PositiveIntegerField()
+    ttype = models.CharField(max_length=20, default='')
+    price = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(fields=["run", "techical_setting_id"], name="uniq_payroll_price_run_ts"),
+        ]
+
+
+class RevenueDaily(models.Model):
+    """
+    Doanh thu thực thu (PaymentHistory) gộp theo ngày và các chiều báo cáo.
+    Các chiều id dùng 0 = không có (không dùng NULL để unique key gom đúng dòng trên MySQL).
+    Cộng dồn khi có thanh toán; chuyển dòng khi Referral của khách đổi
+    (services.revenue_daily); `manage.py rebuild_revenue_daily` để backfill.
+    """
+    day = models.DateField()
+    paid_method = models.CharField(max_length=25, choices=Bill.PAID_METHOD)
+    source_ct_id = models.PositiveIntegerField(default=0)       # content_type của ARItem (phác đồ / đơn thuốc ...)
+    lead_source_id = models.PositiveIntegerField(default=0)     # LeadSource của actor giới thiệu
+    ref_type = models.CharField(max_length=20, default='unknown')
+    ref_hr_id = models.PositiveIntegerField(default=0)
+    ref_actor_id = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+    payment_count = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'paid_method', 'source_ct_id', 'lead_source_id', 'ref_type', 'ref_hr_id', 'ref_actor_id'],
+                name='uniq_revenue_daily_dims',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['ref_hr_id', 'day']),
+            models.Index(fields=['ref_actor_id', 'day']),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.paid_method}: {self.amount}"
+
+
+class ReferralAttribution(models.Model):
+    """
+    Kết quả giới thiệu theo người giới thiệu (CTV = HrUserProfile / actor LeadSource) và ngày:
+    số khách được giới thiệu (ngày tạo Referral), số hoá đơn ARItem và doanh thu thực thu của các khách đó.
+    Cộng dồn khi có ARItem / thanh toán, tính lại theo người giới thiệu khi Referral đổi
+    (services.referral_attribution); `manage.py rebuild_referral_attribution` để backfill.
+    """
+    REF_KIND = [('hr', 'CTV/HR'), ('actor', 'Actor thuộc LeadSource')]
+
+    ref_kind = models.CharField(max_length=10, choices=REF_KIND)
+    ref_id = models.PositiveIntegerField()
+    day = models.DateField()
+    customers = models.IntegerField(default=0)
+    invoices = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=25, decimal_places=2, default=Decimal(0))
+
+    class Meta:
+        app_label = "app_treatment"
+        constraints = [
+            models.UniqueConstraint(fields=['ref_kind', 'ref_id', 'day'], name='uniq_referral_attribution'),
+        ]
+
+    def __str__(self):
+        return f"{self.ref_kind}#{self.ref_id} {self.day}: {self.revenue}"
@@ -1,5 +1,5 @@
 from django.shortcuts import get_object_or_404
-from django.db import transaction
+from django.db import connections, transaction
 from rest_framework import serializers
 from app_treatment.models import Bill, Booking, ClinicalExamination, DoctorProcess, DoctorHealthCheck, ExaminationOrder, ExaminationOrderItem, ExpertSessionRecord, ReExamination, ServiceAssign, SessionTechicalSetting, \
     TreatmentRequest, TreatmentSession, diagnosis_medicine, diagnosis_service, PaymentHistory
@@ -9,9 +9,13 @@ from django.db import models
 from django.apps import apps
 from decimal import Decimal
 from django.contrib.contenttypes.models import ContentType
-from app_treatment.models import ARItem, PaymentHistory
+from app_treatment.models import ARItem, PaymentHistory, BillTotals, CustomerBalance
 from django.db import OperationalError
-from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist, ValidationError as DjangoValidationError
+from app_treatment.services.payments import allocate_payment
+from app_treatment.services import done_status, scheduling, technique_daily
+from app_treatment.services.usage_facts import refresh_usage_facts
+from app_treatment.services.user_service_stats import EMPTY as USER_SERVICE_STATS_EMPTY, user_service_stats
 from typing import Optional
 from rest_framework import status
 from rest_framework.response import Response
@@ -26,6 +30,7 @@ from app_treatment.models import SessionTechicalSetting
 User = get_user_model()
 
 from app_home.models import TestService, TreatmentPackage, generate_random_code
+from app_home.codes import next_code
 from app_product.models import Service, TechicalSetting
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -143,6 +148,9 @@ class CustomerGetSerializer(serializers.ModelSerializer):
             return None
 
     def get_examination_histories(self, obj):
+        # ViewSet có thể prefetch sẵn 'booking_set' để tránh 1 query / dòng
+        if "booking_set" in getattr(obj, "_prefetched_objects_cache", {}):
+            return [{"id": b.id, "day": b.receiving_day} for b in obj.booking_set.all()]
         bookings = Booking.objects.filter(customer_id=obj.id).values("id", "receiving_day")
         return [{"id": booking["id"], "day": booking["receiving_day"]} for booking in bookings]
 
@@ -987,6 +995,231 @@ def _normalize_booking_dt(receiving_day, set_date):
                 t_obj = set_date
     return d_obj, t_obj
 
+def _load_techical_settings(session_data):
+    """
+    {techical_setting_id: TechicalSetting} cho các kỹ thuật có gửi techical_setting_id (1 query);
+    id gửi lên mà không tồn tại -> ValidationError. Dòng cũ không gửi id thì giữ kỹ thuật hiện tại.
+    """
+    raw_ids = [t.get("techical_setting_id") for s in session_data for t in s.get("techniques") or []]
+    raw_ids = [v for v in raw_ids if v not in (None, "")]
+
+    def _as_int(v):
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
+
+    found = TechicalSetting.objects.in_bulk({_as_int(v) for v in raw_ids} - {None})
+    out = {}
+    for raw in raw_ids:
+        ts = found.get(_as_int(raw))
+        if ts is None:
+            raise serializers.ValidationError(f"Kỹ thuật ID {raw} không tồn tại.")
+        out[raw] = ts
+    return out
+
+def _bulk_create_bookings(customer, bookings):
+    """
+    Ghi các Booking mới của 1 lần lưu phác đồ. bulk_create khi backend trả id sau INSERT nhiều dòng;
+    không thì (MySQL) tạo từng booking — mỗi lần chỉ vài buổi, và không có cách khớp lại id an toàn
+    khi 2 request tạo phác đồ cùng khách chạy song song.
+    """
+    if not bookings:
+        return
+    if connections[Booking.objects.db].features.can_return_rows_from_bulk_insert:
+        Booking.objects.bulk_create(bookings)
+        return
+    for b in bookings:
+        b.save(force_insert=True)
+
+def _bulk_create_sessions(tr, sessions):
+    """bulk_create TreatmentSession của 1 phác đồ mới; không có id trả về thì khớp lại theo index_no."""
+    if not sessions:
+        return
+    TreatmentSession.objects.bulk_create(sessions)
+    if all(s.pk for s in sessions):
+        return
+    by_index = dict(TreatmentSession.objects.filter(treatment_request=tr).values_list("index_no", "id"))
+    for s in sessions:
+        s.pk = by_index[s.index_no]
+
+def _execution_day(tr, sess):
+    """Ngày tính lương của lượt kỹ thuật (như services.technique_daily): ngày hẹn, chưa có lịch thì ngày tạo phác đồ."""
+    booking = sess.booking  # đã select_related / gán sẵn, không query
+    if booking is not None:
+        return booking.receiving_day
+    return tr.created_at.date() if tr.created_at else None
+
+def _apply_sessions_diff(tr, customer, incoming_sessions, booking_type, remove_missing=False):
+    """
+    Đồng bộ buổi + dòng kỹ thuật của phác đồ theo payload với số query cố định:
+      1) đọc (khoá) toàn bộ buổi, booking, dòng kỹ thuật hiện có + kỹ thuật được tham chiếu
+      2) tính diff trong bộ nhớ: thêm / sửa / xoá
+      3) ghi bằng bulk_create / bulk_update / DELETE ... WHERE id IN
+      4) trạng thái hoàn thành + số liệu sử dụng tính 1 lần
+    Dòng kỹ thuật cũ chỉ sửa các trường có gửi. remove_missing (PUT): buổi / dòng kỹ thuật không có trong
+    payload bị xoá (dòng kỹ thuật chỉ xét ở buổi có gửi 'techniques'); PATCH chỉ thêm / sửa.
+    Không xoá dòng đã thực hiện (has_come=True) — kể cả theo buổi bị xoá — mà trả ValidationError.
+    """
+    # ---- 1) đọc trạng thái hiện tại
+    sessions = {sess.pk: sess for sess in (TreatmentSession.objects
+                                           .select_for_update()
+                                           .select_related("booking")
+                                           .filter(treatment_request=tr))}
+    items = {it.pk: it for it in (SessionTechicalSetting.objects
+                                  .select_for_update()
+                                  .filter(session_id__in=list(sessions)))}
+    tech_map = _load_techical_settings(incoming_sessions)
+    next_index = max((sess.index_no for sess in sessions.values()), default=0) + 1
+    # ô lương (expert, ngày) trước khi sửa: tính lại cùng các ô sau khi sửa
+    execution_cells_before = {(it.expert_id, _execution_day(tr, sessions[it.session_id]))
+                              for it in items.values() if it.has_come and it.expert_id}
+    service_name = tr.service.name if tr.service else ""
+
+    # ---- 2) diff
+    new_bookings, touched_bookings = [], {}
+    new_sessions, changed_sessions, kept_sessions = [], {}, set()
+    new_items, changed_items, kept_items = [], {}, set()
+    item_fields = ("techical_setting_id", "duration_minutes", "room", "has_come", "expert_id")
+
+    for s in incoming_sessions:
+        session_id    = s.get("id")
+        session_note  = s.get("note", None)
+        receiving_day = s.get("receiving_day")
+        set_date      = s.get("set_date")
+
+        if session_id:
+            sess = sessions.get(session_id)
+            if sess is None:
+                raise serializers.ValidationError(f"Buổi id={session_id} không thuộc phác đồ.")
+            kept_sessions.add(sess.pk)
+            if session_note is not None and sess.note != session_note:
+                sess.note = session_note
+                changed_sessions[sess.pk] = sess
+        else:
+            sess = TreatmentSession(treatment_request=tr, note=session_note or f"Buổi {next_index}", index_no=next_index)
+            new_sessions.append(sess)
+            next_index += 1
+
+        # booking
+        if receiving_day is not None or set_date is not None:
+            d_obj, t_obj = _normalize_booking_dt(receiving_day, set_date)
+            if sess.booking_id:
+                bk = sess.booking
+                if receiving_day is not None:
+                    bk.receiving_day = d_obj
+                if set_date is not None:
+                    bk.set_date = t_obj
+                bk.type = booking_type
+                touched_bookings[bk.pk] = bk
+            else:
+                bk = Booking(
+                    customer=customer,
+                    type=booking_type,
+                    note=f"Buổi trị liệu {sess.index_no} - {service_name}",
+                    is_treatment=True,
+                    has_come=False,
+                    receiving_day=d_obj,
+                    set_date=t_obj,
+                )
+                new_bookings.append(bk)
+                sess.booking = bk
+                if sess.pk:
+                    changed_sessions[sess.pk] = sess
+
+        # dòng kỹ thuật
+        if "techniques" not in s:
+            kept_items |= {it.pk for it in items.values() if sess.pk and it.session_id == sess.pk}
+            continue
+        for t in s.get("techniques") or []:
+            item_id    = t.get("id")
+            ts_id      = t.get("techical_setting_id")
+            expert_ids = t.get("expert_ids", [])
+
+            ts = tech_map.get(ts_id) if ts_id else None
+            if ts is not None and getattr(ts, "service_id", None) and tr.service_id and ts.service_id != tr.service_id:
+                raise serializers.ValidationError("Kỹ thuật không thuộc dịch vụ đã chọn.")
+
+            if item_id:
+                item = items.get(item_id)
+                if item is None or not sess.pk or item.session_id != sess.pk:
+                    raise serializers.ValidationError(f"Item id={item_id} không thuộc buổi {sess.pk}.")
+                kept_items.add(item.pk)
+                before = tuple(getattr(item, f) for f in item_fields)
+                if ts is not None:
+                    item.techical_setting = ts
+                if "duration_minutes" in t:
+                    item.duration_minutes = t["duration_minutes"]
+                if "room" in t:
+                    item.room = t["room"]
+                if "has_come" in t:
+                    item.has_come = bool(t["has_come"])
+                if "expert_ids" in t and expert_ids is not None:
+                    item.expert_id = (expert_ids[0] if expert_ids else None)  # cập nhật expert
+                if tuple(getattr(item, f) for f in item_fields) != before:
+                    changed_items[item.pk] = item
+            else:
+                if ts is None:
+                    raise serializers.ValidationError("Kỹ thuật không tồn tại.")
+                new_items.append(SessionTechicalSetting(
+                    session=sess,
+                    techical_setting=ts,
+                    duration_minutes=t.get("duration_minutes", 10),
+                    room=t.get("room"),
+                    has_come=t.get("has_come", False),
+                    expert_id=(expert_ids[0] if expert_ids else None),
+                ))
+
+    removed_sessions = set(sessions) - kept_sessions if remove_missing else set()
+    # dòng kỹ thuật của buổi bị xoá đi theo CASCADE; ở đây chỉ còn dòng bị bỏ khỏi buổi được giữ
+    removed_items = {pk for pk, it in items.items()
+                     if it.session_id in kept_sessions and pk not in kept_items} if remove_missing else set()
+    done_removed = sorted(pk for pk, it in items.items()
+                          if it.has_come and (pk in removed_items or it.session_id in removed_sessions))
+    if done_removed:
+        raise serializers.ValidationError(
+            f"Không thể xoá kỹ thuật đã thực hiện (id={', '.join(map(str, done_removed))}); "
+            f"gửi lại các dòng này hoặc bỏ has_come trước.")
+
+    # ---- 3) ghi
+    if removed_items:
+        SessionTechicalSetting.objects.filter(id__in=removed_items).delete()
+    if removed_sessions:
+        # booking trị liệu chưa đến của buổi bị xoá cũng bỏ theo
+        orphan_bookings = [sessions[pk].booking_id for pk in removed_sessions
+                           if sessions[pk].booking_id and not sessions[pk].booking.has_come]
+        TreatmentSession.objects.filter(id__in=removed_sessions).delete()
+        if orphan_bookings:
+            Booking.objects.filter(id__in=orphan_bookings, is_treatment=True).delete()
+
+    _bulk_create_bookings(customer, new_bookings)
+    if touched_bookings:
+        now = timezone.now()
+        for bk in touched_bookings.values():
+            bk.updated = now
+        Booking.objects.bulk_update(list(touched_bookings.values()), ["receiving_day", "set_date", "type", "updated"])
+    _bulk_create_sessions(tr, new_sessions)
+    if changed_sessions:
+        for sess in changed_sessions.values():
+            sess.booking = sess.booking  # gán lại booking_id cho booking vừa bulk_create
+        TreatmentSession.objects.bulk_update(list(changed_sessions.values()), ["note", "booking"])
+    SessionTechicalSetting.objects.bulk_create(new_items, batch_size=500)
+    if changed_items:
+        SessionTechicalSetting.objects.bulk_update(list(changed_items.values()),
+                                                   ["techical_setting", "duration_minutes", "room", "has_come", "expert"],
+                                                   batch_size=500)
+
+    # ---- 4) bulk_* không gửi signal: tính lại 1 lần
+    done_status.flush(session_ids=kept_sessions | {sess.pk for sess in new_sessions}, request_ids=[tr.pk])
+    refresh_usage_facts([tr.pk])
+    technique_daily.mark(cells=execution_cells_before | technique_daily.cells_for(request_ids=[tr.pk]))
+    scheduling.invalidate(
+        [bk.receiving_day for bk in new_bookings]
+        + [d for bk in touched_bookings.values() for d in (bk.receiving_day, getattr(bk, "_loaded_receiving_day", None))]
+        + [sess.booking.receiving_day for sess in sessions.values() if sess.booking_id]
+    )
+    tr.refresh_from_db(fields=["is_done"])
+
 class TreatmentRequestSerializer(serializers.ModelSerializer):
     # Read
     service = ServiceGetSerializer(read_only=True)
@@ -1053,9 +1286,10 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
         
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data['doctor_id'] = getattr(instance, 'doctor_profile_id', None)
+        if 'doctor_id' in self.fields:  # ?fields= / ?omit= có thể đã bỏ field này
+            data['doctor_id'] = getattr(instance, 'doctor_profile_id', None)
         return data
-        
+
     def get_service(self, obj):
         s = obj.service
         return {'id': s.id, 'name': s.name, 'type': getattr(s, 'type', None)} if s else None
@@ -1167,6 +1401,8 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
         # Validate & create TR
         customer = self._get_customer_or_raise(customer_id)
         service, package = self._validate_service_and_package(service_id, package_id)
+        # 1) Validate + nạp toàn bộ kỹ thuật được tham chiếu bằng 1 query (trước khi ghi gì)
+        tech_map = _load_techical_settings(session_data)
 
         tr = TreatmentRequest.objects.create(
             service=service,
@@ -1189,7 +1425,7 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
 
         booking_today = (
             Booking.objects
-            .filter(customer=customer, receiving_day=today)
+            .filter(customer=customer, receiving_day=today, treatmentsession__isnull=True)  # booking 1-1 với buổi
             .order_by("set_date", "created")
             .first()
         )
@@ -1199,12 +1435,13 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
             customer=customer,
             receiving_day=today,
             has_come=False
-        ).update(has_come=True)
+        ).update(has_come=True, updated=timezone.now())
 
         # type booking theo service
         booking_type = self._get_booking_type_for_service(service)
 
-        # Tạo các buổi
+        # 2) Tính booking / buổi / dòng kỹ thuật trong bộ nhớ (chưa ghi DB)
+        new_bookings, sessions, items = [], [], []
         for i, session in enumerate(session_data, start=1):
             session_note  = session.get("note", f"Buổi {i}")
             techniques    = session.get("techniques", [])
@@ -1213,75 +1450,60 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
 
             booking = None
             if receiving_day or set_date:
-                # tạo booking đúng theo payload
+                # tạo booking đúng theo payload; có kỹ thuật đã đến hoặc buổi là hôm nay → coi như check-in
                 d_obj, t_obj = _normalize_booking_dt(receiving_day, set_date)
-
-                booking = Booking.objects.create(
+                booking = Booking(
                     customer=customer,
                     type=booking_type,
                     note=f"Buổi trị liệu {i} - {service.name}",
                     is_treatment=True,
-                    has_come=False,
+                    has_come=any(bool(t.get("has_come")) for t in techniques) or d_obj == today,
                     receiving_day=d_obj,
                     set_date=t_obj,
                 )
-
-                # Nếu có kỹ thuật đã đến → đồng bộ booking
-                if any(bool(t.get("has_come")) for t in techniques):
-                    if not booking.has_come:
-                        booking.has_come = True
-                        booking.save(update_fields=["has_come"])
-
-                # nếu buổi này cũng là hôm nay → coi như check-in
-                if d_obj == today and not booking.has_come:
-                    booking.has_come = True
-                    booking.save(update_fields=["has_come"])
-
-            else:
-                # không có thời gian → buổi 1 dùng booking trong ngày hoặc tạo mới
-                if i == 1:
-                    booking = booking_today or Booking.objects.create(
+                new_bookings.append(booking)
+            elif i == 1:
+                # không có thời gian → buổi 1 dùng booking trong ngày hoặc tạo mới (coi như đã đến)
+                booking = booking_today
+                if booking is None:
+                    booking = Booking(
                         customer=customer,
                         type=booking_type,
                         note=f"Buổi trị liệu {i} - {service.name}",
                         is_treatment=True,
-                        has_come=True,         # coi như đã đến
+                        has_come=True,
                         receiving_day=today,
                         set_date=now_dt.time(),  # TimeField -> time
                     )
+                    new_bookings.append(booking)
 
-            # tạo session & items
-            sess = TreatmentSession.objects.create(
-                treatment_request=tr,
-                note=session_note,
-                index_no=i,
-                booking=booking,
-            )
+            sess = TreatmentSession(treatment_request=tr, note=session_note, index_no=i, booking=booking)
+            sessions.append(sess)
 
             for tech in techniques:
-                ts_id            = tech.get("techical_setting_id")
-                expert_ids       = tech.get("expert_ids", [])
-                duration_minutes = tech.get("duration_minutes", 10)
-                room             = tech.get("room")
-                has_come         = bool(tech.get("has_come", False))
-
-                ts = TechicalSetting.objects.filter(id=ts_id).first()
-                if not ts:
-                    raise serializers.ValidationError(f"Kỹ thuật ID {ts_id} không tồn tại.")
-
-                SessionTechicalSetting.objects.create(
+                expert_ids = tech.get("expert_ids", [])
+                items.append(SessionTechicalSetting(
                     session=sess,
-                    techical_setting=ts,
-                    duration_minutes=duration_minutes,
-                    room=room,
-                    has_come=has_come,
+                    techical_setting=tech_map[tech.get("techical_setting_id")],
+                    duration_minutes=tech.get("duration_minutes", 10),
+                    room=tech.get("room"),
+                    has_come=bool(tech.get("has_come", False)),
                     expert_id=(expert_ids[0] if expert_ids else None),  # <-- lưu expert_id tại đây
-                )
-
-                # nếu có item đã đến → chắc chắn booking.has_come=True
-                if booking and has_come and not booking.has_come:
-                    booking.has_come = True
-                    booking.save(update_fields=["has_come"])
+                ))
+
+        # 3) Ghi: booking, buổi, kỹ thuật — mỗi loại 1 câu bulk_create
+        _bulk_create_bookings(customer, new_bookings)
+        _bulk_create_sessions(tr, sessions)
+        SessionTechicalSetting.objects.bulk_create(items, batch_size=500)
+
+        # 4) bulk_create không gửi signal: tính trạng thái hoàn thành + số liệu sử dụng + lịch 1 lần
+        if sessions:
+            done_status.flush(session_ids=[sess.pk for sess in sessions])
+            refresh_usage_facts([tr.pk])
+            technique_daily.mark(cells={(it.expert_id, _execution_day(tr, it.session))
+                                        for it in items if it.has_come and it.expert_id})
+            scheduling.invalidate([b.receiving_day for b in new_bookings] + [booking_today.receiving_day if booking_today else None])
+            tr.refresh_from_db(fields=["is_done"])
 
         return tr
 
@@ -1343,129 +1565,15 @@ class TreatmentRequestSerializer(serializers.ModelSerializer):
         instance.recalc_ar()
 
         # Xác định customer để tạo/điều chỉnh Booking
-        if customer_id:
-            customer = self._get_customer_or_raise(customer_id)
-        else:
-            any_sess = instance.treatment_sessions.select_related("booking__customer").first()
-            customer = getattr(getattr(any_sess, "booking", None), "customer", None)
-            if not customer:
-                raise serializers.ValidationError(
-                    "Không xác định được khách hàng. Vui lòng gửi kèm 'customer_id'."
-                )
+        customer = self._get_customer_or_raise(customer_id) if customer_id else instance.customer
 
-        # Nếu service đã đổi, có thể muốn đồng bộ type của các booking cũ
+        # Nếu service đã đổi, đồng bộ type của booking được chạm tới
         booking_type = self._get_booking_type_for_service(instance.service)
-        # Optional: đồng bộ toàn bộ booking hiện có của phác đồ
-        # instance.treatment_sessions.filter(booking__isnull=False).update(booking__type=booking_type)
-
-        # Upsert session + items
-        from django.db.models import Max
-        next_index = (instance.treatment_sessions.aggregate(mx=Max("index_no"))["mx"] or 0) + 1
-
-        for s in incoming_sessions:
-            session_id    = s.get("id")
-            session_note  = s.get("note", None)
-            receiving_day = s.get("receiving_day")
-            set_date      = s.get("set_date")
-
-            # lấy hoặc tạo session
-            if session_id:
-                sess = (
-                    TreatmentSession.objects
-                    .select_for_update()
-                    .filter(id=session_id, treatment_request=instance)
-                    .first()
-                )
-                if not sess:
-                    raise serializers.ValidationError(f"Buổi id={session_id} không thuộc phác đồ.")
-                if session_note is not None:
-                    sess.note = session_note
-            else:
-                sess = TreatmentSession.objects.create(
-                    treatment_request=instance,
-                    note=session_note or f"Buổi {next_index}",
-                    index_no=next_index,
-                )
-                next_index += 1
 
-            # upsert booking
-            if receiving_day is not None or set_date is not None:
-                d_obj, t_obj = _normalize_booking_dt(receiving_day, set_date)
-                if sess.booking_id:
-                    bk = sess.booking
-                    if receiving_day is not None:
-                        bk.receiving_day = d_obj
-                    if set_date is not None:
-                        bk.set_date = t_obj
-                    # đồng bộ type theo service hiện tại
-                    if bk.type != booking_type:
-                        bk.type = booking_type
-                    bk.save(update_fields=["receiving_day", "set_date", "type"])
-                else:
-                    bk = Booking.objects.create(
-                        customer=customer,
-                        type=booking_type,
-                        note=f"Buổi trị liệu {sess.index_no} - {instance.service.name if instance.service else ''}",
-                        is_treatment=True,
-                        has_come=False,
-                        receiving_day=d_obj,
-                        set_date=t_obj,
-                    )
-                    sess.booking = bk
-                    sess.save(update_fields=["booking"])
-
-            # upsert techniques
-            for t in s.get("techniques", []):
-                item_id          = t.get("id")
-                ts_id            = t.get("techical_setting_id")
-                expert_ids       = t.get("expert_ids", [])
-                duration_minutes = t.get("duration_minutes", 10)
-                room             = t.get("room")
-                has_come         = t.get("has_come", False)
-
-                if item_id:
-                    item = (
-                        SessionTechicalSetting.objects
-                        .select_for_update()
-                        .filter(id=item_id, session=sess)
-                        .first()
-                    )
-                    if not item:
-                        raise serializers.ValidationError(f"Item id={item_id} không thuộc buổi {sess.id}.")
-                    if ts_id:
-                        ts = TechicalSetting.objects.filter(id=ts_id).first()
-                        if not ts:
-                            raise serializers.ValidationError("Kỹ thuật không tồn tại.")
-                        if (hasattr(ts, "service_id")
-                            and ts.service_id
-                            and instance.service_id
-                            and ts.service_id != instance.service_id):
-                            raise serializers.ValidationError("Kỹ thuật không thuộc dịch vụ đã chọn.")
-                        item.techical_setting = ts
-                    item.duration_minutes = duration_minutes
-                    item.room = room
-                    item.has_come = has_come
-                    if expert_ids is not None:
-                        item.expert_id = (expert_ids[0] if expert_ids else None)  # cập nhật expert
-                    item.save()
-                else:
-                    ts = TechicalSetting.objects.filter(id=ts_id).first()
-                    if not ts:
-                        raise serializers.ValidationError("Kỹ thuật không tồn tại.")
-                    if (hasattr(ts, "service_id")
-                        and ts.service_id
-                        and instance.service_id
-                        and ts.service_id != instance.service_id):
-                        raise serializers.ValidationError("Kỹ thuật không thuộc dịch vụ đã chọn.")
-                    expert_id = (expert_ids[0] if expert_ids else None)
-                    SessionTechicalSetting.objects.create(
-                        session=sess,
-                        techical_setting=ts,
-                        duration_minutes=duration_minutes,
-                        room=room,
-                        has_come=has_come,
-                        expert_id=expert_id,
-                    )
+        if incoming_sessions:
+            # PUT: buổi không có trong payload bị xoá; PATCH chỉ thêm / sửa
+            _apply_sessions_diff(instance, customer, incoming_sessions, booking_type,
+                                 remove_missing=not self.partial)
 
         return instance
 
@@ -1531,49 +1639,103 @@ class BillListSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created', 'code', 'fully_paid']
 
     # -------------- methods --------------
+    # Số tiền của bill đọc từ BillTotals (select_related 'totals' ở ViewSet);
+    # bill chưa có BillTotals thì tính trực tiếp như cũ.
+    def _totals(self, obj):
+        try:
+            return obj.totals
+        except BillTotals.DoesNotExist:
+            return None
+
+    def _annotated(self, obj, name, fallback):
+        value = getattr(obj, name, None)
+        return value if value is not None else fallback()
+
     def get_package_services_total(self, obj):
-        return obj.get_total_service_amount()
+        return self.get_total_service_amount(obj)
 
     def get_technical_used_total(self, obj):
-        total = 0
-        for tr in obj.treatment_requests.all():
-            total += tr.get_total_price_is_done_treatment_sessions()
-        return total
-
-    def get_total_amount(self, obj): return obj.get_total_amount()
-    def get_total_amount_real(self, obj): return obj.get_total_amount_real()
-    def get_amount_remaining(self, obj): return obj.amount_remaining()
-    def get_total_product_amount(self, obj): return obj.get_total_product_amount()
-    def get_total_service_amount(self, obj): return obj.get_total_service_amount()
-    def get_customer_total_billed(self, obj): return obj.get_customer_total_billed()
-    def get_customer_total_paid(self, obj): return obj.get_customer_total_paid()
+        def _compute():
+            total = 0
+            for tr in obj.treatment_requests.all():
+                total += tr.get_total_price_is_done_treatment_sessions()
+            return total
+        return self._annotated(obj, "technical_used_total_value", _compute)
+
+    def get_total_amount(self, obj):
+        t = self._totals(obj)
+        return t.total_amount if t else obj.get_total_amount()
+
+    def get_total_amount_real(self, obj):
+        return self.get_total_amount(obj)
+
+    # Số liệu cấp khách hàng: CustomerBalance (select_related 'customer__balance').
+    # Chưa có dòng số dư = khách chưa phát sinh công nợ / thanh toán
+    # (dữ liệu cũ: chạy `manage.py rebuild_customer_balances`).
+    def _balance(self, obj):
+        try:
+            return obj.customer.balance if obj.customer else None
+        except CustomerBalance.DoesNotExist:
+            return CustomerBalance(customer_id=obj.customer_id)
+
+    def get_amount_remaining(self, obj):
+        b = self._balance(obj)
+        return b.amount_remaining if b else obj.amount_remaining()
+
+    def get_total_product_amount(self, obj):
+        t = self._totals(obj)
+        return t.total_product_amount if t else obj.get_total_product_amount()
+
+    def get_total_service_amount(self, obj):
+        t = self._totals(obj)
+        return t.total_service_amount if t else obj.get_total_service_amount()
+
+    def get_customer_total_billed(self, obj):
+        b = self._balance(obj)
+        return b.total_billed if b else obj.get_customer_total_billed()
+
+    def get_customer_total_paid(self, obj):
+        b = self._balance(obj)
+        return b.total_paid if b else obj.get_customer_total_paid()
 
     def get_doctor_process_details(self, obj):
-        dp = obj.customer.doctor_process.order_by('-id').first() if obj.customer else None
+        if not obj.customer:
+            return None
+        # ViewSet prefetch sẵn danh sách process (mới nhất trước) vào 'doctor_processes_latest'
+        latest = getattr(obj.customer, "doctor_processes_latest", None)
+        if latest is not None:
+            dp = latest[0] if latest else None
+        else:
+            dp = obj.customer.doctor_process.order_by('-id').first()
         return DoctorProcessSerializer(dp, context=self.context).data if dp else None
 
     def get_doctor(self, obj):
-        doctor = obj.get_doctor()
+        # Giống Bill.get_doctor nhưng không query DoctorProcess (không có field bác sĩ kiểu User);
+        # doctor_health_check__doctor đã được select_related ở ViewSet.
+        try:
+            doctor = obj.customer.doctor_health_check.doctor if obj.customer else None
+        except ObjectDoesNotExist:
+            doctor = None
         return getattr(doctor, "username", None) if doctor else None
 
     # ==== SESSIONS ====
     def get_treatment_sessions_remaining(self, obj):
-        return obj.get_treatment_sessions_remaining()
+        return self._annotated(obj, "sessions_remaining_count", obj.get_treatment_sessions_remaining)
 
     def get_treatment_sessions_done(self, obj):
-        return obj.get_treatment_sessions_done()
+        return self._annotated(obj, "sessions_done_count", obj.get_treatment_sessions_done)
 
     def get_uncompleted_sessions_tlcbs(self, obj):
-        return obj.get_uncompleted_sessions_for_tlcb_service()
+        return self._annotated(obj, "sessions_tlcb_remaining_count", obj.get_uncompleted_sessions_for_tlcb_service)
 
     def get_completed_sessions_tlcbs(self, obj):
-        return obj.get_completed_sessions_for_tlcb_service()
+        return self._annotated(obj, "sessions_tlcb_done_count", obj.get_completed_sessions_for_tlcb_service)
 
     def get_uncompleted_sessions_tldss(self, obj):
-        return obj.get_uncompleted_sessions_for_tlds_service()
+        return self._annotated(obj, "sessions_tlds_remaining_count", obj.get_uncompleted_sessions_for_tlds_service)
 
     def get_completed_sessions_tldss(self, obj):
-        return obj.get_completed_sessions_for_tlds_service()
+        return self._annotated(obj, "sessions_tlds_done_count", obj.get_completed_sessions_for_tlds_service)
 
 class PaymentHistorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -1598,7 +1760,7 @@ class PaymentHistorySerializer(serializers.ModelSerializer):
         validated['customer'] = ar.customer
         validated['user'] = request.user
         if not validated.get('code'):
-            validated['code'] = f"PMT{timezone.now():%Y%m%d%H%M%S}"
+            validated['code'] = next_code("PMT")
         with transaction.atomic():
             pmt = super().create(validated)
             # cập nhật ARItem
@@ -1607,6 +1769,46 @@ class PaymentHistorySerializer(serializers.ModelSerializer):
             ar.save(update_fields=['amount_paid', 'status'])
         return pmt
 
+class PaymentAllocateSerializer(serializers.Serializer):
+    """
+    Thu 1 lần cho nhiều phiếu công nợ của 1 khách.
+    ar_items: phân bổ theo đúng thứ tự; bỏ trống -> FIFO (phiếu cũ nhất trước).
+    """
+    customer = serializers.PrimaryKeyRelatedField(queryset=Customer.objects.all())
+    amount = serializers.DecimalField(max_digits=25, decimal_places=2, min_value=Decimal('0.01'))
+    paid_method = serializers.ChoiceField(choices=Bill.PAID_METHOD)
+    ar_items = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=True)
+    strategy = serializers.ChoiceField(choices=[('fifo', 'FIFO')], default='fifo')
+    note = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+
+    def create(self, validated):
+        request = self.context['request']
+        try:
+            return allocate_payment(
+                customer_id=validated['customer'].id,
+                amount=validated['amount'],
+                paid_method=validated['paid_method'],
+                user=request.user,
+                ar_item_ids=validated.get('ar_items') or None,
+                note=validated.get('note'),
+            )
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({"detail": e.messages})
+
+    def to_representation(self, bill):
+        return {
+            "bill_id": bill.id,
+            "bill_code": bill.code,
+            "customer": bill.customer_id,
+            "amount": bill.paid_ammount,
+            "paid_method": bill.method,
+            "payments": PaymentHistorySerializer(bill.allocated_payments, many=True).data,
+            "ar_items": [
+                {"id": ar.id, "amount_paid": ar.amount_paid, "amount_remaining": ar.amount_remaining, "status": ar.status}
+                for ar in bill.allocated_items
+            ],
+        }
+
 class ReExaminationSerializer(serializers.ModelSerializer):
     class Meta:
         model = ReExamination
@@ -1727,74 +1929,34 @@ class UserServiceStatsSerializer(serializers.ModelSerializer):
         name2 = " ".join(p for p in parts if p).strip()
         return name2 or getattr(obj, "username", str(obj.pk))
 
-    # ----- Lọc theo thời gian & base queryset -----
-    def _base_qs(self, obj):
-        """
-        Lấy queryset SessionTechicalSetting mà user là expert,
-        có áp dụng lọc thời gian theo TreatmentRequest.created_at.
-        """
-        request = self.context.get("request")
-        qs = SessionTechicalSetting.objects.filter(expert=obj)
-
-        if request:
-            start = request.query_params.get("start")
-            end = request.query_params.get("end")
-            if start:
-                d = parse_date(start)
-                if d:
-                    qs = qs.filter(session__treatment_request__created_at__date__gte=d)
-            if end:
-                d = parse_date(end)
-                if d:
-                    qs = qs.filter(session__treatment_request__created_at__date__lte=d)
-        return qs
-
-    # ----- Đếm số phác đồ (distinct TreatmentRequest) theo loại -----
-    def _count_plans_by_service_type(self, obj, service_type):
-        """Đếm số phác đồ (distinct TreatmentRequest) theo loại dịch vụ"""
-        qs = self._base_qs(obj).filter(
-            session__treatment_request__service__type=service_type
-        )
-        return qs.values("session__treatment_request_id").distinct().count()
-
-    def get_total_tlcb(self, obj):
-        return self._count_plans_by_service_type(obj, "TLCB")
-
-    def get_total_tlds(self, obj):
-        return self._count_plans_by_service_type(obj, "TLDS")
-
-    # ----- Tính tiền công theo loại -----
-    def _amount_by_service_type(self, obj, service_type):
-        """Tính tổng tiền cho expert này theo loại dịch vụ"""
-        qs = self._base_qs(obj).filter(
-            session__treatment_request__service__type=service_type,
-            has_come=True,  # chỉ tính kỹ thuật đã thực hiện
-            expert=obj      # chỉ tính kỹ thuật mà user này là expert
-        )
-        
-        # Tổng giá trị kỹ thuật đã thực hiện
-        agg = qs.aggregate(total=Sum("techical_setting__price"))
-        return agg["total"] or Decimal('0')
+    # ----- Thống kê: view truyền sẵn context["service_stats"] cho cả trang (services.user_service_stats)
+    def _stats(self, obj):
+        stats = self.context.get("service_stats")
+        if stats is None:
+            request = self.context.get("request")
+            start = parse_date(request.query_params.get("start") or "") if request else None
+            end = parse_date(request.query_params.get("end") or "") if request else None
+            stats = self.context["service_stats"] = user_service_stats(start, end)
+        return stats.get(obj.pk, USER_SERVICE_STATS_EMPTY)
 
     def get_total_tlcb(self, obj):
         """Đếm số lượt thực hiện kỹ thuật TLCB"""
-        return self._base_qs(obj).filter(
-            session__treatment_request__service__type="TLCB",
-            has_come=True,
-            expert=obj
-        ).count()
+        return self._stats(obj)["total_tlcb"]
 
     def get_total_tlds(self, obj):
         """Đếm số lượt thực hiện kỹ thuật TLDS"""
-        return self._base_qs(obj).filter(
-            session__treatment_request__service__type="TLDS", 
-            has_come=True,
-            expert=obj
-        ).count()
+        return self._stats(obj)["total_tlds"]
+
+    def get_amount_tlcb(self, obj):
+        return self._stats(obj)["amount_tlcb"]
+
+    def get_amount_tlds(self, obj):
+        return self._stats(obj)["amount_tlds"]
 
     def get_amount_total(self, obj):
         # Tổng tiền công từ cả 2 loại
-        return (self.get_amount_tlcb(obj) or 0) + (self.get_amount_tlds(obj) or 0)
+        s = self._stats(obj)
+        return s["amount_tlcb"] + s["amount_tlds"]
     
 class ARPaymentBriefSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,204 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from django.apps import apps
+from django.core import signing
+from django.db import connection
+from django.db.models import Sum
+from django.utils.dateparse import parse_datetime
+
+from app_treatment.services.ar_periods import ZERO, balance_before, day_start
+
+CURSOR_SALT = 'app_treatment.ar_ledger'
+
+
+def label_from_model(model: Optional[str]) -> str:
+    if model == "doctorprocess":
+        return "Đơn thuốc"
+    if model == "treatmentrequest":
+        return "Phác đồ"
+    if model in ("materialissue", "warehouseissue", "issuematerial", "stockout"):
+        return "Xuất vật tư"
+    return "Khác"
+
+
+def method_label(m: Optional[str]) -> str:
+    if m == "cash":
+        return "Tiền mặt"
+    if m == "transfer":
+        return "Chuyển khoản"
+    return m or ""
+
+
+def _dec(v) -> Decimal:
+    # MySQL trả Decimal; SQLite trả int/float qua UNION -> quy về Decimal qua str để không lệch số
+    if isinstance(v, Decimal):
+        return v
+    return Decimal(str(v or 0))
+
+
+def _dt(v) -> datetime:
+    return parse_datetime(v) if isinstance(v, str) else v
+
+
+def encode_cursor(created: datetime, type_order: int, pk: int, balance: Decimal) -> str:
+    return signing.dumps([created.isoformat(), type_order, pk, str(balance)], salt=CURSOR_SALT)
+
+
+def decode_cursor(token: str) -> Tuple[datetime, int, int, Decimal]:
+    """Giải mã cursor; ValueError nếu cursor sai / bị sửa."""
+    try:
+        created, type_order, pk, balance = signing.loads(token, salt=CURSOR_SALT)
+        return parse_datetime(created), int(type_order), int(pk), Decimal(balance)
+    except (signing.BadSignature, TypeError, ValueError, ArithmeticError):
+        raise ValueError("cursor không hợp lệ")
+
+
+def _bounds(start: Optional[date], end: Optional[date]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    return (day_start(start) if start else None,
+            day_start(end + timedelta(days=1)) if end else None)
+
+
+def _branch_where(alias: str, type_order: int, lo, hi, after) -> Tuple[List[str], List]:
+    """
+    Điều kiện thời gian + keyset cho 1 nhánh UNION (type_order cố định trong nhánh),
+    viết dạng so sánh trên (created, id) để dùng được index (customer, created).
+    """
+    adapt = connection.ops.adapt_datetimefield_value
+    conds, params = [], []
+    if lo is not None:
+        conds.append(f"{alias}.created >= %s")
+        params.append(adapt(lo))
+    if hi is not None:
+        conds.append(f"{alias}.created < %s")
+        params.append(adapt(hi))
+    if after is not None:
+        a_created, a_type, a_id = after
+        if type_order > a_type:
+            conds.append(f"{alias}.created >= %s")
+            params.append(adapt(a_created))
+        elif type_order < a_type:
+            conds.append(f"{alias}.created > %s")
+            params.append(adapt(a_created))
+        else:
+            conds.append(f"({alias}.created > %s OR ({alias}.created = %s AND {alias}.id > %s))")
+            params += [adapt(a_created), adapt(a_created), a_id]
+    return conds, params
+
+
+def ledger_page(customer_id: int, *, start: Optional[date] = None, end: Optional[date] = None,
+                cursor: Optional[str] = None, page_size: int = 50) -> Dict:
+    """
+    1 trang sổ chi tiết công nợ của khách: ARItem = Nợ (type_order 0), PaymentHistory = Có (type_order 1),
+    sắp theo (created, type_order, id). Số dư luỹ kế tính bằng SUM() OVER trong DB, cộng với
+    số dư mang sang (đầu kỳ ở trang đầu, hoặc số dư lưu trong cursor ở các trang sau).
+    Mỗi nhánh UNION chỉ lấy tối đa page_size + 1 dòng sau cursor -> chi phí mỗi trang không đổi.
+    """
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    qn = connection.ops.quote_name
+    t_ar, t_pay, t_ct = qn(ARItem._meta.db_table), qn(PaymentHistory._meta.db_table), qn(ContentType._meta.db_table)
+
+    lo, hi = _bounds(start, end)
+    opening = None
+    after = None
+    if cursor:
+        a_created, a_type, a_id, carried = decode_cursor(cursor)
+        after = (a_created, a_type, a_id)
+    else:
+        opening = balance_before(customer_id, start) if start else ZERO
+        carried = opening
+
+    limit = page_size + 1
+    ar_conds, ar_params = _branch_where('a', 0, lo, hi, after)
+    pay_conds, pay_params = _branch_where('p', 1, lo, hi, after)
+    ar_where = " AND ".join(["a.customer_id = %s"] + ar_conds)
+    pay_where = " AND ".join(["p.customer_id = %s"] + pay_conds)
+
+    sql = f"""
+        SELECT u.id, u.type_order, u.created, u.debit, u.credit, u.description, u.model,
+               u.paid_method, u.ar_item_id,
+               SUM(u.debit - u.credit) OVER (ORDER BY u.created, u.type_order, u.id) AS running
+        FROM (
+            SELECT * FROM (
+                SELECT a.id AS id, 0 AS type_order, a.created AS created,
+                       a.amount_original AS debit, 0 AS credit, a.description AS description,
+                       ct.model AS model, NULL AS paid_method, NULL AS ar_item_id
+                FROM {t_ar} a
+                LEFT JOIN {t_ct} ct ON ct.id = a.content_type_id
+                WHERE {ar_where}
+                ORDER BY a.created, a.id
+                LIMIT %s
+            ) d
+            UNION ALL
+            SELECT * FROM (
+                SELECT p.id AS id, 1 AS type_order, p.created AS created,
+                       0 AS debit, p.paid_amount AS credit, '' AS description,
+                       ct.model AS model, p.paid_method AS paid_method, p.ar_item_id AS ar_item_id
+                FROM {t_pay} p
+                LEFT JOIN {t_ar} a ON a.id = p.ar_item_id
+                LEFT JOIN {t_ct} ct ON ct.id = a.content_type_id
+                WHERE {pay_where}
+                ORDER BY p.created, p.id
+                LIMIT %s
+            ) c
+        ) u
+        ORDER BY u.created, u.type_order, u.id
+        LIMIT %s
+    """
+    params = [customer_id, *ar_params, limit, customer_id, *pay_params, limit, limit]
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    entries = []
+    for pk, type_order, created, debit, credit, description, model, paid_method, ar_item_id, running in rows:
+        debit, credit = _dec(debit), _dec(credit)
+        balance = carried + _dec(running)
+        if type_order == 0:
+            desc = description or label_from_model(model) or "Phát sinh công nợ"
+        else:
+            desc = f"Thu tiền {label_from_model(model)} (AR #{ar_item_id})"
+            mth = method_label(paid_method)
+            if mth:
+                desc += f" - {mth}"
+        entries.append({
+            "id": pk,
+            "type": "debit" if type_order == 0 else "credit",
+            "type_order": type_order,
+            "date": _dt(created),
+            "description": desc,
+            "debit": debit,
+            "credit": credit,
+            "balance_debit": balance if balance > 0 else ZERO,
+            "balance_credit": -balance if balance < 0 else ZERO,
+            "_balance": balance,
+        })
+
+    next_cursor = None
+    if has_more and entries:
+        last = entries[-1]
+        next_cursor = encode_cursor(last["date"], last["type_order"], last["id"], last["_balance"])
+    for e in entries:
+        del e["_balance"]
+
+    return {"opening_balance": opening, "entries": entries, "next_cursor": next_cursor}
+
+
+def ledger_totals(customer_id: int, start: Optional[date] = None, end: Optional[date] = None) -> Tuple[Decimal, Decimal]:
+    """Tổng Nợ / tổng Có của khách trong [start, end] (2 aggregate trên index (customer, created))."""
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    lo, hi = _bounds(start, end)
+    rng = {}
+    if lo is not None:
+        rng['created__gte'] = lo
+    if hi is not None:
+        rng['created__lt'] = hi
+    debit = ARItem.objects.filter(customer_id=customer_id, **rng).aggregate(s=Sum('amount_original'))['s']
+    credit = PaymentHistory.objects.filter(customer_id=customer_id, **rng).aggregate(s=Sum('paid_amount'))['s']
+    return debit or ZERO, credit or ZERO
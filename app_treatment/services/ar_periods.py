@@ -0,0 +1,177 @@
+from typing import Dict, Optional
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce
+
+DEC = DecimalField(max_digits=25, decimal_places=2)
+ZERO = Decimal('0')
+
+
+def month_start(d: date) -> date:
+    return d.replace(day=1)
+
+
+def next_month(d: date) -> date:
+    d = month_start(d)
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+
+def prev_month(d: date) -> date:
+    d = month_start(d)
+    return date(d.year - 1, 12, 1) if d.month == 1 else date(d.year, d.month - 1, 1)
+
+
+def day_start(d: date) -> datetime:
+    """00:00 của ngày d (USE_TZ=False -> datetime naive); dùng thay cho created__date để tận dụng index."""
+    return datetime(d.year, d.month, d.day)
+
+
+def day_range(field: str, start: Optional[date] = None, end: Optional[date] = None) -> Q:
+    """Q lọc field (DateTime) trong [start, end] theo ngày, dạng nửa mở >= / < thay cho __date__range."""
+    cond = Q()
+    if start:
+        cond &= Q(**{f"{field}__gte": day_start(start)})
+    if end:
+        cond &= Q(**{f"{field}__lt": day_start(end + timedelta(days=1))})
+    return cond
+
+
+def last_closed_before(d: date) -> Optional[date]:
+    """Kỳ (tháng) đã khoá gần nhất mà kết thúc trước ngày d."""
+    ARPeriodClose = apps.get_model('app_treatment', 'ARPeriodClose')
+    # kỳ M kết thúc trước d  <=>  next_month(M) <= d  <=>  M <= prev_month(d)
+    return (ARPeriodClose.objects
+            .filter(period__lte=prev_month(d))
+            .order_by('-period')
+            .values_list('period', flat=True)
+            .first())
+
+
+def _grouped_sum(qs, field) -> Dict[int, Decimal]:
+    return {
+        r['customer_id']: r['s'] or ZERO
+        for r in qs.values('customer_id').annotate(s=Sum(field))
+    }
+
+
+@transaction.atomic
+def close_period(period: date) -> int:
+    """
+    Khoá 1 tháng: ghi ARPeriodSnapshot cho các khách có số dư đầu kỳ hoặc phát sinh khác 0.
+    Số dư đầu kỳ lấy từ snapshot tháng trước (nếu tháng trước đã khoá),
+    ngược lại tính từ toàn bộ lịch sử trước tháng (chỉ xảy ra ở lần khoá đầu tiên).
+    Trả về số dòng snapshot đã ghi.
+    """
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ARPeriodSnapshot = apps.get_model('app_treatment', 'ARPeriodSnapshot')
+    ARPeriodClose = apps.get_model('app_treatment', 'ARPeriodClose')
+
+    period = month_start(period)
+    start, end = day_start(period), day_start(next_month(period))
+    prev = prev_month(period)
+
+    if ARPeriodClose.objects.filter(period=prev).exists():
+        opening = dict(ARPeriodSnapshot.objects.filter(period=prev).values_list('customer_id', 'closing'))
+    else:
+        debit_before = _grouped_sum(ARItem.objects.filter(created__lt=start), 'amount_original')
+        credit_before = _grouped_sum(PaymentHistory.objects.filter(created__lt=start), 'paid_amount')
+        opening = {
+            cid: debit_before.get(cid, ZERO) - credit_before.get(cid, ZERO)
+            for cid in set(debit_before) | set(credit_before)
+        }
+
+    debit = _grouped_sum(ARItem.objects.filter(created__gte=start, created__lt=end), 'amount_original')
+    credit = _grouped_sum(PaymentHistory.objects.filter(created__gte=start, created__lt=end), 'paid_amount')
+
+    rows = []
+    for cid in set(opening) | set(debit) | set(credit):
+        o, d, c = opening.get(cid, ZERO), debit.get(cid, ZERO), credit.get(cid, ZERO)
+        if not (o or d or c):
+            continue
+        rows.append(ARPeriodSnapshot(
+            customer_id=cid, period=period,
+            opening=o, debit=d, credit=c, closing=o + d - c,
+        ))
+
+    ARPeriodSnapshot.objects.filter(period=period).delete()
+    ARPeriodSnapshot.objects.bulk_create(rows, batch_size=1000)
+    ARPeriodClose.objects.update_or_create(period=period, defaults={'customer_count': len(rows)})
+    return len(rows)
+
+
+def reopen_from(period: date) -> int:
+    """Mở lại các kỳ từ tháng `period` (khi có chứng từ ghi lùi ngày); trả số kỳ đã mở."""
+    ARPeriodSnapshot = apps.get_model('app_treatment', 'ARPeriodSnapshot')
+    ARPeriodClose = apps.get_model('app_treatment', 'ARPeriodClose')
+    period = month_start(period)
+    with transaction.atomic():
+        ARPeriodSnapshot.objects.filter(period__gte=period).delete()
+        deleted, _ = ARPeriodClose.objects.filter(period__gte=period).delete()
+    return deleted
+
+
+def ar_summary_annotations(start: date, end: date) -> Dict[str, object]:
+    """
+    Các annotate cho Customer để tính bảng tổng hợp công nợ trong SQL:
+      opening = closing của snapshot tháng đã khoá gần nhất + phát sinh từ sau kỳ đó tới trước startDate
+      period_debit / period_credit = phát sinh trong [startDate, endDate]
+    Chỉ quét các dòng trong khoảng thời gian cần thiết (index (customer, created)).
+    """
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ARPeriodSnapshot = apps.get_model('app_treatment', 'ARPeriodSnapshot')
+
+    base_period = last_closed_before(start)
+    delta_from = day_start(next_month(base_period)) if base_period else None
+    start_dt, end_dt = day_start(start), day_start(end + timedelta(days=1))
+
+    def _sum(model, field, lo, hi):
+        qs = model.objects.filter(customer_id=OuterRef('pk'), created__lt=hi)
+        if lo is not None:
+            qs = qs.filter(created__gte=lo)
+        sq = qs.order_by().values('customer_id').annotate(s=Sum(field)).values('s')
+        return Coalesce(Subquery(sq, output_field=DEC), Value(ZERO, output_field=DEC))
+
+    if base_period:
+        snap = (ARPeriodSnapshot.objects
+                .filter(customer_id=OuterRef('pk'), period=base_period)
+                .values('closing')[:1])
+        opening_base = Coalesce(Subquery(snap, output_field=DEC), Value(ZERO, output_field=DEC))
+    else:
+        opening_base = Value(ZERO, output_field=DEC)
+
+    return {
+        'opening_base': opening_base,
+        'opening_debit_delta': _sum(ARItem, 'amount_original', delta_from, start_dt),
+        'opening_credit_delta': _sum(PaymentHistory, 'paid_amount', delta_from, start_dt),
+        'period_debit': _sum(ARItem, 'amount_original', start_dt, end_dt),
+        'period_credit': _sum(PaymentHistory, 'paid_amount', start_dt, end_dt),
+    }
+
+
+def balance_before(customer_id: int, d: date) -> Decimal:
+    """Số dư công nợ của 1 khách trước 00:00 ngày d (snapshot gần nhất + phát sinh sau đó)."""
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ARPeriodSnapshot = apps.get_model('app_treatment', 'ARPeriodSnapshot')
+
+    base_period = last_closed_before(d)
+    balance = ZERO
+    ar_qs = ARItem.objects.filter(customer_id=customer_id, created__lt=day_start(d))
+    pay_qs = PaymentHistory.objects.filter(customer_id=customer_id, created__lt=day_start(d))
+    if base_period:
+        balance = (ARPeriodSnapshot.objects
+                   .filter(customer_id=customer_id, period=base_period)
+                   .values_list('closing', flat=True)
+                   .first()) or ZERO
+        delta_from = day_start(next_month(base_period))
+        ar_qs = ar_qs.filter(created__gte=delta_from)
+        pay_qs = pay_qs.filter(created__gte=delta_from)
+
+    debit = ar_qs.aggregate(s=Sum('amount_original'))['s'] or ZERO
+    credit = pay_qs.aggregate(s=Sum('paid_amount'))['s'] or ZERO
+    return balance + debit - credit
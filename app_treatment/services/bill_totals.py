@@ -0,0 +1,162 @@
+from typing import Dict, Iterable, Optional
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce
+
+from .pricing import price_items
+
+DEC = DecimalField(max_digits=25, decimal_places=2)
+ZERO = Decimal('0')
+
+
+def compute_customer_amounts(customer_ids: Iterable[int]) -> Dict[int, Dict[str, Decimal]]:
+    """
+    Tính tiền dịch vụ / thuốc theo DoctorProcess đang hiệu lực cho NHIỀU khách hàng
+    với số query cố định (không phụ thuộc số khách / số dòng):
+      1) DoctorProcess active (+ medicine_discount)
+      2) ServiceAssign (+ service_discount)
+      3) services.pricing.price_items cho cả process lẫn chỉ định dịch vụ
+
+    Trả về {customer_id: {"service": Decimal, "product": Decimal}}.
+    """
+    DoctorProcess = apps.get_model('app_treatment', 'DoctorProcess')
+    ServiceAssign = apps.get_model('app_treatment', 'ServiceAssign')
+
+    customer_ids = {cid for cid in customer_ids if cid}
+    out = {cid: {'service': ZERO, 'product': ZERO} for cid in customer_ids}
+    if not customer_ids:
+        return out
+
+    # process đang hiệu lực (cùng thứ tự với DoctorProcess.active_for_customer)
+    active_dp = {}
+    for dp in (DoctorProcess.objects
+               .filter(customer_id__in=customer_ids, is_active=True)
+               .select_related('medicine_discount')
+               .order_by('customer_id', '-version')):
+        active_dp.setdefault(dp.customer_id, dp)
+    if not active_dp:
+        return out
+
+    dp_customer = {dp.id: cid for cid, dp in active_dp.items()}
+    assigns = list(ServiceAssign.objects
+                   .filter(doctor_process_id__in=dp_customer)
+                   .select_related('service_discount'))
+
+    prices = price_items(list(active_dp.values()) + assigns)
+    for cid, dp in active_dp.items():
+        out[cid]['product'] = prices[dp].final
+    for a in assigns:
+        out[dp_customer[a.doctor_process_id]]['service'] += prices[a].final
+    return out
+
+
+@transaction.atomic
+def recompute_bill_totals(customer_ids: Iterable[int]) -> int:
+    """
+    Tính lại và ghi BillTotals cho toàn bộ Bill của các khách hàng truyền vào,
+    kèm CustomerBalance.total_billed của các khách đó.
+    Gọi trong cùng transaction với thao tác ghi làm thay đổi số tiền.
+    Trả về số Bill đã cập nhật.
+    """
+    Bill = apps.get_model('app_treatment', 'Bill')
+    BillTotals = apps.get_model('app_treatment', 'BillTotals')
+    CustomerBalance = apps.get_model('app_treatment', 'CustomerBalance')
+
+    customer_ids = {cid for cid in customer_ids if cid}
+    if not customer_ids:
+        return 0
+
+    bill_rows = list(Bill.objects
+                     .filter(customer_id__in=customer_ids)
+                     .values_list('id', 'customer_id'))
+    if not bill_rows:
+        return 0
+
+    # Mọi bill của cùng khách hàng có cùng số tiền (tính theo process đang hiệu lực)
+    amounts = compute_customer_amounts(customer_ids)
+    rows = []
+    for bill_id, cid in bill_rows:
+        service = amounts[cid]['service']
+        product = amounts[cid]['product']
+        rows.append(BillTotals(
+            bill_id=bill_id,
+            total_service_amount=service,
+            total_product_amount=product,
+            total_amount=service + product,
+        ))
+
+    BillTotals.objects.filter(bill_id__in=[r.bill_id for r in rows]).delete()
+    BillTotals.objects.bulk_create(rows, batch_size=500)
+    CustomerBalance.refresh_billed({cid for _, cid in bill_rows})
+    return len(rows)
+
+
+def customers_for_discount(discount_id: int) -> set:
+    """Các khách hàng có process đang hiệu lực dùng discount này (thuốc hoặc dịch vụ)."""
+    DoctorProcess = apps.get_model('app_treatment', 'DoctorProcess')
+    ServiceAssign = apps.get_model('app_treatment', 'ServiceAssign')
+    ids = set(DoctorProcess.objects
+              .filter(is_active=True, medicine_discount_id=discount_id)
+              .values_list('customer_id', flat=True))
+    ids |= set(ServiceAssign.objects
+               .filter(doctor_process__is_active=True, service_discount_id=discount_id)
+               .values_list('doctor_process__customer_id', flat=True))
+    ids.discard(None)
+    return ids
+
+
+def customers_for_service_price(service_id: Optional[int], package_id: Optional[int]) -> set:
+    """Các khách hàng có process đang hiệu lực chỉ định dịch vụ theo cặp (service, gói) của bảng giá."""
+    DiagnosisService = apps.get_model('app_treatment', 'diagnosis_service')
+    if not service_id or not package_id:
+        return set()
+    ids = set(DiagnosisService.objects
+              .filter(service_id=service_id, treatment_package_id=package_id,
+                      service_assign__doctor_process__is_active=True)
+              .values_list('service_assign__doctor_process__customer_id', flat=True))
+    ids.discard(None)
+    return ids
+
+
+def customer_for_doctor_process(dp_id: Optional[int]) -> Optional[int]:
+    if not dp_id:
+        return None
+    DoctorProcess = apps.get_model('app_treatment', 'DoctorProcess')
+    return DoctorProcess.objects.filter(pk=dp_id).values_list('customer_id', flat=True).first()
+
+
+def bill_session_annotations() -> Dict[str, object]:
+    """
+    Các annotate (subquery) thay cho Bill.get_treatment_sessions_* và tiền kỹ thuật đã dùng,
+    để danh sách Bill lấy được trong 1 query thay vì 7 query / dòng.
+    """
+    TreatmentSession = apps.get_model('app_treatment', 'TreatmentSession')
+    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
+
+    def _count(**filters):
+        sq = (TreatmentSession.objects
+              .filter(treatment_request__bill=OuterRef('pk'), **filters)
+              .order_by()
+              .values('treatment_request__bill')
+              .annotate(c=Count('id'))
+              .values('c'))
+        return Coalesce(Subquery(sq, output_field=IntegerField()), Value(0))
+
+    used = (STS.objects
+            .filter(session__treatment_request__bill=OuterRef('pk'), has_come=True)
+            .order_by()
+            .values('session__treatment_request__bill')
+            .annotate(s=Sum('techical_setting__price'))
+            .values('s'))
+
+    return {
+        'sessions_remaining_count': _count(is_done=False),
+        'sessions_done_count': _count(is_done=True),
+        'sessions_tlcb_remaining_count': _count(treatment_request__service__type='TLCB', is_done=False),
+        'sessions_tlcb_done_count': _count(treatment_request__service__type='TLCB', is_done=True),
+        'sessions_tlds_remaining_count': _count(treatment_request__service__type='TLDS', is_done=False),
+        'sessions_tlds_done_count': _count(treatment_request__service__type='TLDS', is_done=True),
+        'technical_used_total_value': Coalesce(Subquery(used, output_field=DEC), Value(0, output_field=DEC)),
+    }
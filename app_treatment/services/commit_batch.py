@@ -0,0 +1,24 @@
+from typing import Optional, Type, TypeVar
+from django.db import transaction
+
+B = TypeVar('B')
+
+
+def on_commit_batch(cls: Type[B], using: Optional[str] = None) -> Optional[B]:
+    """
+    Batch `cls()` của transaction hiện tại, đăng ký qua transaction.on_commit; None nếu ngoài transaction.
+    Chỉ dùng lại batch đăng ký trong các savepoint còn đang mở (mỗi mục run_on_commit mang savepoint_ids lúc
+    đăng ký): savepoint rollback thì Django bỏ batch cùng mọi thứ đã gom trong đó, không làm mất phần gom
+    sau đó ở transaction ngoài; batch không khớp thì đăng ký batch mới cho mức savepoint hiện tại.
+    """
+    conn = transaction.get_connection(using)
+    if not conn.in_atomic_block:
+        return None
+    active = set(conn.savepoint_ids)
+    for entry in reversed(conn.run_on_commit):
+        sids, func = entry[0], entry[1]
+        if isinstance(func, cls) and set(sids) <= active:
+            return func
+    batch = cls()
+    transaction.on_commit(batch, using=using)
+    return batch
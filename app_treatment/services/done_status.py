@@ -0,0 +1,94 @@
+from typing import Iterable
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Case, Exists, OuterRef, Q, Value, When, BooleanField, CharField
+
+from .commit_batch import on_commit_batch
+
+
+class _DirtyBatch:
+    """
+    Các buổi / phác đồ / khách cần tính lại trạng thái trong transaction hiện tại.
+    Đăng ký qua transaction.on_commit (services.commit_batch); rollback thì Django bỏ callback -> bỏ luôn batch.
+    """
+    def __init__(self):
+        self.sessions = set()
+        self.requests = set()
+        self.customers = set()
+
+    def __call__(self):
+        flush(self.sessions, self.requests, self.customers)
+
+
+def _batch(using=None):
+    return on_commit_batch(_DirtyBatch, using=using)
+
+
+def mark_dirty(*, sessions: Iterable[int] = (), requests: Iterable[int] = (), customers: Iterable[int] = ()) -> None:
+    """
+    Đánh dấu cần tính lại is_done (buổi, phác đồ) / main_status (khách).
+    Trong transaction: gom lại và tính 1 lần khi commit; ngoài transaction: tính ngay.
+    """
+    sessions = {i for i in sessions if i}
+    requests = {i for i in requests if i}
+    customers = {i for i in customers if i}
+    if not (sessions or requests or customers):
+        return
+    batch = _batch()
+    if batch is None:
+        flush(sessions, requests, customers)
+        return
+    batch.sessions |= sessions
+    batch.requests |= requests
+    batch.customers |= customers
+
+
+def _done_case(techniques):
+    """is_done = có ít nhất 1 kỹ thuật và không còn kỹ thuật has_come=False."""
+    return Case(
+        When(Q(Exists(techniques)) & ~Q(Exists(techniques.filter(has_come=False))), then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+
+@transaction.atomic
+def flush(session_ids: Iterable[int] = (), request_ids: Iterable[int] = (), customer_ids: Iterable[int] = ()) -> None:
+    """
+    Tính lại trạng thái bằng UPDATE theo tập (số query cố định, không phụ thuộc số dòng):
+      1) TreatmentSession.is_done theo kỹ thuật của buổi
+      2) TreatmentRequest.is_done theo kỹ thuật của mọi buổi thuộc phác đồ (kể cả phác đồ của buổi ở bước 1)
+      3) Customer.main_status: '3' nếu mọi phác đồ (qua Bill) đã xong, '2' nếu còn phác đồ dở; khách chưa có phác đồ giữ nguyên
+    """
+    TreatmentSession = apps.get_model('app_treatment', 'TreatmentSession')
+    TreatmentRequest = apps.get_model('app_treatment', 'TreatmentRequest')
+    SessionTechicalSetting = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    Customer = apps.get_model('app_customer', 'Customer')
+
+    session_ids, request_ids, customer_ids = set(session_ids), set(request_ids), set(customer_ids)
+
+    if session_ids:
+        TreatmentSession.objects.filter(id__in=session_ids).update(
+            is_done=_done_case(SessionTechicalSetting.objects.filter(session_id=OuterRef('pk')))
+        )
+        request_ids |= set(TreatmentSession.objects
+                           .filter(id__in=session_ids)
+                           .values_list('treatment_request_id', flat=True))
+
+    if request_ids:
+        TreatmentRequest.objects.filter(id__in=request_ids).update(
+            is_done=_done_case(SessionTechicalSetting.objects.filter(session__treatment_request_id=OuterRef('pk')))
+        )
+        customer_ids |= set(TreatmentRequest.objects
+                            .filter(id__in=request_ids, bill__customer_id__isnull=False)
+                            .values_list('bill__customer_id', flat=True))
+
+    if customer_ids:
+        requests = TreatmentRequest.objects.filter(bill__customer_id=OuterRef('pk'))
+        (Customer.objects
+         .filter(Exists(requests), id__in=customer_ids)
+         .update(main_status=Case(
+             When(Exists(requests.filter(is_done=False)), then=Value('2')),
+             default=Value('3'),
+             output_field=CharField(),
+         )))
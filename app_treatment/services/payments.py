@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional, Sequence
+from decimal import Decimal
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.dispatch import Signal
+
+ZERO = Decimal('0.00')
+
+# Gửi sau khi 1 đợt thu nhiều dòng được ghi bằng bulk_create/bulk_update (không có post_save từng dòng).
+# kwargs: bill, payments (list PaymentHistory), ar_items (list ARItem đã cập nhật), closed_count
+payments_created = Signal()
+
+
+def _remaining(ar) -> Decimal:
+    return (ar.amount_original or ZERO) - (ar.amount_paid or ZERO)
+
+
+def _status(ar) -> str:
+    if _remaining(ar) <= 0:
+        return 'closed'
+    return 'partial' if (ar.amount_paid or ZERO) > 0 else 'open'
+
+
+def plan_allocation(items: Sequence, amount: Decimal) -> Dict[int, Decimal]:
+    """Chia amount lần lượt vào các ARItem theo thứ tự truyền vào; trả {ar_item_id: số tiền}."""
+    plan = {}
+    left = amount
+    for ar in items:
+        if left <= 0:
+            break
+        take = min(left, _remaining(ar))
+        if take > 0:
+            plan[ar.pk] = take
+            left -= take
+    if left > 0:
+        raise ValidationError("Số tiền thanh toán vượt quá dư nợ của các phiếu công nợ.")
+    return plan
+
+
+@transaction.atomic
+def allocate_payment(*, customer_id: int, amount: Decimal, paid_method: str, user=None,
+                     ar_item_ids: Optional[List[int]] = None, note: Optional[str] = None):
+    """
+    Thu 1 lần cho nhiều ARItem của khách:
+      - khoá các ARItem đích bằng 1 SELECT ... FOR UPDATE (sắp theo id để tránh deadlock)
+      - ar_item_ids: phân bổ theo đúng thứ tự truyền vào; không truyền: FIFO (cũ nhất trước)
+      - 1 Bill cho cả đợt thu, 1 PaymentHistory / ARItem (bulk_create), 1 UPDATE / ARItem (bulk_update)
+    Trả về Bill vừa tạo (kèm `allocated_payments`, `allocated_items`).
+    """
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    Bill = apps.get_model('app_treatment', 'Bill')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+
+    if amount is None or amount <= 0:
+        raise ValidationError("Số tiền phải > 0.")
+
+    qs = (ARItem.objects
+          .select_for_update()
+          .filter(customer_id=customer_id)
+          .exclude(status='closed')
+          .order_by('id'))
+    if ar_item_ids:
+        qs = qs.filter(id__in=ar_item_ids)
+    locked = list(qs)
+
+    if ar_item_ids:
+        by_id = {ar.pk: ar for ar in locked}
+        missing = [i for i in ar_item_ids if i not in by_id]
+        if missing:
+            raise ValidationError(f"Phiếu công nợ không hợp lệ / đã tất toán / không thuộc khách hàng: {missing}")
+        ordered = [by_id[i] for i in dict.fromkeys(ar_item_ids)]
+    else:
+        ordered = sorted(locked, key=lambda ar: (ar.created, ar.pk))
+
+    plan = plan_allocation(ordered, amount)
+
+    bill = Bill(customer_id=customer_id, paid_ammount=amount, method=paid_method, user=user, note=note)
+    bill.save()
+
+    payments, touched, closed = [], [], 0
+    for ar in ordered:
+        part = plan.get(ar.pk)
+        if not part:
+            continue
+        was_open = ar.status != 'closed'
+        ar.amount_paid = (ar.amount_paid or ZERO) + part
+        ar.status = _status(ar)
+        if was_open and ar.status == 'closed':
+            closed += 1
+        touched.append(ar)
+        payments.append(PaymentHistory(
+            bill=bill, ar_item=ar, customer_id=customer_id,
+            paid_amount=part, paid_method=paid_method, user=user,
+            code=f"{bill.code}-{len(payments) + 1:02d}",
+        ))
+
+    PaymentHistory.objects.bulk_create(payments)
+    if not all(p.pk for p in payments):
+        # backend không trả id sau INSERT nhiều dòng (MySQL): đọc lại theo (bill, code) — code duy nhất trong đợt thu
+        by_code = dict(PaymentHistory.objects.filter(bill=bill).values_list('code', 'id'))
+        for p in payments:
+            p.pk = by_code[p.code]
+    ARItem.objects.bulk_update(touched, ['amount_paid', 'status'])
+    for ar in touched:
+        ar._balance_snapshot = ar.balance_state()
+
+    payments_created.send(sender=PaymentHistory, bill=bill, payments=payments,
+                          ar_items=touched, closed_count=closed)
+
+    bill.allocated_payments = payments
+    bill.allocated_items = touched
+    return bill
@@ -1,10 +1,80 @@
 from typing import Optional, Dict
+from datetime import date, timedelta
 from decimal import Decimal
 from django.apps import apps
-from django.db.models import Q, Count, Sum, Value, DecimalField
-from django.db.models.functions import Coalesce
+from django.db.models import Q, Sum
+from django.utils.dateparse import parse_date
+
+from . import technique_daily
+from .ar_periods import next_month
+
+ZERO = Decimal('0')
+EMPTY_STATS = {'count_tlcb': 0, 'count_tlds': 0, 'total_count': 0, 'amount': ZERO}
+
+
+def _as_date(value):
+    return parse_date(value) if isinstance(value, str) else value
+
+
+def closed_period_of(start_date, end_date) -> Optional[date]:
+    """Tháng (ngày 1) nếu [start, end] đúng trọn 1 tháng, ngược lại None."""
+    start_date, end_date = _as_date(start_date), _as_date(end_date)
+    if not start_date or not end_date or start_date.day != 1:
+        return None
+    return start_date if end_date == next_month(start_date) - timedelta(days=1) else None
+
+
+def payroll_line(hr, s: Dict) -> Dict:
+    """1 dòng lương (giá trị Decimal) của HR từ thống kê expert_totals; HR cần select_related('position')."""
+    pos = hr.position
+    coeff = float(pos.performance_coefficient) if pos and pos.performance_coefficient else 1.0
+    # Tính lương = hệ số * tổng tiền kỹ thuật
+    salary = (Decimal(str(coeff)) * (s['amount'] or ZERO)).quantize(Decimal('0.01'))
+    return {
+        "hr_id": hr.id,
+        "employee_code": hr.code,
+        "full_name": hr.full_name,
+        "position": pos.title if pos else None,
+        "contract": hr.get_contract_type_display() if hr.contract_type else None,
+        "coefficient": coeff,
+        "count_tlcb": s['count_tlcb'],
+        "count_tlds": s['count_tlds'],
+        "total_count": s['total_count'],
+        "total_amount": s['amount'],
+        "salary": salary,
+    }
+
+
+def _closed_payroll(run, *, user_type=None, department_id=None, search=None):
+    """Bảng lương kỳ đã chốt: chỉ đọc PayrollLine (số liệu, hệ số tại thời điểm chốt)."""
+    PayrollLine = apps.get_model('app_treatment', 'PayrollLine')
+    lines = PayrollLine.objects.filter(run=run)
+    if user_type:
+        lines = lines.filter(hr_type=user_type)
+    if department_id:
+        lines = lines.filter(department_id=department_id)
+    if search:
+        lines = lines.filter(
+            Q(full_name__icontains=search) |
+            Q(employee_code__icontains=search) |
+            Q(email__icontains=search)
+        )
+    out = [{
+        "hr_id": ln.hr_id,
+        "employee_code": ln.employee_code,
+        "full_name": ln.full_name,
+        "position": ln.position,
+        "contract": ln.contract,
+        "coefficient": ln.coefficient,
+        "count_tlcb": ln.count_tlcb,
+        "count_tlds": ln.count_tlds,
+        "total_count": ln.total_count,
+        "total_amount": str(ln.total_amount),
+        "salary": str(ln.salary),
+    } for ln in lines]
+    out.sort(key=lambda x: (x['full_name'] or '').lower())
+    return out
 
-DEC = DecimalField(max_digits=18, decimal_places=2)
 
 def get_performance_payroll(
     start_date,
@@ -19,14 +89,22 @@ def get_performance_payroll(
     
     Logic:
     - Mỗi SessionTechicalSetting với has_come=True = 1 lượt thực hiện kỹ thuật
-    - Nhóm theo expert (HrUserProfile) và loại kỹ thuật (TLCB/TLDS)
+    - Nhóm theo expert (HrUserProfile) và loại kỹ thuật (TLCB/TLDS), đọc từ TechniqueExecutionDaily
+      (ngày = ngày hẹn của buổi, buổi chưa có lịch thì ngày tạo phác đồ)
     - Tính tổng tiền = sum(techical_setting.price) của các kỹ thuật đã thực hiện
     - Lương = coefficient * tổng tiền
+    - Khoảng thời gian đúng 1 tháng đã chốt (PayrollRun) -> trả snapshot PayrollLine, không tính lại
     """
     
     Hr = apps.get_model('app_hr', 'HrUserProfile')
-    Pos = apps.get_model('app_home', 'Position')
-    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    PayrollRun = apps.get_model('app_treatment', 'PayrollRun')
+    
+    start_date, end_date = _as_date(start_date), _as_date(end_date)
+    period = closed_period_of(start_date, end_date)
+    if period:
+        run = PayrollRun.objects.filter(period=period).first()
+        if run:
+            return _closed_payroll(run, user_type=user_type, department_id=department_id, search=search)
     
     # ---- 1) Base HR queryset: chỉ employee
     hq = Hr.objects.select_related('position').filter(type="employee")
@@ -44,95 +122,17 @@ def get_performance_payroll(
         )
         hq = hq.filter(search_query)
     
-    # ---- 2) Thời gian filter - sửa tên field
-    time_q = (
-        Q(session__booking__receiving_day__gte=start_date, 
-          session__booking__receiving_day__lte=end_date) |
-        Q(session__treatment_request__created_at__date__gte=start_date, 
-          session__treatment_request__created_at__date__lte=end_date)
-    )
-    
-    # ---- 3) Query SessionTechicalSetting với các điều kiện
-    base_sts = (STS.objects
-                .select_related('techical_setting', 'expert')
-                .filter(
-                    has_come=True,  # Chỉ tính kỹ thuật đã thực hiện
-                    expert__isnull=False,  # Phải có expert
-                    expert__type='employee'  # Chỉ tính cho employee
-                )
-                .filter(time_q))
+    # ---- 2) Thống kê từ bảng tổng hợp TechniqueExecutionDaily (1 query GROUP BY expert)
+    hrs = list(hq)
+    stats_map: Dict[int, Dict] = technique_daily.expert_totals(start_date, end_date, [hr.id for hr in hrs])
     
-    # ---- Filter STS by search if provided ----
-    if search:
-        base_sts = base_sts.filter(
-            Q(expert__full_name__icontains=search) |
-            Q(expert__code__icontains=search) |
-            Q(expert__email__icontains=search)
-        )
-    
-    # ---- 4) Nhóm theo expert và tính thống kê
-    grouped = (
-        base_sts.values('expert_id')
-        .annotate(
-            # Đếm số lượt theo loại kỹ thuật
-            count_tlcb=Count('id', filter=Q(techical_setting__type='TLCB')),
-            count_tlds=Count('id', filter=Q(techical_setting__type='TLDS')),
-            
-            # Tổng tiền từ giá kỹ thuật đã thực hiện
-            amount=Coalesce(
-                Sum('techical_setting__price', output_field=DEC),
-                Value(0, output_field=DEC)
-            ),
-            
-            # Tổng số lượt thực hiện (tất cả loại)
-            total_count=Count('id'),
-        )
-    )
-    
-    # ---- 5) Tạo map thống kê theo HR ID
-    stats_map: Dict[int, Dict] = {}
-    for row in grouped:
-        hr_id = row['expert_id']
-        if hr_id is None:
-            continue
-            
-        stats_map[hr_id] = {
-            'count_tlcb': row['count_tlcb'] or 0,
-            'count_tlds': row['count_tlds'] or 0,
-            'total_count': row['total_count'] or 0,
-            'amount': row['amount'] or Decimal('0'),
-        }
-    
-    # ---- 6) Tạo kết quả cuối cùng
+    # ---- 3) Tạo kết quả cuối cùng
     out = []
-    for hr in hq:
-        pos = hr.position
-        coeff = float(pos.performance_coefficient) if pos and pos.performance_coefficient else 1.0
-        
-        # Lấy thống kê cho HR này, mặc định = 0 nếu không có
-        s = stats_map.get(hr.id, {
-            'count_tlcb': 0, 
-            'count_tlds': 0, 
-            'total_count': 0,
-            'amount': Decimal('0')
-        })
-        
-        # Tính lương = hệ số * tổng tiền kỹ thuật
-        salary = (Decimal(str(coeff)) * (s['amount'] or Decimal('0'))).quantize(Decimal('0.01'))
-        
-        out.append({
-            "hr_id": hr.id,
-            "employee_code": hr.code,
-            "full_name": hr.full_name,
-            "position": pos.title if pos else None,
-            "contract": hr.get_contract_type_display() if hr.contract_type else None,
-            "coefficient": coeff,
-            "count_tlcb": s['count_tlcb'],
-            "count_tlds": s['count_tlds'],
-            "total_count": s['total_count'],
-            "total_amount": str(s['amount']),
-            "salary": str(salary),
-        })
+    for hr in hrs:
+        row = payroll_line(hr, stats_map.get(hr.id, EMPTY_STATS))
+        row["total_amount"] = str(row["total_amount"])
+        row["salary"] = str(row["salary"])
+        out.append(row)
     
     # ---- Sort results by name for better UX ----
     out.sort(key=lambda x: (x['full_name'] or '').lower())
@@ -142,58 +142,52 @@ def get_performance_payroll(
 
 def get_expert_technique_detail(expert_id: int, start_date, end_date, technique_type: Optional[str] = None):
     """
-    Chi tiết kỹ thuật thực hiện của một expert trong khoảng thời gian.
+    Chi tiết kỹ thuật thực hiện của một expert trong khoảng thời gian (đọc TechniqueExecutionDaily).
+    Khoảng thời gian đúng 1 tháng đã chốt -> technique_price lấy giá lúc chốt (PayrollRunPrice).
     
     Returns:
-    - Danh sách các buổi với kỹ thuật đã thực hiện
-    - Nhóm theo khách hàng và ngày
+    - Danh sách dòng (khách, ngày, kỹ thuật) kèm số lượt thực hiện
+    - Sắp theo tên khách, ngày giảm dần, tên kỹ thuật
     """
-    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
-    
-    time_q = (
-        Q(session__booking__receiving_day__gte=start_date, 
-          session__booking__receiving_day__lte=end_date) |
-        Q(session__treatment_request__created_at__date__gte=start_date, 
-          session__treatment_request__created_at__date__lte=end_date)
-    )
-    
-    base = (STS.objects
-            .select_related(
-                'session__booking__customer',
-                'session__treatment_request__customer', 
-                'techical_setting',
-                'expert'
-            )
-            .filter(
-                has_come=True,
-                expert_id=expert_id,
-            )
-            .filter(time_q))
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    Customer = apps.get_model('app_customer', 'Customer')
+    TechicalSetting = apps.get_model('app_product', 'TechicalSetting')
+    PayrollRunPrice = apps.get_model('app_treatment', 'PayrollRunPrice')
     
+    base = TechniqueExecutionDaily.objects.filter(expert_id=expert_id, day__gte=start_date, day__lte=end_date)
     if technique_type in ("TLCB", "TLDS"):
-        base = base.filter(techical_setting__type=technique_type)
+        base = base.filter(ttype=technique_type)
     
-    # Group by customer, date, technique
-    rows = (
-        base.values(
-            'session__booking__customer_id',
-            'session__booking__customer__name',
-            'session__booking__customer__code',
-            'session__booking__receiving_day',
-            'session__treatment_request__created_at__date',
-            'techical_setting__id',
-            'techical_setting__name',
-            'techical_setting__type',
-            'techical_setting__price',
-        )
-        .annotate(
-            execution_count=Count('id')  # Số lần thực hiện kỹ thuật này trong ngày
-        )
-        .order_by(
-            'session__booking__customer__name',
-            '-session__booking__receiving_day',
-            'techical_setting__name'
-        )
+    rows = list(
+        base.values('customer_id', 'day', 'techical_setting_id', 'ttype')
+        .annotate(execution_count=Sum('execution_count'))
+        .order_by()
     )
+    customers = Customer.objects.only('id', 'name', 'code').in_bulk({r['customer_id'] for r in rows})
+    techniques = TechicalSetting.objects.only('id', 'name', 'price').in_bulk({r['techical_setting_id'] for r in rows})
+    frozen = {}
+    period = closed_period_of(start_date, end_date)
+    if period and rows:
+        frozen = dict(PayrollRunPrice.objects
+                      .filter(run__period=period, techical_setting_id__in={r['techical_setting_id'] for r in rows})
+                      .values_list('techical_setting_id', 'price'))
     
-    return list(rows)
\ No newline at end of file
+    out = []
+    for r in rows:
+        c = customers.get(r['customer_id'])
+        t = techniques.get(r['techical_setting_id'])
+        price = frozen.get(r['techical_setting_id'], t.price if t else None)
+        out.append({
+            'customer_id': c.id if c else None,
+            'customer_name': c.name if c else None,
+            'customer_code': c.code if c else None,
+            'day': r['day'],
+            'techical_setting_id': r['techical_setting_id'],
+            'technique_name': t.name if t else None,
+            'technique_type': r['ttype'] or None,
+            'technique_price': price,
+            'execution_count': r['execution_count'] or 0,
+        })
+    # Cùng thứ tự với bản cũ: tên khách, ngày mới trước, tên kỹ thuật
+    out.sort(key=lambda x: (x['customer_name'] or '', -x['day'].toordinal(), x['technique_name'] or ''))
+    return out
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import technique_daily
+from .ar_periods import month_start, next_month
+from .payroll import EMPTY_STATS, payroll_line
+
+ZERO = Decimal('0')
+
+
+@transaction.atomic
+def close_period(period: date, closed_by=None):
+    """
+    Chốt lương hiệu suất 1 tháng: tính lại TechniqueExecutionDaily của tháng, tính toàn bộ dòng lương
+    1 lần rồi ghi PayrollLine (kèm hệ số) + PayrollRunPrice (giá kỹ thuật đã dùng).
+    Chốt lại kỳ đã chốt thì ghi đè snapshot cũ và ghi người / lúc chốt lại vào recomputed_by / recomputed_at
+    (closed_by / closed_at của lần chốt đầu giữ nguyên). Trả về PayrollRun.
+    """
+    Hr = apps.get_model('app_hr', 'HrUserProfile')
+    TechicalSetting = apps.get_model('app_product', 'TechicalSetting')
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    PayrollRun = apps.get_model('app_treatment', 'PayrollRun')
+    PayrollLine = apps.get_model('app_treatment', 'PayrollLine')
+    PayrollRunPrice = apps.get_model('app_treatment', 'PayrollRunPrice')
+
+    period = month_start(period)
+    start, end = period, next_month(period) - timedelta(days=1)
+    technique_daily.rebuild(start, end)
+
+    hrs = list(Hr.objects.select_related('position').filter(type="employee"))
+    stats = technique_daily.expert_totals(start, end, [hr.id for hr in hrs])
+    ts_ids = set(TechniqueExecutionDaily.objects
+                 .filter(day__gte=start, day__lte=end)
+                 .values_list('techical_setting_id', flat=True)
+                 .distinct())
+    techniques = TechicalSetting.objects.only('id', 'type', 'price').in_bulk(ts_ids)
+
+    run, created = PayrollRun.objects.select_for_update().get_or_create(period=period,
+                                                                       defaults={'closed_by': closed_by})
+    lines = []
+    for hr in hrs:
+        row = payroll_line(hr, stats.get(hr.id, EMPTY_STATS))
+        pos = hr.position
+        lines.append(PayrollLine(
+            run=run, hr_type=hr.type or '', email=hr.email,
+            department_id=(pos.department_id if pos else None) or 0, **row,
+        ))
+    prices = [PayrollRunPrice(run=run, techical_setting_id=t.id, ttype=t.type or '', price=t.price or ZERO)
+              for t in techniques.values()]
+
+    PayrollLine.objects.filter(run=run).delete()
+    PayrollRunPrice.objects.filter(run=run).delete()
+    PayrollLine.objects.bulk_create(lines, batch_size=1000)
+    PayrollRunPrice.objects.bulk_create(prices, batch_size=1000)
+    run.line_count = len(lines)
+    run.total_salary = sum((ln.salary for ln in lines), ZERO)
+    update_fields = ['line_count', 'total_salary']
+    if not created:
+        run.recomputed_by = closed_by
+        run.recomputed_at = timezone.now()
+        run.recompute_count = F('recompute_count') + 1
+        update_fields += ['recomputed_by', 'recomputed_at', 'recompute_count']
+    run.save(update_fields=update_fields)
+    if not created:
+        run.refresh_from_db(fields=['recompute_count'])
+    return run
+
+
+def reopen_from(period: date) -> int:
+    """Mở lại các kỳ lương từ tháng `period` (bảng lương quay về tính trực tiếp); trả số kỳ đã mở."""
+    PayrollRun = apps.get_model('app_treatment', 'PayrollRun')
+    _, per_model = PayrollRun.objects.filter(period__gte=month_start(period)).delete()
+    return per_model.get(PayrollRun._meta.label, 0)
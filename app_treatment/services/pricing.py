@@ -0,0 +1,175 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from decimal import Decimal
+from collections import defaultdict
+from django.apps import apps
+from django.db.models import F, Sum, DecimalField
+
+DEC = DecimalField(max_digits=25, decimal_places=2)
+ZERO = Decimal('0')
+
+# Discount.type: chấp nhận cả cách viết cũ
+PERCENT_TYPES = ('percentage', 'percent')
+FIXED_TYPES = ('fixed', 'amount')
+
+
+class PriceBreakdown(NamedTuple):
+    original: Decimal       # giá gốc (trước giảm)
+    discount: Decimal       # số tiền được giảm
+    final: Decimal          # giá sau giảm (>= 0)
+    sessions: int = 0       # số buổi của gói (chỉ TreatmentRequest)
+    package_id: Optional[int] = None  # gói dùng để tính giá (chỉ TreatmentRequest)
+
+
+def apply_discount(amount: Decimal, discount) -> Tuple[Decimal, Decimal]:
+    """
+    Áp dụng Discount cho 1 số tiền, dùng chung cho phác đồ / dịch vụ / đơn thuốc.
+    Trả về (số tiền giảm, giá sau giảm), giá sau giảm không âm.
+    """
+    amount = amount or ZERO
+    if discount is None:
+        return ZERO, amount
+    if discount.type in PERCENT_TYPES:
+        final = amount - (amount * Decimal(discount.rate)) / Decimal('100')
+    elif discount.type in FIXED_TYPES:
+        final = amount - Decimal(discount.rate)
+    else:
+        final = amount
+    final = max(final, ZERO)
+    return amount - final, final
+
+
+def _cached_fk(obj, field_name: str):
+    """Trả object FK nếu đã được select_related / gán sẵn, ngược lại None (không query)."""
+    field = obj._meta.get_field(field_name)
+    return field.get_cached_value(obj) if field.is_cached(obj) else None
+
+
+def _price_list(items: List, *, use_selected_package: bool = False) -> List[PriceBreakdown]:
+    """
+    Tính giá cho danh sách TreatmentRequest / ServiceAssign / DoctorProcess (có thể trộn lẫn)
+    với số query cố định:
+      1) Discount còn thiếu (1 lần cho mọi loại)
+      2) diagnosis_service của các ServiceAssign
+      3) TreatmentPackage (số buổi) của các phác đồ
+      4) bảng giá ServiceTreatmentPackage (1 lần cho mọi cặp service/gói)
+      5) Σ(price * quantity) thuốc của các DoctorProcess chưa prefetch 'diagnosis_medicines'
+    Service không có field giá -> không có STP thì giá = 0.
+    """
+    TreatmentRequest = apps.get_model('app_treatment', 'TreatmentRequest')
+    ServiceAssign = apps.get_model('app_treatment', 'ServiceAssign')
+    DoctorProcess = apps.get_model('app_treatment', 'DoctorProcess')
+    DiagnosisService = apps.get_model('app_treatment', 'diagnosis_service')
+    DiagnosisMedicine = apps.get_model('app_treatment', 'diagnosis_medicine')
+    Discount = apps.get_model('app_home', 'Discount')
+    TreatmentPackage = apps.get_model('app_home', 'TreatmentPackage')
+    STP = apps.get_model('app_product', 'ServiceTreatmentPackage')
+
+    trs = [o for o in items if isinstance(o, TreatmentRequest)]
+    assigns = [o for o in items if isinstance(o, ServiceAssign)]
+    dps = [o for o in items if isinstance(o, DoctorProcess)]
+
+    # ---- 1) discount
+    discount_field = {TreatmentRequest: 'discount', ServiceAssign: 'service_discount', DoctorProcess: 'medicine_discount'}
+    discounts = {}
+    missing = set()
+    for obj in items:
+        name = discount_field.get(type(obj))
+        if not name:
+            continue
+        did = getattr(obj, f'{name}_id')
+        if not did:
+            continue
+        cached = _cached_fk(obj, name)
+        if cached is not None:
+            discounts[did] = cached
+        else:
+            missing.add(did)
+    missing -= set(discounts)
+    if missing:
+        discounts.update(Discount.objects.in_bulk(missing))
+
+    # ---- 2) dòng dịch vụ của ServiceAssign
+    lines = []
+    if assigns:
+        lines = list(DiagnosisService.objects
+                     .filter(service_assign_id__in=[a.pk for a in assigns], service_id__isnull=False)
+                     .values('service_assign_id', 'service_id', 'treatment_package_id', 'quantity'))
+
+    # ---- 3) gói của phác đồ
+    def tr_package_id(tr):
+        if tr.treatment_package_id:
+            return tr.treatment_package_id
+        return tr.selected_package_id if use_selected_package else None
+
+    package_sessions = {}
+    pkg_ids = {tr_package_id(tr) for tr in trs} - {None}
+    if pkg_ids:
+        package_sessions = dict(TreatmentPackage.objects.filter(id__in=pkg_ids).values_list('id', 'value'))
+
+    # ---- 4) bảng giá STP
+    pairs = {(tr.service_id, tr_package_id(tr)) for tr in trs if tr.service_id and tr_package_id(tr)}
+    pairs |= {(ln['service_id'], ln['treatment_package_id']) for ln in lines if ln['treatment_package_id']}
+    stp_price = {}
+    if pairs:
+        for sid, pid, price in (STP.objects
+                                .filter(service_id__in={s for s, _ in pairs},
+                                        treatment_package_id__in={p for _, p in pairs})
+                                .values_list('service_id', 'treatment_package_id', 'price')):
+            stp_price[(sid, pid)] = price if price is not None else ZERO
+
+    # ---- 5) tiền thuốc
+    med_totals = {}
+    need_query = []
+    for dp in dps:
+        if 'diagnosis_medicines' in getattr(dp, '_prefetched_objects_cache', {}):
+            med_totals[dp.pk] = sum(
+                ((dm.price or ZERO) * (dm.quantity or 0) for dm in dp.diagnosis_medicines.all()), ZERO
+            )
+        else:
+            need_query.append(dp.pk)
+    if need_query:
+        med_totals.update(
+            DiagnosisMedicine.objects
+            .filter(doctor_process_id__in=need_query)
+            .values('doctor_process_id')
+            .annotate(s=Sum(F('price') * F('quantity'), output_field=DEC))
+            .values_list('doctor_process_id', 's')
+        )
+
+    assign_totals = defaultdict(lambda: ZERO)
+    for ln in lines:
+        unit = stp_price.get((ln['service_id'], ln['treatment_package_id']), ZERO)
+        assign_totals[ln['service_assign_id']] += unit * (ln['quantity'] or 0)
+
+    out = []
+    for obj in items:
+        if isinstance(obj, TreatmentRequest):
+            pid = tr_package_id(obj)
+            original = stp_price.get((obj.service_id, pid), ZERO) if obj.service_id and pid else ZERO
+            disc, final = apply_discount(original, discounts.get(obj.discount_id))
+            out.append(PriceBreakdown(original, disc, final, int(package_sessions.get(pid) or 0), pid))
+        elif isinstance(obj, ServiceAssign):
+            original = assign_totals[obj.pk]
+            disc, final = apply_discount(original, discounts.get(obj.service_discount_id))
+            out.append(PriceBreakdown(original, disc, final))
+        elif isinstance(obj, DoctorProcess):
+            original = med_totals.get(obj.pk) or ZERO
+            disc, final = apply_discount(original, discounts.get(obj.medicine_discount_id))
+            out.append(PriceBreakdown(original, disc, final))
+        else:
+            raise TypeError(f"Không hỗ trợ tính giá cho {type(obj).__name__}")
+    return out
+
+
+def price_items(items: Iterable, *, use_selected_package: bool = False) -> Dict[object, PriceBreakdown]:
+    """
+    Tính giá hàng loạt; trả {instance: PriceBreakdown}.
+    use_selected_package=True: phác đồ chưa có treatment_package thì dùng selected_package_id.
+    """
+    items = list(items)
+    return dict(zip(items, _price_list(items, use_selected_package=use_selected_package)))
+
+
+def price_of(obj, *, use_selected_package: bool = False) -> PriceBreakdown:
+    """Tính giá cho 1 object (kể cả chưa lưu)."""
+    return _price_list([obj], use_selected_package=use_selected_package)[0]
@@ -0,0 +1,144 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+
+from .revenue_daily import referral_dims
+
+ZERO = Decimal('0')
+KIND_FIELDS = {'hr': 'ref_hr_id', 'actor': 'ref_actor_id'}
+
+Ref = Tuple[str, int]   # (ref_kind, ref_id)
+
+
+def referrer(dims) -> Optional[Ref]:
+    """(kind, id) người giới thiệu từ chiều referral_dims; None nếu không phải CTV / actor."""
+    ref_type, hr_id, actor_id, _ = dims
+    if ref_type == 'hr' and hr_id:
+        return 'hr', hr_id
+    if ref_type == 'actor' and actor_id:
+        return 'actor', actor_id
+    return None
+
+
+def _apply(deltas: Dict[Tuple[str, int, date], Tuple[int, int, Decimal]]):
+    ReferralAttribution = apps.get_model('app_treatment', 'ReferralAttribution')
+    for (kind, ref_id, day), (customers, invoices, revenue) in deltas.items():
+        if not (customers or invoices or revenue):
+            continue
+        row, _ = ReferralAttribution.objects.get_or_create(ref_kind=kind, ref_id=ref_id, day=day)
+        ReferralAttribution.objects.filter(pk=row.pk).update(
+            customers=F('customers') + customers,
+            invoices=F('invoices') + invoices,
+            revenue=F('revenue') + revenue,
+        )
+
+
+def _add(rows: Iterable[Tuple[int, date, int, Decimal]]):
+    """rows: (customer_id, ngày, số hoá đơn, doanh thu) -> cộng vào người giới thiệu hiện tại của khách."""
+    rows = [r for r in rows if r[0]]
+    if not rows:
+        return
+    dims = referral_dims({r[0] for r in rows})
+    deltas = defaultdict(lambda: (0, 0, ZERO))
+    for customer_id, day, invoices, revenue in rows:
+        ref = referrer(dims[customer_id])
+        if ref is None:
+            continue
+        c, i, r = deltas[(*ref, day)]
+        deltas[(*ref, day)] = (c, i + invoices, r + revenue)
+    _apply(deltas)
+
+
+@transaction.atomic
+def add_payments(payments, sign: int = 1) -> None:
+    """Cộng (sign=1, vừa tạo) / trừ (sign=-1, sắp xoá) doanh thu các PaymentHistory vào người giới thiệu của khách."""
+    _add((p.customer_id, p.created.date(), 0, sign * (p.paid_amount or ZERO)) for p in payments)
+
+
+@transaction.atomic
+def add_ar_item(ar_item, sign: int = 1) -> None:
+    """ARItem vừa tạo (sign=1) / vừa xoá (sign=-1): +-1 hoá đơn cho người giới thiệu của khách."""
+    _add([(ar_item.customer_id, ar_item.created.date(), sign, ZERO)])
+
+
+def _grouped(model, ref_field: str, ids, day_field: str, agg):
+    return (model.objects
+            .filter(**{f'{ref_field}__in': ids})
+            .annotate(day=TruncDate(day_field))
+            .values(ref_field, 'day')
+            .annotate(v=agg)
+            .order_by()
+            .values_list(ref_field, 'day', 'v'))
+
+
+@transaction.atomic
+def refresh_referrers(refs: Iterable[Optional[Ref]]) -> int:
+    """Tính lại toàn bộ dòng của các người giới thiệu (Referral đổi / xoá): xoá + 3 query GROUP BY mỗi loại."""
+    Referral = apps.get_model('app_customer', 'Referral')
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ReferralAttribution = apps.get_model('app_treatment', 'ReferralAttribution')
+
+    by_kind: Dict[str, Set[int]] = defaultdict(set)
+    for ref in refs:
+        if ref:
+            by_kind[ref[0]].add(ref[1])
+    rows = []
+    for kind, ids in by_kind.items():
+        ids = list(ids)
+        field = KIND_FIELDS[kind]
+        ReferralAttribution.objects.filter(ref_kind=kind, ref_id__in=ids).delete()
+        totals = defaultdict(lambda: [0, 0, ZERO])
+        for ref_id, day, n in _grouped(Referral, field, ids, 'created', Count('id')):
+            totals[(ref_id, day)][0] += n
+        for ref_id, day, n in _grouped(ARItem, f'customer__primary_referral__{field}', ids, 'created', Count('id')):
+            totals[(ref_id, day)][1] += n
+        for ref_id, day, s in _grouped(PaymentHistory, f'customer__primary_referral__{field}', ids, 'created',
+                                       Sum('paid_amount')):
+            totals[(ref_id, day)][2] += s or ZERO
+        rows += [ReferralAttribution(ref_kind=kind, ref_id=ref_id, day=day,
+                                     customers=c, invoices=i, revenue=r)
+                 for (ref_id, day), (c, i, r) in totals.items()]
+    ReferralAttribution.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def rebuild() -> int:
+    """Tính lại toàn bộ ReferralAttribution; trả số dòng."""
+    Referral = apps.get_model('app_customer', 'Referral')
+    ReferralAttribution = apps.get_model('app_treatment', 'ReferralAttribution')
+    refs = {('hr', i) for i in Referral.objects.filter(ref_hr__isnull=False).values_list('ref_hr_id', flat=True)}
+    refs |= {('actor', i) for i in Referral.objects.filter(ref_actor__isnull=False).values_list('ref_actor_id', flat=True)}
+    with transaction.atomic():
+        ReferralAttribution.objects.all().delete()
+        return refresh_referrers(refs)
+
+
+def referrer_totals(kind: str, ids: Iterable[int], start: Optional[date] = None,
+                    end: Optional[date] = None) -> Dict[int, Dict]:
+    """
+    {ref_id: {customers, invoices, revenue}} (1 query): khách / hoá đơn tính toàn bộ thời gian,
+    doanh thu trong [start, end] (bỏ trống = toàn bộ) — như báo cáo CTV / actor cũ.
+    """
+    ReferralAttribution = apps.get_model('app_treatment', 'ReferralAttribution')
+    window = Q()
+    if start:
+        window &= Q(day__gte=start)
+    if end:
+        window &= Q(day__lte=end)
+    rows = (ReferralAttribution.objects
+            .filter(ref_kind=kind, ref_id__in=list(ids))
+            .values('ref_id')
+            .annotate(customers=Sum('customers'), invoices=Sum('invoices'),
+                      revenue=Sum('revenue', filter=window) if window else Sum('revenue'))
+            .order_by())
+    return {r['ref_id']: {
+        'customers': r['customers'] or 0,
+        'invoices': r['invoices'] or 0,
+        'revenue': r['revenue'] or ZERO,
+    } for r in rows}
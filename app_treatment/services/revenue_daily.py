@@ -0,0 +1,132 @@
+from typing import Dict, Iterable, Optional, Tuple
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+
+from .ar_periods import day_start
+
+ZERO = Decimal('0')
+UNKNOWN = ('unknown', 0, 0, 0)   # (ref_type, ref_hr_id, ref_actor_id, lead_source_id)
+
+DIMENSIONS = ('day', 'paid_method', 'source_ct_id', 'lead_source_id', 'ref_type', 'ref_hr_id', 'ref_actor_id')
+
+
+def referral_dims(customer_ids: Iterable[int]) -> Dict[int, Tuple[str, int, int, int]]:
+    """{customer_id: (ref_type, ref_hr_id, ref_actor_id, lead_source_id)} theo Referral hiện tại."""
+    Referral = apps.get_model('app_customer', 'Referral')
+    out = {cid: UNKNOWN for cid in customer_ids if cid}
+    for cid, ref_type, hr_id, actor_id, source_id in (
+            Referral.objects
+            .filter(customer_id__in=list(out))
+            .values_list('customer_id', 'ref_type', 'ref_hr_id', 'ref_actor_id', 'ref_actor__source_id')):
+        out[cid] = (ref_type or 'unknown', hr_id or 0, actor_id or 0, source_id or 0)
+    return out
+
+
+def _key(day: date, paid_method: str, source_ct_id: Optional[int], dims) -> Tuple:
+    ref_type, hr_id, actor_id, source_id = dims
+    return (day, paid_method, source_ct_id or 0, source_id, ref_type, hr_id, actor_id)
+
+
+def _apply(deltas: Dict[Tuple, Tuple[Decimal, int]]):
+    RevenueDaily = apps.get_model('app_treatment', 'RevenueDaily')
+    for key, (amount, count) in deltas.items():
+        if not amount and not count:
+            continue
+        row, _ = RevenueDaily.objects.get_or_create(**dict(zip(DIMENSIONS, key)))
+        RevenueDaily.objects.filter(pk=row.pk).update(
+            amount=F('amount') + amount,
+            payment_count=F('payment_count') + count,
+        )
+
+
+@transaction.atomic
+def add_payments(payments, sign: int = 1) -> None:
+    """
+    Cộng các PaymentHistory vừa tạo (sign=1) / sắp xoá (sign=-1) vào RevenueDaily
+    (số query theo số dòng rollup bị chạm, không theo số payment).
+    """
+    ARItem = apps.get_model('app_treatment', 'ARItem')
+    payments = [p for p in payments if p.customer_id]
+    if not payments:
+        return
+    ct_by_ar = dict(ARItem.objects
+                    .filter(id__in={p.ar_item_id for p in payments if p.ar_item_id})
+                    .values_list('id', 'content_type_id'))
+    dims = referral_dims({p.customer_id for p in payments})
+
+    deltas = defaultdict(lambda: (ZERO, 0))
+    for p in payments:
+        key = _key(p.created.date(), p.paid_method, ct_by_ar.get(p.ar_item_id), dims[p.customer_id])
+        amount, count = deltas[key]
+        deltas[key] = (amount + sign * (p.paid_amount or ZERO), count + sign)
+    _apply(deltas)
+
+
+@transaction.atomic
+def move_customer(customer_id: int, old_dims, new_dims) -> None:
+    """Referral của khách đổi -> chuyển toàn bộ doanh thu của khách sang chiều giới thiệu mới."""
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    if not customer_id or old_dims == new_dims:
+        return
+    deltas = defaultdict(lambda: (ZERO, 0))
+    for r in (PaymentHistory.objects
+              .filter(customer_id=customer_id)
+              .annotate(day=TruncDate('created'))
+              .values('day', 'paid_method', 'ar_item__content_type_id')
+              .annotate(s=Sum('paid_amount'), n=Count('id'))
+              .order_by()):
+        for dims, sign in ((old_dims, -1), (new_dims, 1)):
+            key = _key(r['day'], r['paid_method'], r['ar_item__content_type_id'], dims)
+            amount, count = deltas[key]
+            deltas[key] = (amount + sign * (r['s'] or ZERO), count + sign * r['n'])
+    _apply(deltas)
+
+
+@transaction.atomic
+def rebuild(start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """Tính lại RevenueDaily từ PaymentHistory cho [start, end] (bỏ trống = toàn bộ); trả số dòng."""
+    RevenueDaily = apps.get_model('app_treatment', 'RevenueDaily')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    pays = PaymentHistory.objects.all()
+    rows = RevenueDaily.objects.all()
+    if start:
+        pays = pays.filter(created__gte=day_start(start))
+        rows = rows.filter(day__gte=start)
+    if end:
+        pays = pays.filter(created__lt=day_start(end + timedelta(days=1)))
+        rows = rows.filter(day__lte=end)
+    rows.delete()
+
+    grouped = list(pays
+                   .annotate(day=TruncDate('created'))
+                   .values('day', 'paid_method', 'customer_id', 'ar_item__content_type_id')
+                   .annotate(s=Sum('paid_amount'), n=Count('id'))
+                   .order_by())
+    dims = referral_dims({r['customer_id'] for r in grouped})
+
+    totals = defaultdict(lambda: (ZERO, 0))
+    for r in grouped:
+        key = _key(r['day'], r['paid_method'], r['ar_item__content_type_id'], dims.get(r['customer_id'], UNKNOWN))
+        amount, count = totals[key]
+        totals[key] = (amount + (r['s'] or ZERO), count + r['n'])
+
+    RevenueDaily.objects.bulk_create(
+        [RevenueDaily(amount=amount, payment_count=count, **dict(zip(DIMENSIONS, key)))
+         for key, (amount, count) in totals.items()],
+        batch_size=1000,
+    )
+    return len(totals)
+
+
+def move_actor(actor_id: int, lead_source_id: Optional[int]) -> int:
+    """Actor đổi LeadSource -> cập nhật chiều lead_source cho các dòng của actor."""
+    RevenueDaily = apps.get_model('app_treatment', 'RevenueDaily')
+    return (RevenueDaily.objects
+            .filter(ref_actor_id=actor_id)
+            .exclude(lead_source_id=lead_source_id or 0)
+            .update(lead_source_id=lead_source_id or 0))
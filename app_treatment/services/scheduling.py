@@ -0,0 +1,204 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from collections import defaultdict
+from datetime import date, time
+from threading import Lock
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .commit_batch import on_commit_batch
+
+# Giờ làm việc & bước gợi ý slot (phút); cấu hình được trong settings
+OPEN_TIME = getattr(settings, 'CLINIC_OPEN_TIME', time(8, 0))
+CLOSE_TIME = getattr(settings, 'CLINIC_CLOSE_TIME', time(20, 0))
+SLOT_STEP = getattr(settings, 'SCHEDULE_SLOT_STEP_MINUTES', 5)
+
+_VERSION_KEY = 'app_treatment.schedule.v.{}'
+MAX_CACHED_DAYS = 62
+
+
+class Interval(NamedTuple):
+    start: int              # phút tính từ 00:00
+    end: int
+    item_id: int            # SessionTechicalSetting.id
+    session_id: int
+    customer_id: Optional[int]
+
+
+def minutes(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def hhmm(m: int) -> str:
+    return f"{m // 60:02d}:{m % 60:02d}"
+
+
+class DaySchedule:
+    """
+    Chỉ mục khoảng thời gian của 1 ngày theo chuyên gia và theo phòng, mỗi danh sách sắp theo giờ bắt đầu.
+    Các kỹ thuật của 1 buổi nối tiếp nhau từ giờ hẹn của Booking (theo thứ tự id).
+    """
+    def __init__(self, day: date, by_expert: Dict[int, List[Interval]], by_room: Dict[str, List[Interval]]):
+        self.day = day
+        self.by_expert = by_expert
+        self.by_room = by_room
+
+    @classmethod
+    def build(cls, day: date) -> 'DaySchedule':
+        SessionTechicalSetting = apps.get_model('app_treatment', 'SessionTechicalSetting')
+        rows = (SessionTechicalSetting.objects
+                .filter(session__booking__receiving_day=day, session__booking__set_date__isnull=False)
+                .order_by('session_id', 'id')
+                .values_list('id', 'session_id', 'expert_id', 'room', 'duration_minutes',
+                             'session__booking__set_date', 'session__booking__customer_id'))
+        by_expert, by_room = defaultdict(list), defaultdict(list)
+        cursor = {}
+        for item_id, session_id, expert_id, room, duration, set_date, customer_id in rows:
+            start = cursor.get(session_id, minutes(set_date))
+            end = start + (duration or 0)
+            cursor[session_id] = end
+            iv = Interval(start, end, item_id, session_id, customer_id)
+            if expert_id:
+                by_expert[expert_id].append(iv)
+            if room:
+                by_room[room].append(iv)
+        for lst in list(by_expert.values()) + list(by_room.values()):
+            lst.sort()
+        return cls(day, dict(by_expert), dict(by_room))
+
+    # ---- truy vấn
+    @staticmethod
+    def _overlaps(intervals: List[Interval]) -> List[Tuple[Interval, Interval]]:
+        """Các cặp chồng giờ trong 1 danh sách đã sắp (quét 1 lượt, giữ các khoảng đang mở)."""
+        out, active = [], []
+        for iv in intervals:
+            active = [a for a in active if a.end > iv.start]
+            out.extend((a, iv) for a in active)
+            active.append(iv)
+        return out
+
+    def conflicts(self, expert_id: Optional[int] = None, room: Optional[str] = None) -> Dict[str, list]:
+        """Trùng lịch theo chuyên gia / phòng; truyền expert_id hoặc room thì chỉ xét đối tượng đó."""
+        if expert_id or room:
+            experts = {expert_id: self.by_expert.get(expert_id, [])} if expert_id else {}
+            rooms = {room: self.by_room.get(room, [])} if room else {}
+        else:
+            experts, rooms = self.by_expert, self.by_room
+        return {
+            'experts': [(k, a, b) for k, lst in experts.items() for a, b in self._overlaps(lst)],
+            'rooms': [(k, a, b) for k, lst in rooms.items() for a, b in self._overlaps(lst)],
+        }
+
+    @staticmethod
+    def _free(intervals: Iterable[Interval], open_m: int, close_m: int) -> List[Tuple[int, int]]:
+        gaps, cur = [], open_m
+        for iv in intervals:
+            if iv.start > cur:
+                gaps.append((cur, min(iv.start, close_m)))
+            cur = max(cur, iv.end)
+            if cur >= close_m:
+                break
+        if cur < close_m:
+            gaps.append((cur, close_m))
+        return [(s, e) for s, e in gaps if e > s]
+
+    def free_gaps(self, *, expert_id: Optional[int] = None, room: Optional[str] = None,
+                  open_time: time = OPEN_TIME, close_time: time = CLOSE_TIME) -> List[Tuple[int, int]]:
+        """Khoảng trống chung của chuyên gia (và/hoặc phòng) trong giờ làm việc."""
+        busy = []
+        if expert_id:
+            busy += self.by_expert.get(expert_id, [])
+        if room:
+            busy += self.by_room.get(room, [])
+        return self._free(sorted(busy), minutes(open_time), minutes(close_time))
+
+    def available_starts(self, duration: int, *, expert_id: Optional[int] = None, room: Optional[str] = None,
+                         open_time: time = OPEN_TIME, close_time: time = CLOSE_TIME,
+                         step: int = SLOT_STEP) -> List[Tuple[int, int]]:
+        """Các khoảng trống đủ dài cho duration phút, kèm giờ bắt đầu làm tròn theo step."""
+        out = []
+        for s, e in self.free_gaps(expert_id=expert_id, room=room, open_time=open_time, close_time=close_time):
+            start = -(-s // step) * step
+            if start + duration <= e:
+                out.append((start, e))
+        return out
+
+
+# ---- chỉ mục trong bộ nhớ tiến trình, vô hiệu hoá theo version lưu ở cache (dùng chung khi cache là Redis/Memcached)
+_INDEX: Dict[date, Tuple[int, DaySchedule]] = {}
+_LOCK = Lock()
+
+
+def _version(day: date) -> int:
+    return cache.get(_VERSION_KEY.format(day.isoformat()), 0)
+
+
+def invalidate(days: Iterable[Optional[date]]) -> None:
+    """
+    Gọi sau khi ghi Booking / buổi / kỹ thuật làm đổi lịch của các ngày này.
+    Tăng version ngay và tăng lần nữa khi commit, để tiến trình khác không giữ chỉ mục dựng từ dữ liệu chưa commit.
+    """
+    days = {d for d in days if d}
+    if not days:
+        return
+    _bump(days)
+    transaction.on_commit(lambda: _bump(days))
+
+
+def _bump(days) -> None:
+    for day in days:
+        key = _VERSION_KEY.format(day.isoformat())
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+        with _LOCK:
+            _INDEX.pop(day, None)
+
+
+def day_schedule(day: date) -> DaySchedule:
+    """Chỉ mục của ngày; dựng lại (1 query) khi chưa có hoặc version đã đổi."""
+    version = _version(day)
+    cached = _INDEX.get(day)
+    if cached and cached[0] == version:
+        return cached[1]
+    schedule = DaySchedule.build(day)
+    with _LOCK:
+        if len(_INDEX) >= MAX_CACHED_DAYS:
+            _INDEX.clear()
+        _INDEX[day] = (version, schedule)
+    return schedule
+
+
+def days_for(*, session_ids: Iterable[int] = (), booking_ids: Iterable[int] = ()) -> set:
+    """Ngày hẹn của các buổi / booking (1 query)."""
+    Booking = apps.get_model('app_treatment', 'Booking')
+    session_ids = [i for i in session_ids if i]
+    booking_ids = [i for i in booking_ids if i]
+    if not (session_ids or booking_ids):
+        return set()
+    return set(Booking.objects
+               .filter(Q(treatmentsession__id__in=session_ids) | Q(id__in=booking_ids))
+               .values_list('receiving_day', flat=True))
+
+
+class _PendingRefs:
+    """Buổi / booking bị sửa trong transaction; quy ra ngày bằng 1 query lúc commit."""
+    def __init__(self):
+        self.session_ids = set()
+        self.booking_ids = set()
+
+    def __call__(self):
+        invalidate(days_for(session_ids=self.session_ids, booking_ids=self.booking_ids))
+
+
+def invalidate_refs(*, session_ids: Iterable[int] = (), booking_ids: Iterable[int] = ()) -> None:
+    """Như invalidate() nhưng theo id buổi / booking, gom theo transaction (dùng trong signal từng dòng)."""
+    pending = on_commit_batch(_PendingRefs)
+    if pending is None:
+        invalidate(days_for(session_ids=session_ids, booking_ids=booking_ids))
+        return
+    pending.session_ids.update(i for i in session_ids if i)
+    pending.booking_ids.update(i for i in booking_ids if i)
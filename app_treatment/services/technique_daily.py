@@ -0,0 +1,172 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+
+from .commit_batch import on_commit_batch
+
+ZERO = Decimal('0')
+
+Cell = Tuple[int, date]   # (expert_id, ngày)
+
+
+def execution_day(prefix: str = ''):
+    """Ngày thực hiện: ngày hẹn của buổi, buổi chưa có lịch thì ngày tạo phác đồ."""
+    return Coalesce(f'{prefix}booking__receiving_day', TruncDate(f'{prefix}treatment_request__created_at'))
+
+
+def _executions():
+    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    return (STS.objects
+            .filter(has_come=True, expert__isnull=False)
+            .annotate(exec_day=execution_day('session__'),
+                      exec_customer=Coalesce('session__booking__customer_id',
+                                             'session__treatment_request__customer_id', Value(0),
+                                             output_field=IntegerField())))
+
+
+def _cells_q(cells: Set[Cell], expert_field: str, day_field: str) -> Q:
+    by_expert = defaultdict(set)
+    for expert_id, day in cells:
+        by_expert[expert_id].add(day)
+    q = Q()
+    for expert_id, days in by_expert.items():
+        q |= Q(**{expert_field: expert_id, f'{day_field}__in': days})
+    return q
+
+
+def _grouped(executions):
+    return (executions
+            .values('expert_id', 'exec_day', 'exec_customer', 'techical_setting_id', 'techical_setting__type')
+            .annotate(n=Count('id'), s=Sum('techical_setting__price'))
+            .order_by())
+
+
+def _facts(grouped):
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    return [TechniqueExecutionDaily(
+        day=r['exec_day'], expert_id=r['expert_id'], ttype=r['techical_setting__type'] or '',
+        customer_id=r['exec_customer'] or 0, techical_setting_id=r['techical_setting_id'],
+        execution_count=r['n'], amount=r['s'] or ZERO,
+    ) for r in grouped if r['exec_day']]
+
+
+def execution_refs(*, session_ids: Iterable[int] = (), request_ids: Iterable[int] = (),
+                   booking_ids: Iterable[int] = ()) -> Set[Tuple[int, int, date]]:
+    """(expert_id, session_id, ngày) của các lượt đã thực hiện trong các buổi / phác đồ / booking này (1 query)."""
+    cond = Q()
+    for field, ids in (('session_id', session_ids), ('session__treatment_request_id', request_ids),
+                       ('session__booking_id', booking_ids)):
+        ids = [i for i in ids if i]
+        if ids:
+            cond |= Q(**{f'{field}__in': ids})
+    if not cond:
+        return set()
+    return set(_executions().filter(cond).values_list('expert_id', 'session_id', 'exec_day').distinct())
+
+
+def cells_for(**refs) -> Set[Cell]:
+    """Các ô (expert, ngày) hiện có lượt đã thực hiện (cùng tham số với execution_refs)."""
+    return {(e, d) for e, _, d in execution_refs(**refs) if d}
+
+
+@transaction.atomic
+def refresh(cells: Iterable[Cell]) -> int:
+    """Tính lại toàn bộ dòng của các ô (expert, ngày): xoá + 1 query GROUP BY + bulk_create."""
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    cells = {(e, d) for e, d in cells if e and d}
+    if not cells:
+        return 0
+    TechniqueExecutionDaily.objects.filter(_cells_q(cells, 'expert_id', 'day')).delete()
+    facts = _facts(_grouped(_executions().filter(_cells_q(cells, 'expert_id', 'exec_day'))))
+    TechniqueExecutionDaily.objects.bulk_create(facts, batch_size=1000)
+    return len(facts)
+
+
+def rebuild(start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """Tính lại TechniqueExecutionDaily cho [start, end] (bỏ trống = toàn bộ); trả số dòng."""
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    executions = _executions()
+    rows = TechniqueExecutionDaily.objects.all()
+    if start:
+        executions = executions.filter(exec_day__gte=start)
+        rows = rows.filter(day__gte=start)
+    if end:
+        executions = executions.filter(exec_day__lte=end)
+        rows = rows.filter(day__lte=end)
+    with transaction.atomic():
+        rows.delete()
+        facts = _facts(_grouped(executions))
+        TechniqueExecutionDaily.objects.bulk_create(facts, batch_size=1000)
+    return len(facts)
+
+
+def reprice(techical_setting_id: int, price, ttype: Optional[str]) -> int:
+    """Kỹ thuật đổi giá / loại: tính lại tại chỗ (amount = số lượt * giá hiện tại, như bảng lương cũ)."""
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    return (TechniqueExecutionDaily.objects
+            .filter(techical_setting_id=techical_setting_id)
+            .update(amount=F('execution_count') * (price or ZERO), ttype=ttype or ''))
+
+
+# ---- gom theo transaction: signal từng dòng chỉ ghi nhận, tính 1 lần khi commit
+class _PendingCells:
+    """Ô đã biết + (expert, buổi) quy ra ngày bằng 1 query lúc commit."""
+    def __init__(self):
+        self.cells: Set[Cell] = set()
+        self.session_refs: Set[Tuple[int, int]] = set()
+
+    def __call__(self):
+        cells = set(self.cells)
+        if self.session_refs:
+            TreatmentSession = apps.get_model('app_treatment', 'TreatmentSession')
+            days = dict(TreatmentSession.objects
+                        .filter(id__in={s for _, s in self.session_refs})
+                        .annotate(exec_day=execution_day())
+                        .values_list('id', 'exec_day'))
+            cells |= {(e, days.get(s)) for e, s in self.session_refs}
+        refresh(cells)
+
+
+def mark(*, cells: Iterable[Cell] = (), session_refs: Iterable[Tuple[int, int]] = ()) -> None:
+    """Đánh dấu ô cần tính lại; trong transaction gom lại đến lúc commit, ngoài transaction tính ngay."""
+    cells = {(e, d) for e, d in cells if e and d}
+    session_refs = {(e, s) for e, s in session_refs if e and s}
+    if not (cells or session_refs):
+        return
+    pending = on_commit_batch(_PendingCells)
+    if pending is None:
+        pending = _PendingCells()
+        pending.cells, pending.session_refs = cells, session_refs
+        pending()
+        return
+    pending.cells |= cells
+    pending.session_refs |= session_refs
+
+
+def expert_totals(start: Optional[date], end: Optional[date], expert_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict]:
+    """{expert_id: {count_tlcb, count_tlds, total_count, amount}} trong [start, end] (bỏ trống = không giới hạn; 1 query)."""
+    TechniqueExecutionDaily = apps.get_model('app_treatment', 'TechniqueExecutionDaily')
+    qs = TechniqueExecutionDaily.objects.all()
+    if start:
+        qs = qs.filter(day__gte=start)
+    if end:
+        qs = qs.filter(day__lte=end)
+    if expert_ids is not None:
+        qs = qs.filter(expert_id__in=list(expert_ids))
+    rows = (qs.values('expert_id')
+            .annotate(count_tlcb=Sum('execution_count', filter=Q(ttype='TLCB')),
+                      count_tlds=Sum('execution_count', filter=Q(ttype='TLDS')),
+                      total_count=Sum('execution_count'),
+                      amount=Sum('amount'))
+            .order_by())
+    return {r['expert_id']: {
+        'count_tlcb': r['count_tlcb'] or 0,
+        'count_tlds': r['count_tlds'] or 0,
+        'total_count': r['total_count'] or 0,
+        'amount': r['amount'] or ZERO,
+    } for r in rows}
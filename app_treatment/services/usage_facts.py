@@ -0,0 +1,108 @@
+from typing import Dict, Iterable, Set
+from decimal import Decimal
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from .pricing import price_items
+
+ZERO = Decimal('0')
+CENT = Decimal('0.01')
+
+
+def used_amount(package_price: Decimal, total_sessions: int, used_sessions: int) -> Decimal:
+    """Tiền đã sử dụng = (giá gói / tổng buổi) * số buổi đã thực hiện."""
+    if not package_price or not total_sessions:
+        return ZERO
+    return (package_price / Decimal(total_sessions) * Decimal(used_sessions)).quantize(CENT)
+
+
+def compute_usage_facts(tr_ids: Iterable[int]) -> Dict[int, Dict]:
+    """
+    Tính số liệu sử dụng cho nhiều TreatmentRequest với số query cố định:
+      1) TR (+ discount)
+      2) giá gói qua services.pricing (fallback selected_package_id)
+      3) số buổi đã phát sinh = số buổi có ÍT NHẤT 1 kỹ thuật has_come=True
+      4) tổng đã thanh toán qua ARItem có content_type = TreatmentRequest
+    """
+    TreatmentRequest = apps.get_model('app_treatment', 'TreatmentRequest')
+    SessionTechicalSetting = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    PaymentHistory = apps.get_model('app_treatment', 'PaymentHistory')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    tr_ids = {i for i in tr_ids if i}
+    if not tr_ids:
+        return {}
+
+    trs = list(TreatmentRequest.objects.filter(id__in=tr_ids).select_related('discount'))
+    prices = price_items(trs, use_selected_package=True)
+
+    used = dict(
+        SessionTechicalSetting.objects
+        .filter(session__treatment_request_id__in=tr_ids, has_come=True)
+        .values('session__treatment_request_id')
+        .annotate(cnt=Count('session_id', distinct=True))
+        .values_list('session__treatment_request_id', 'cnt')
+    )
+    ct_tr = ContentType.objects.get_for_model(TreatmentRequest)
+    paid = dict(
+        PaymentHistory.objects
+        .filter(ar_item__content_type=ct_tr, ar_item__object_id__in=tr_ids)
+        .values('ar_item__object_id')
+        .annotate(s=Sum('paid_amount'))
+        .values_list('ar_item__object_id', 's')
+    )
+
+    out = {}
+    for tr in trs:
+        price = prices[tr]
+        used_sessions = int(used.get(tr.id, 0))
+        out[tr.id] = {
+            'customer_id': tr.customer_id,
+            'tr_created_at': tr.created_at,
+            'package_price': price.original,
+            'final_price': price.final,
+            'total_sessions': price.sessions,
+            'used_sessions': used_sessions,
+            'paid_amount': paid.get(tr.id) or ZERO,
+            'used_amount': used_amount(price.original, price.sessions, used_sessions),
+        }
+    return out
+
+
+@transaction.atomic
+def refresh_usage_facts(tr_ids: Iterable[int]) -> int:
+    """Tính lại & ghi TreatmentUsageFact cho các TR truyền vào (TR đã xoá thì bỏ qua)."""
+    TreatmentUsageFact = apps.get_model('app_treatment', 'TreatmentUsageFact')
+    tr_ids = {i for i in tr_ids if i}
+    if not tr_ids:
+        return 0
+    facts = compute_usage_facts(tr_ids)
+    TreatmentUsageFact.objects.filter(treatment_request_id__in=tr_ids).delete()
+    TreatmentUsageFact.objects.bulk_create(
+        [TreatmentUsageFact(treatment_request_id=tr_id, **row) for tr_id, row in facts.items()],
+        batch_size=500,
+    )
+    return len(facts)
+
+
+def trs_for_ar_items(ar_items) -> Set[int]:
+    """TR nguồn của các ARItem (bỏ qua công nợ đơn thuốc / khác)."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TreatmentRequest = apps.get_model('app_treatment', 'TreatmentRequest')
+    ct_tr = ContentType.objects.get_for_model(TreatmentRequest)
+    return {ar.object_id for ar in ar_items if ar is not None and ar.content_type_id == ct_tr.id}
+
+
+def trs_for_pricing_change(*, discount_id=None, package_id=None, service_id=None) -> Set[int]:
+    """TR bị ảnh hưởng khi đổi Discount / TreatmentPackage / bảng giá (service, package)."""
+    TreatmentRequest = apps.get_model('app_treatment', 'TreatmentRequest')
+    cond = Q()
+    if discount_id:
+        cond |= Q(discount_id=discount_id)
+    if package_id:
+        pkg = Q(treatment_package_id=package_id) | Q(treatment_package__isnull=True, selected_package_id=package_id)
+        cond |= (pkg & Q(service_id=service_id)) if service_id else pkg
+    if not cond:
+        return set()
+    return set(TreatmentRequest.objects.filter(cond).values_list('id', flat=True))
@@ -0,0 +1,52 @@
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+
+from .ar_periods import day_range
+
+ZERO = Decimal('0')
+EMPTY = {'total_tlcb': 0, 'total_tlds': 0, 'amount_tlcb': ZERO, 'amount_tlds': ZERO}
+
+# Thống kê của 1 khoảng (start, end) được cache ngần này giây (dùng chung cho mọi trang / bộ lọc user)
+USER_SERVICE_STATS_CACHE_SECONDS = getattr(settings, 'USER_SERVICE_STATS_CACHE_SECONDS', 60)
+_CACHE_KEY = 'app_treatment.user_service_stats.{}.{}'
+
+
+def user_service_stats(start: Optional[date] = None, end: Optional[date] = None) -> Dict[int, Dict]:
+    """
+    {user_id: {total_tlcb, total_tlds, amount_tlcb, amount_tlds}} cho mọi user là expert (qua HrUserProfile.user):
+      total_*  = số lượt kỹ thuật đã thực hiện (has_come) thuộc phác đồ có dịch vụ loại đó
+      amount_* = tổng giá kỹ thuật của các lượt đó
+    Lọc theo ngày tạo phác đồ trong [start, end]; 1 query GROUP BY, cache theo khoảng ngày.
+    """
+    key = _CACHE_KEY.format(start or '', end or '')
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    STS = apps.get_model('app_treatment', 'SessionTechicalSetting')
+    tlcb = Q(session__treatment_request__service__type='TLCB')
+    tlds = Q(session__treatment_request__service__type='TLDS')
+    rows = (STS.objects
+            .filter(has_come=True, expert__user__isnull=False)
+            .filter(day_range('session__treatment_request__created_at', start, end))
+            .filter(tlcb | tlds)
+            .values('expert__user_id')
+            .annotate(total_tlcb=Count('id', filter=tlcb),
+                      total_tlds=Count('id', filter=tlds),
+                      amount_tlcb=Sum('techical_setting__price', filter=tlcb),
+                      amount_tlds=Sum('techical_setting__price', filter=tlds))
+            .order_by())
+    stats = {r['expert__user_id']: {
+        'total_tlcb': r['total_tlcb'],
+        'total_tlds': r['total_tlds'],
+        'amount_tlcb': r['amount_tlcb'] or ZERO,
+        'amount_tlds': r['amount_tlds'] or ZERO,
+    } for r in rows}
+    cache.set(key, stats, USER_SERVICE_STATS_CACHE_SECONDS)
+    return stats
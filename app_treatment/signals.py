@@ -1,39 +1,407 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
 from django.dispatch import receiver
 from django.db.models import Sum
 from decimal import Decimal
 
-from .models import PaymentHistory, TreatmentRequest, TreatmentSession
+from .models import ARItem, Bill, Booking, CustomerBalance, DoctorProcess, PaymentHistory, ServiceAssign, TreatmentRequest, \
+    TreatmentSession, SessionTechicalSetting, diagnosis_medicine, diagnosis_service
+from .services.bill_totals import recompute_bill_totals, customers_for_discount, customers_for_service_price, \
+    customer_for_doctor_process
+from .services.payments import payments_created
+from .services.done_status import mark_dirty
+from .services.usage_facts import refresh_usage_facts, trs_for_ar_items, trs_for_pricing_change
+from .services import referral_attribution, revenue_daily, scheduling, technique_daily
 
-from app_customer.models import Customer  # hoặc nơi chứa model Customer
+from app_home.models import Discount, LeadSourceActor, TreatmentPackage
+from app_product.models import ServiceTreatmentPackage, TechicalSetting
+
+from app_customer.models import Customer, Referral  # hoặc nơi chứa model Customer
 
 @receiver(post_save, sender=TreatmentSession)
 def update_is_done_status(sender, instance, **kwargs):
-    tr = instance.treatment_request
-    # done khi KHÔNG còn session chưa done
-    tr_is_done = not tr.treatment_sessions.filter(is_done=False).exists()
-    if tr.is_done != tr_is_done:
-        tr.is_done = tr_is_done
-        tr.save(update_fields=['is_done'])
+    # phác đồ done khi mọi kỹ thuật của mọi buổi đã has_come; tính khi commit (services.done_status)
+    mark_dirty(requests=[instance.treatment_request_id])
 
 @receiver(post_save, sender=TreatmentRequest)
 def update_customer_status_if_all_requests_done(sender, instance, **kwargs):
-    bill = instance.bill
-    if not bill or not bill.customer_id:
+    # '3' = đã mua xong khi KHÔNG còn phác đồ nào chưa done, '2' = đang mua
+    if not instance.bill_id:
+        return
+    customer_id = Bill.objects.filter(pk=instance.bill_id).values_list("customer_id", flat=True).first()
+    mark_dirty(customers=[customer_id])
+
+# ==============================
+# BillTotals: tính lại trong cùng transaction khi số tiền thay đổi
+# ==============================
+
+@receiver(post_save, sender=DoctorProcess)
+@receiver(post_delete, sender=DoctorProcess)
+def bill_totals_on_doctor_process_change(sender, instance, **kwargs):
+    recompute_bill_totals([instance.customer_id])
+
+
+@receiver(post_save, sender=diagnosis_medicine)
+@receiver(post_delete, sender=diagnosis_medicine)
+def bill_totals_on_medicine_change(sender, instance, **kwargs):
+    recompute_bill_totals([customer_for_doctor_process(instance.doctor_process_id)])
+
+
+@receiver(post_save, sender=ServiceAssign)
+@receiver(post_delete, sender=ServiceAssign)
+def bill_totals_on_service_assign_change(sender, instance, **kwargs):
+    recompute_bill_totals([customer_for_doctor_process(instance.doctor_process_id)])
+
+
+@receiver(post_save, sender=diagnosis_service)
+@receiver(post_delete, sender=diagnosis_service)
+def bill_totals_on_diagnosis_service_change(sender, instance, **kwargs):
+    dp_id = (ServiceAssign.objects
+             .filter(pk=instance.service_assign_id)
+             .values_list('doctor_process_id', flat=True)
+             .first())
+    recompute_bill_totals([customer_for_doctor_process(dp_id)])
+
+
+@receiver(post_save, sender=Discount)
+def bill_totals_on_discount_change(sender, instance, created, **kwargs):
+    if created:
+        return
+    recompute_bill_totals(customers_for_discount(instance.pk))
+
+
+@receiver(pre_delete, sender=Discount)
+def bill_totals_before_discount_delete(sender, instance, **kwargs):
+    # FK SET_NULL chạy trước post_delete -> ghi nhận khách hàng bị ảnh hưởng từ trước
+    instance._bill_totals_customers = customers_for_discount(instance.pk)
+
+
+@receiver(post_delete, sender=Discount)
+def bill_totals_on_discount_delete(sender, instance, **kwargs):
+    recompute_bill_totals(getattr(instance, '_bill_totals_customers', ()))
+
+
+@receiver(post_save, sender=ServiceTreatmentPackage)
+@receiver(post_delete, sender=ServiceTreatmentPackage)
+def bill_totals_on_price_change(sender, instance, **kwargs):
+    # chỉ định dịch vụ được tính theo bảng giá (service, gói)
+    recompute_bill_totals(customers_for_service_price(instance.service_id, instance.treatment_package_id))
+
+
+# ==============================
+# CustomerBalance: cộng dồn chênh lệch bằng F() khi ARItem / Bill / PaymentHistory thay đổi
+# ==============================
+@receiver(post_save, sender=ARItem)
+def balance_on_ar_item_save(sender, instance, created, **kwargs):
+    old = None if created else getattr(instance, "_balance_snapshot", None)
+    new = instance.balance_state()
+    if new is None or (not created and old is None):
+        # không biết giá trị trước khi sửa -> tính lại từ đầu cho khách này
+        CustomerBalance.rebuild([instance.customer_id])
+    elif old != new:
+        if old:
+            CustomerBalance.apply_delta(old[0], open_items=-int(old[1]))
+        CustomerBalance.apply_delta(new[0], open_items=int(new[1]))
+    instance._balance_snapshot = instance.balance_state()
+
+
+@receiver(post_delete, sender=ARItem)
+def balance_on_ar_item_delete(sender, instance, **kwargs):
+    state = getattr(instance, "_balance_snapshot", None) or instance.balance_state()
+    if state:
+        CustomerBalance.apply_delta(state[0], open_items=-int(state[1]), create=False)
+
+
+@receiver(post_save, sender=Bill)
+def on_bill_save(sender, instance, created, **kwargs):
+    old = None if created else getattr(instance, "_balance_snapshot", None)
+    new = instance.balance_state()
+
+    # BillTotals (+ CustomerBalance.total_billed): chỉ khi có bill mới hoặc bill chuyển khách hàng
+    if created or old is None or new is None or old[0] != new[0]:
+        recompute_bill_totals([instance.customer_id])
+        if old and old[0] != instance.customer_id:
+            CustomerBalance.refresh_billed([old[0]], create=False)
+
+    # CustomerBalance.total_paid
+    if new is None or (not created and old is None):
+        CustomerBalance.rebuild([instance.customer_id])
+    elif old != new:
+        if old and old[0] == new[0]:
+            CustomerBalance.apply_delta(new[0], paid=new[1] - old[1])
+        else:
+            if old:
+                CustomerBalance.apply_delta(old[0], paid=-old[1])
+            CustomerBalance.apply_delta(new[0], paid=new[1])
+    instance._balance_snapshot = instance.balance_state()
+
+
+@receiver(post_delete, sender=Bill)
+def on_bill_delete(sender, instance, **kwargs):
+    state = getattr(instance, "_balance_snapshot", None) or instance.balance_state()
+    if state:
+        CustomerBalance.apply_delta(state[0], paid=-state[1], create=False)
+        # BillTotals của bill đã bị xoá theo cascade
+        CustomerBalance.refresh_billed([state[0]], create=False)
+
+
+@receiver(post_save, sender=PaymentHistory)
+def balance_on_payment(sender, instance, created, **kwargs):
+    if created:
+        CustomerBalance.apply_delta(instance.customer_id, payment_at=instance.created)
+
+
+@receiver(post_delete, sender=PaymentHistory)
+def balance_on_payment_delete(sender, instance, **kwargs):
+    # total_paid đi theo Bill; chỉ còn lần thu gần nhất có thể vừa bị xoá
+    CustomerBalance.refresh_last_payment(instance.customer_id)
+
+
+@receiver(payments_created)
+def balance_on_payments_created(sender, bill, payments, ar_items, closed_count, **kwargs):
+    # total_paid đã cộng qua post_save của Bill; ở đây chỉ còn số phiếu tất toán + lần thu gần nhất
+    if payments:
+        CustomerBalance.apply_delta(bill.customer_id, open_items=-closed_count,
+                                    payment_at=max(p.created for p in payments))
+
+
+# ==============================
+# TreatmentUsageFact: số liệu sử dụng từng phác đồ cho báo cáo doanh thu chưa thực hiện
+# ==============================
+@receiver(post_save, sender=TreatmentRequest)
+def usage_fact_on_tr_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {"is_done"}:
         return
+    refresh_usage_facts([instance.pk])
+
+
+@receiver(post_save, sender=SessionTechicalSetting)
+def usage_fact_on_technique_save(sender, instance, created, **kwargs):
+    loaded = getattr(instance, "_loaded_has_come", None)
+    changed = instance.has_come if created else loaded is None or loaded != instance.has_come
+    if changed:
+        refresh_usage_facts([instance.session.treatment_request_id])
+    instance._loaded_has_come = instance.has_come
+
+
+@receiver(post_delete, sender=SessionTechicalSetting)
+def usage_fact_on_technique_delete(sender, instance, **kwargs):
+    if instance.has_come:
+        tr_id = TreatmentSession.objects.filter(pk=instance.session_id).values_list("treatment_request_id", flat=True).first()
+        refresh_usage_facts([tr_id])
+
+
+@receiver(post_save, sender=PaymentHistory)
+def usage_fact_on_payment(sender, instance, created, **kwargs):
+    if created and instance.ar_item_id:
+        refresh_usage_facts(trs_for_ar_items([instance.ar_item]))
+
+
+@receiver(payments_created)
+def usage_fact_on_payments_created(sender, ar_items, **kwargs):
+    refresh_usage_facts(trs_for_ar_items(ar_items))
+
+
+@receiver(post_save, sender=Discount)
+def usage_fact_on_discount_save(sender, instance, created, **kwargs):
+    if not created:
+        refresh_usage_facts(trs_for_pricing_change(discount_id=instance.pk))
+
+
+@receiver(post_save, sender=TreatmentPackage)
+def usage_fact_on_package_save(sender, instance, created, **kwargs):
+    if not created:
+        refresh_usage_facts(trs_for_pricing_change(package_id=instance.pk))
+
+
+@receiver(post_save, sender=ServiceTreatmentPackage)
+@receiver(post_delete, sender=ServiceTreatmentPackage)
+def usage_fact_on_price_change(sender, instance, **kwargs):
+    refresh_usage_facts(trs_for_pricing_change(package_id=instance.treatment_package_id,
+                                               service_id=instance.service_id))
+
+
+# ===== RevenueDaily: cộng dồn doanh thu theo ngày / chiều báo cáo =====
+@receiver(post_save, sender=PaymentHistory)
+def revenue_daily_on_payment(sender, instance, created, **kwargs):
+    if created:
+        revenue_daily.add_payments([instance])
 
-    customer = bill.customer
 
-    # Lấy tất cả phác đồ của khách hàng
-    all_requests = TreatmentRequest.objects.filter(bill__customer=customer)
+@receiver(payments_created)
+def revenue_daily_on_payments_created(sender, payments, **kwargs):
+    revenue_daily.add_payments(payments)
 
-    if not all_requests.exists():
+
+@receiver(pre_delete, sender=PaymentHistory)
+def revenue_daily_before_payment_delete(sender, instance, **kwargs):
+    # trước khi xoá: ARItem (có thể bị xoá cùng lượt CASCADE) và Referral vẫn còn để quy ra chiều
+    revenue_daily.add_payments([instance], sign=-1)
+
+
+@receiver(pre_save, sender=Referral)
+def revenue_daily_before_referral_save(sender, instance, **kwargs):
+    # chiều giới thiệu đang ghi trong RevenueDaily (trước khi sửa)
+    instance._revenue_dims = revenue_daily.referral_dims([instance.customer_id])[instance.customer_id] \
+        if instance.pk else revenue_daily.UNKNOWN
+
+
+@receiver(post_save, sender=Referral)
+def revenue_daily_on_referral_save(sender, instance, **kwargs):
+    old = getattr(instance, "_revenue_dims", revenue_daily.UNKNOWN)
+    new = revenue_daily.referral_dims([instance.customer_id])[instance.customer_id]
+    revenue_daily.move_customer(instance.customer_id, old, new)
+
+
+@receiver(pre_delete, sender=Referral)
+def revenue_daily_before_referral_delete(sender, instance, **kwargs):
+    instance._revenue_dims = revenue_daily.referral_dims([instance.customer_id])[instance.customer_id]
+
+
+@receiver(post_delete, sender=Referral)
+def revenue_daily_on_referral_delete(sender, instance, **kwargs):
+    old = getattr(instance, "_revenue_dims", revenue_daily.UNKNOWN)
+    revenue_daily.move_customer(instance.customer_id, old, revenue_daily.UNKNOWN)
+
+
+@receiver(post_save, sender=LeadSourceActor)
+def revenue_daily_on_actor_save(sender, instance, created, **kwargs):
+    # actor chuyển sang LeadSource khác: mọi dòng của actor cùng 1 lead_source nên đổi tại chỗ không đụng unique key
+    if not created:
+        revenue_daily.move_actor(instance.pk, instance.source_id)
+
+
+# ===== ReferralAttribution: khách / hoá đơn / doanh thu theo người giới thiệu =====
+@receiver(post_save, sender=PaymentHistory)
+def referral_attribution_on_payment(sender, instance, created, **kwargs):
+    if created:
+        referral_attribution.add_payments([instance])
+
+
+@receiver(payments_created)
+def referral_attribution_on_payments_created(sender, payments, **kwargs):
+    referral_attribution.add_payments(payments)
+
+
+@receiver(pre_delete, sender=PaymentHistory)
+def referral_attribution_before_payment_delete(sender, instance, **kwargs):
+    referral_attribution.add_payments([instance], sign=-1)
+
+
+@receiver(post_save, sender=ARItem)
+def referral_attribution_on_ar_item(sender, instance, created, **kwargs):
+    if created:
+        referral_attribution.add_ar_item(instance)
+
+
+@receiver(post_delete, sender=ARItem)
+def referral_attribution_on_ar_item_delete(sender, instance, **kwargs):
+    referral_attribution.add_ar_item(instance, sign=-1)
+
+
+@receiver(post_save, sender=Referral)
+def referral_attribution_on_referral_save(sender, instance, created, **kwargs):
+    # người giới thiệu cũ (ghi ở pre_save của RevenueDaily) và mới; sửa ghi chú... thì bỏ qua
+    old = referral_attribution.referrer(getattr(instance, "_revenue_dims", revenue_daily.UNKNOWN))
+    new = referral_attribution.referrer(revenue_daily.referral_dims([instance.customer_id])[instance.customer_id])
+    if created or old != new:
+        referral_attribution.refresh_referrers({old, new})
+
+
+@receiver(post_delete, sender=Referral)
+def referral_attribution_on_referral_delete(sender, instance, **kwargs):
+    old = getattr(instance, "_revenue_dims", revenue_daily.UNKNOWN)
+    referral_attribution.refresh_referrers({referral_attribution.referrer(old)})
+
+
+# ===== Lịch chuyên gia / phòng: vô hiệu hoá chỉ mục theo ngày =====
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def schedule_on_booking_change(sender, instance, **kwargs):
+    scheduling.invalidate([instance.receiving_day, getattr(instance, "_loaded_receiving_day", None)])
+
+
+@receiver(post_save, sender=TreatmentSession)
+@receiver(post_delete, sender=TreatmentSession)
+def schedule_on_session_change(sender, instance, **kwargs):
+    scheduling.invalidate_refs(booking_ids=[instance.booking_id])
+
+
+@receiver(post_save, sender=SessionTechicalSetting)
+@receiver(post_delete, sender=SessionTechicalSetting)
+def schedule_on_technique_change(sender, instance, **kwargs):
+    scheduling.invalidate_refs(session_ids=[instance.session_id])
+
+
+# ===== TechniqueExecutionDaily: lượt kỹ thuật đã thực hiện theo chuyên gia / ngày (bảng lương) =====
+def _execution_ref(state):
+    """(expert_id, session_id) nếu trạng thái này được tính lương (has_come + có expert)."""
+    if state and state[0] and state[1]:
+        return state[1], state[2]
+    return None
+
+
+@receiver(post_save, sender=SessionTechicalSetting)
+def technique_daily_on_technique_save(sender, instance, created, **kwargs):
+    old = None if created else getattr(instance, "_loaded_execution", None)
+    new = instance.execution_state()
+    if old != new:
+        technique_daily.mark(session_refs=[r for r in (_execution_ref(old), _execution_ref(new)) if r])
+    instance._loaded_execution = new
+
+
+@receiver(pre_delete, sender=SessionTechicalSetting)
+def technique_daily_before_technique_delete(sender, instance, **kwargs):
+    # buổi / booking có thể bị xoá cùng lượt (CASCADE) nên quy ra ngày ngay lúc này
+    if _execution_ref(instance.execution_state()):
+        technique_daily.mark(cells=technique_daily.cells_for(session_ids=[instance.session_id]))
+
+
+@receiver(post_save, sender=Booking)
+def technique_daily_on_booking_save(sender, instance, created, **kwargs):
+    old_day = getattr(instance, "_loaded_receiving_day", None)
+    if created or old_day == instance.receiving_day:
         return
+    cells = technique_daily.cells_for(booking_ids=[instance.pk])
+    technique_daily.mark(cells=cells | {(e, old_day) for e, _ in cells})
 
-    # nếu KHÔNG còn phác đồ nào chưa done
-    all_done = not all_requests.filter(is_done=False).exists()
-    new_status = '3' if all_done else '2'  # '3' = đã mua xong, '2' = đang mua
 
-    if customer.main_status != new_status:
-        customer.main_status = new_status
-        customer.save(update_fields=['main_status'])
\ No newline at end of file
+@receiver(pre_save, sender=TreatmentSession)
+def technique_daily_before_session_rebook(sender, instance, **kwargs):
+    # buổi gắn / đổi / bỏ lịch: quy ra ô của ngày cũ trước khi ghi
+    if instance._state.adding:
+        return
+    if hasattr(instance, "_loaded_booking_id") and instance._loaded_booking_id == instance.booking_id:
+        return
+    instance._rebook_refs = technique_daily.execution_refs(session_ids=[instance.pk])
+
+
+@receiver(post_save, sender=TreatmentSession)
+def technique_daily_on_session_rebook(sender, instance, **kwargs):
+    refs = instance.__dict__.pop("_rebook_refs", None)
+    if refs:
+        technique_daily.mark(cells={(e, d) for e, _, d in refs}, session_refs={(e, s) for e, s, _ in refs})
+
+
+@receiver(pre_delete, sender=Booking)
+def technique_daily_before_booking_delete(sender, instance, **kwargs):
+    # buổi mất lịch (SET_NULL) -> lượt chuyển sang ngày tạo phác đồ, quy ra lại khi commit
+    refs = technique_daily.execution_refs(booking_ids=[instance.pk])
+    technique_daily.mark(cells={(e, d) for e, _, d in refs}, session_refs={(e, s) for e, s, _ in refs})
+
+
+@receiver(post_save, sender=TechicalSetting)
+def technique_daily_on_techical_setting_save(sender, instance, created, **kwargs):
+    if not created:
+        technique_daily.reprice(instance.pk, instance.price, instance.type)
+
+
+# Đăng ký sau cùng: mọi receiver post_save ở trên đã dùng xong giá trị cũ thì mới cập nhật mốc,
+# để lưu tiếp cùng instance (D1 -> D2 -> D3, hoặc bản ghi vừa tạo) vẫn so với giá trị đã ghi gần nhất.
+@receiver(post_save, sender=Booking)
+def booking_snapshot_after_save(sender, instance, **kwargs):
+    instance._loaded_receiving_day = instance.receiving_day
+
+
+@receiver(post_save, sender=TreatmentSession)
+def session_snapshot_after_save(sender, instance, **kwargs):
+    instance._loaded_booking_id = instance.booking_id
@@ -1,3 +1,628 @@
-from django.test import TestCase
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.test import APIClient
+
+from app_customer.models import Customer, Referral
+from app_home.models import Discount, LeadSource, LeadSourceActor, TreatmentPackage, UserProfile
+from app_hr.models import HrUserProfile
+from app_product.models import Service, ServiceTreatmentPackage, TechicalSetting
+from app_treatment.models import ARItem, Bill, BillTotals, Booking, CustomerBalance, DoctorProcess, PaymentHistory, \
+    PayrollRun, ReferralAttribution, RevenueDaily, SessionTechicalSetting, TechniqueExecutionDaily, TreatmentRequest, \
+    ServiceAssign, TreatmentSession, TreatmentUsageFact, diagnosis_medicine, diagnosis_service
+from app_treatment.services.ar_ledger import CURSOR_SALT, label_from_model, method_label
+from app_treatment.services.ar_periods import month_start, next_month, prev_month
+from app_treatment.services.payroll import get_expert_technique_detail, get_performance_payroll
+from app_treatment.services.payroll_runs import close_period
+from app_treatment.services.revenue_daily import DIMENSIONS
+from app_treatment.services import technique_daily
+from app_treatment.services.payments import allocate_payment, payments_created
+from app_treatment.services.pricing import price_items, price_of
+
+TR_URL = "/api/app-treatment/v1/treatment-request/"
+
+
+class TreatmentFixtures:
+    """Dữ liệu chung: 1 dịch vụ TLCB + gói + vài kỹ thuật, 1 khách, client đăng nhập admin."""
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_staff=True, is_superuser=True)
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(self.admin)
+        self.service = Service.objects.create(name="Svc", type="TLCB")
+        self.package = TreatmentPackage.objects.create(name="P", value=20)
+        ServiceTreatmentPackage.objects.create(service=self.service, treatment_package=self.package,
+                                               price=Decimal("2000"))
+        self.techniques = [TechicalSetting.objects.create(name=f"T{i}", price=10 * (i + 1), type="TLCB")
+                           for i in range(3)]
+        self.customer = Customer.objects.create(name="Nguyễn Văn A", mobile="0900000001")
+
+    def create_request(self, sessions):
+        payload = {"service_id": self.service.id, "treatment_package_id": self.package.id,
+                   "customer_id": self.customer.id, "sessions": sessions}
+        resp = self.client_api.post(TR_URL, payload, format="json")
+        self.assertEqual(resp.status_code, 201, resp.content)
+        return TreatmentRequest.objects.get(pk=resp.json()["id"])
+
+    def session_payload(self, day, techniques):
+        return {"note": "b", "receiving_day": day.isoformat(), "set_date": "09:00", "techniques": techniques}
+
+    def assertMatchesRebuild(self, model, command, fields, **exclude):
+        """Bảng gộp do signal duy trì phải trùng với kết quả `manage.py <command>` tính lại từ đầu."""
+        def rows():
+            qs = model.objects.all()
+            if exclude:
+                qs = qs.exclude(**exclude)
+            return sorted(qs.values_list(*fields))
+        live = rows()
+        call_command(command, stdout=StringIO())
+        self.assertEqual(live, rows())
+        return live
+
+
+class TreatmentSessionsEditTests(TreatmentFixtures, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        day = date.today() + timedelta(days=1)
+        self.tr = self.create_request([self.session_payload(day, [
+            {"techical_setting_id": ts.id, "duration_minutes": 30, "has_come": i == 0}
+            for i, ts in enumerate(self.techniques)])])
+        self.session = TreatmentSession.objects.get(treatment_request=self.tr)
+        self.items = list(SessionTechicalSetting.objects.filter(session=self.session).order_by("id"))
+
+    def patch(self, techniques):
+        return self.client_api.patch(f"{TR_URL}{self.tr.id}/",
+                                     {"sessions": [{"id": self.session.id, "techniques": techniques}]},
+                                     format="json")
+
+    def test_patch_partial_technique_list_keeps_other_items(self):
+        resp = self.patch([{"id": self.items[1].id, "has_come": True}])
+        self.assertEqual(resp.status_code, 200, resp.content)
+
+        items = {it.pk: it for it in SessionTechicalSetting.objects.filter(session=self.session)}
+        self.assertEqual(set(items), {it.pk for it in self.items})
+        # dòng đã thực hiện không gửi lên: không bị xoá / reset
+        self.assertTrue(items[self.items[0].pk].has_come)
+        self.assertEqual(items[self.items[0].pk].duration_minutes, 30)
+        # dòng có gửi: chỉ sửa trường có gửi, giữ kỹ thuật khi không gửi techical_setting_id
+        self.assertTrue(items[self.items[1].pk].has_come)
+        self.assertEqual(items[self.items[1].pk].duration_minutes, 30)
+        self.assertEqual(items[self.items[1].pk].techical_setting_id, self.techniques[1].id)
+
+    def test_bookings_without_bulk_insert_returning(self):
+        days = [date.today() + timedelta(days=i) for i in (3, 4, 5)]
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            tr = self.create_request([{**self.session_payload(d, []), "note": "same"} for d in days])
+        sessions = TreatmentSession.objects.filter(treatment_request=tr).select_related("booking").order_by("index_no")
+        self.assertEqual([s.booking.receiving_day for s in sessions], days)
+
+    def test_new_item_requires_techical_setting(self):
+        resp = self.patch([{"has_come": True}])
+        self.assertEqual(resp.status_code, 400)
+
+    def test_put_refuses_to_remove_performed_item(self):
+        base = {"service_id": self.service.id, "treatment_package_id": self.package.id,
+                "customer_id": self.customer.id}
+        resp = self.client_api.put(f"{TR_URL}{self.tr.id}/", {**base, "sessions": [
+            {"id": self.session.id, "techniques": [{"id": self.items[1].id}]}]}, format="json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(SessionTechicalSetting.objects.filter(session=self.session).count(), 3)
+
+        resp = self.client_api.put(f"{TR_URL}{self.tr.id}/", {**base, "sessions": [
+            {"id": self.session.id, "techniques": [{"id": self.items[0].id}, {"id": self.items[1].id}]}]},
+            format="json")
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(set(SessionTechicalSetting.objects.filter(session=self.session).values_list("id", flat=True)),
+                         {self.items[0].id, self.items[1].id})
+
+
+class TechniqueExecutionDailyTests(TreatmentFixtures, TransactionTestCase):
+    FIELDS = ("day", "expert_id", "ttype", "customer_id", "techical_setting_id", "execution_count", "amount")
+
+    def setUp(self):
+        super().setUp()
+        self.expert = HrUserProfile.objects.create(full_name="E", type="employee")
+        self.day = date.today() + timedelta(days=1)
+
+    def assertFacts(self):
+        return self.assertMatchesRebuild(TechniqueExecutionDaily, "rebuild_technique_daily", self.FIELDS)
+
+    def days(self):
+        return set(TechniqueExecutionDaily.objects.values_list("day", flat=True))
+
+    def test_create_update_delete(self):
+        tr = self.create_request([self.session_payload(self.day, [
+            {"techical_setting_id": ts.id, "has_come": True, "expert_ids": [self.expert.id]}
+            for ts in self.techniques[:2]])])
+        self.assertEqual(len(self.assertFacts()), 2)
+
+        item = SessionTechicalSetting.objects.filter(session__treatment_request=tr).first()
+        item.has_come = False
+        item.save()
+        self.assertEqual(len(self.assertFacts()), 1)
+
+        self.techniques[1].price = 99
+        self.techniques[1].save()
+        self.assertEqual(self.assertFacts()[0][-1], Decimal("99"))
+
+        for it in SessionTechicalSetting.objects.filter(has_come=True):
+            it.delete()
+        self.assertEqual(self.assertFacts(), [])
+
+    def test_marks_after_rolled_back_savepoint_are_applied(self):
+        self.create_request([self.session_payload(self.day, [
+            {"techical_setting_id": self.techniques[0].id, "has_come": True, "expert_ids": [self.expert.id]}])])
+        TechniqueExecutionDaily.objects.all().delete()
+        cell = (self.expert.id, self.day)
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    technique_daily.mark(cells={cell})
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            technique_daily.mark(cells={cell})
+        self.assertEqual(self.days(), {self.day})
+
+    def test_moving_loaded_booking_twice_leaves_no_stale_cell(self):
+        tr = self.create_request([self.session_payload(self.day, [
+            {"techical_setting_id": self.techniques[0].id, "has_come": True, "expert_ids": [self.expert.id]}])])
+        booking = TreatmentSession.objects.get(treatment_request=tr).booking
+        for offset in (1, 2):
+            booking.receiving_day = self.day + timedelta(days=offset)
+            booking.save()
+        self.assertEqual(self.days(), {self.day + timedelta(days=2)})
+        self.assertFacts()
+
+    def test_moving_booking_created_in_process(self):
+        tr = self.create_request([{"note": "b", "techniques": [
+            {"techical_setting_id": self.techniques[0].id, "has_come": True, "expert_ids": [self.expert.id]}]}])
+        session = TreatmentSession.objects.get(treatment_request=tr)
+        booking = Booking.objects.create(customer=self.customer, is_treatment=True, receiving_day=self.day)
+        session.booking = booking
+        session.save()
+        self.assertEqual(self.days(), {self.day})
+
+        booking.receiving_day = self.day + timedelta(days=3)
+        booking.save()
+        self.assertEqual(self.days(), {self.day + timedelta(days=3)})
+        self.assertFacts()
+
+
+class ARItemFixtures(TreatmentFixtures):
+    """+ 3 phiếu công nợ 100 của khách."""
+
+    def setUp(self):
+        super().setUp()
+        ct = ContentType.objects.get_for_model(Customer)
+        self.ar_items = [ARItem.objects.create(customer=self.customer, content_type=ct, object_id=i,
+                                               amount_original=Decimal("100")) for i in range(3)]
+
+
+class AllocatePaymentTests(ARItemFixtures, TransactionTestCase):
+
+    def test_payment_ids_without_bulk_insert_returning(self):
+        seen = []
+
+        def receiver(sender, payments, **kwargs):
+            seen.extend(p.pk for p in payments)
+
+        payments_created.connect(receiver)
+        self.addCleanup(payments_created.disconnect, receiver)
+        # MySQL: bulk_create không trả id
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            bill = allocate_payment(customer_id=self.customer.id, amount=Decimal("250"), paid_method="cash")
+
+        ids = [p.pk for p in bill.allocated_payments]
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(seen, ids)
+        self.assertEqual(dict(PaymentHistory.objects.filter(bill=bill).values_list("id", "code")),
+                         {p.pk: p.code for p in bill.allocated_payments})
+
+
+class BillTotalsTests(TreatmentFixtures, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        process = DoctorProcess.objects.create(customer=self.customer)
+        assign = ServiceAssign.objects.create(doctor_process=process, assigned_expert=self.admin)
+        diagnosis_service.objects.create(service_assign=assign, service=self.service,
+                                         treatment_package=self.package, quantity=2)
+        self.bill = Bill.objects.create(customer=self.customer)
+
+    def assertTotalsLive(self, expected):
+        totals = BillTotals.objects.get(bill=self.bill)
+        self.assertEqual(totals.total_service_amount, expected)
+        self.assertEqual(totals.total_amount, Bill.objects.get(pk=self.bill.pk).get_total_amount_real())
+
+    def test_price_table_change_recomputes_totals(self):
+        self.assertTotalsLive(Decimal("4000"))
+        stp = ServiceTreatmentPackage.objects.get(service=self.service, treatment_package=self.package)
+        stp.price = Decimal("2500")
+        stp.save()
+        self.assertTotalsLive(Decimal("5000"))
+        self.assertEqual(CustomerBalance.objects.get(customer=self.customer).total_billed, Decimal("5000"))
+        stp.delete()
+        self.assertTotalsLive(Decimal("0"))
+
+
+class CustomerBalanceTests(ARItemFixtures, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.process = DoctorProcess.objects.create(customer=self.customer)
+        diagnosis_medicine.objects.create(doctor_process=self.process, price=Decimal("70"), quantity=2)
+        self.bills = [Bill.objects.create(customer=self.customer) for _ in range(2)]
+
+    def assertBilledAsBillTotals(self):
+        # tổng đã xuất = Σ tổng tiền từng bill (không phải Σ ARItem.amount_original)
+        expected = sum((b.get_total_amount_real() for b in Bill.objects.filter(customer=self.customer)), Decimal(0))
+        balance = CustomerBalance.objects.get(customer=self.customer)
+        self.assertEqual(balance.total_billed, expected)
+        self.assertEqual(Bill.objects.get(pk=self.bills[0].pk).get_customer_total_billed(), expected)
+        return expected
+
+    def test_total_billed_follows_bill_totals(self):
+        self.assertEqual(self.assertBilledAsBillTotals(), Decimal("280"))
+
+        diagnosis_medicine.objects.create(doctor_process=self.process, price=Decimal("30"), quantity=1)
+        self.assertEqual(self.assertBilledAsBillTotals(), Decimal("340"))
+
+        bill = Bill.objects.get(pk=self.bills[0].pk)
+        bill.paid_ammount = Decimal("340")
+        bill.save()
+        self.assertTrue(Bill.objects.get(pk=bill.pk).fully_paid)
+
+        self.bills[1].delete()
+        self.assertEqual(self.assertBilledAsBillTotals(), Decimal("170"))
+        self.assertMatchesRebuild(CustomerBalance, "rebuild_customer_balances",
+                                  ("customer_id", "total_billed", "total_paid", "open_ar_count"))
+        self.assertEqual(CustomerBalance.objects.get(customer=self.customer).open_ar_count, 3)
+
+
+class BookingCalendarTests(TreatmentFixtures, TransactionTestCase):
+    URL = "/api/app-treatment/v1/booking/calendar/"
+
+    def setUp(self):
+        super().setUp()
+        self.day = date.today()
+        Booking.objects.create(customer=self.customer, receiving_day=self.day)
+
+    def get(self, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client_api.get(self.URL, {"startDate": self.day.isoformat(), "endDate": self.day.isoformat()},
+                                   **headers)
+
+    def test_customer_edit_changes_etag(self):
+        etag = self.get()["ETag"]
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        self.customer.name = "Nguyễn Văn B"
+        self.customer.save()
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["days"][0]["bookings"][0]["customer_name"], "Nguyễn Văn B")
+
+        etag = response["ETag"]
+        self.customer.mobile = "0900000009"
+        self.customer.save(update_fields=["mobile"])
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["days"][0]["bookings"][0]["mobile"], "0900000009")
+
+
+class PricingParityTests(TreatmentFixtures, TransactionTestCase):
+    """services.pricing (tính hàng loạt) phải cho cùng kết quả với cách tính từng object như trước."""
+
+    def setUp(self):
+        super().setUp()
+        self.package2 = TreatmentPackage.objects.create(name="P2", value=10)
+        ServiceTreatmentPackage.objects.create(service=self.service, treatment_package=self.package2,
+                                               price=Decimal("1500.50"))
+        self.no_price = TreatmentPackage.objects.create(name="P3", value=5)  # không có dòng bảng giá
+        discounts = [None] + [Discount.objects.create(name=t, type=t, rate=rate) for t, rate in (
+            ("percentage", 10), ("percent", 25), ("fixed", 500), ("amount", 300), ("fixed", 999999))]
+
+        self.items = []
+        for discount in discounts:
+            for package in (self.package, self.package2, self.no_price):
+                self.items.append(TreatmentRequest.objects.create(
+                    customer=self.customer, service=self.service, treatment_package=package, discount=discount))
+            process = DoctorProcess.objects.create(customer=self.customer, is_active=False,
+                                                   medicine_discount=discount)
+            diagnosis_medicine.objects.create(doctor_process=process, price=Decimal("120.25"), quantity=3)
+            diagnosis_medicine.objects.create(doctor_process=process, price=Decimal("80"), quantity=1)
+            assign = ServiceAssign.objects.create(doctor_process=process, assigned_expert=self.admin,
+                                                  service_discount=discount)
+            for package, quantity in ((self.package, 2), (self.package2, 1), (self.no_price, 4)):
+                diagnosis_service.objects.create(service_assign=assign, service=self.service,
+                                                 treatment_package=package, quantity=quantity)
+            self.items += [process, assign]
+        # phác đồ chưa chọn gói
+        self.items.append(TreatmentRequest.objects.create(customer=self.customer, service=self.service))
+
+    @staticmethod
+    def old_discount(total, discount):
+        if discount:
+            if discount.type in ("percentage", "percent"):
+                total = total - (total * discount.rate) / Decimal("100")
+            elif discount.type in ("fixed", "amount"):
+                total = total - discount.rate
+        return max(total, Decimal(0))
+
+    def old_stp_price(self, service, package):
+        # Service không có field giá: không có dòng bảng giá -> 0
+        stp = ServiceTreatmentPackage.objects.filter(service=service, treatment_package=package).first()
+        return stp.price if stp and stp.price is not None else Decimal(0)
+
+    def old_price(self, obj):
+        """Giá sau giảm theo cách tính từng object (1 vài query / object) trước khi có services.pricing."""
+        if isinstance(obj, TreatmentRequest):
+            original = self.old_stp_price(obj.service, obj.treatment_package) if obj.treatment_package_id else Decimal(0)
+            return self.old_discount(original, obj.discount)
+        if isinstance(obj, ServiceAssign):
+            total = sum((self.old_stp_price(d.service, d.treatment_package) * d.quantity
+                         for d in obj.diagnosis_services.all()), Decimal(0))
+            return self.old_discount(total, obj.service_discount)
+        total = sum(((dm.price or 0) * (dm.quantity or 0) for dm in obj.diagnosis_medicines.all()), Decimal(0))
+        return self.old_discount(total, obj.medicine_discount)
+
+    def test_batch_prices_match_per_object(self):
+        prices = price_items(self.items)
+        for obj in self.items:
+            expected = self.old_price(obj)
+            self.assertEqual(prices[obj].final, expected, obj)
+            self.assertEqual(price_of(obj).final, expected, obj)
+            self.assertEqual(prices[obj].original - prices[obj].discount, prices[obj].final, obj)
+        # mỗi discount 5 object (3 phác đồ, process, chỉ định); nhóm cuối giảm 999999 -> kẹp về 0
+        self.assertEqual({prices[obj].final for obj in self.items[25:30]}, {Decimal(0)})
+        self.assertEqual(prices[self.items[2]].final, Decimal(0))  # gói không có giá
+        self.assertEqual(prices[self.items[0]].final, Decimal("2000"))
+
+
+class ARLedgerTests(ARItemFixtures, TransactionTestCase):
+    URL = "/api/app-treatment/v1/ar-detail/"
+
+    def setUp(self):
+        super().setUp()
+        ct = ContentType.objects.get_for_model(Customer)
+        base = timezone.now() - timedelta(days=3)
+        # ARItem và khoản thu trùng thời điểm: thứ tự (created, Nợ trước Có, id)
+        ARItem.objects.filter(customer=self.customer).update(created=base)
+        self.ar_items += [ARItem.objects.create(customer=self.customer, content_type=ct, object_id=10 + i,
+                                                amount_original=Decimal("40.50"), description=f"AR {i}",
+                                                created=base + timedelta(hours=i)) for i in range(3)]
+        allocate_payment(customer_id=self.customer.id, amount=Decimal("250"), paid_method="cash")
+        PaymentHistory.objects.create(customer=self.customer, ar_item=self.ar_items[4],
+                                      paid_amount=Decimal("10.25"), paid_method="transfer")
+        PaymentHistory.objects.filter(paid_amount__gte=Decimal("50")).update(created=base)
+        # khách khác không được lẫn vào sổ
+        other = Customer.objects.create(name="Lê Bình", mobile="0900000002")
+        ARItem.objects.create(customer=other, content_type=ct, object_id=99, amount_original=Decimal("7"), created=base)
+
+    def python_ledger(self):
+        """Sổ tính bằng Python như bản cũ của ARDetailByCustomerAPI (không lọc ngày)."""
+        timeline = []
+        for ar in ARItem.objects.filter(customer=self.customer).select_related("content_type"):
+            timeline.append((ar.created, 0, ar.id, ar.description or label_from_model(ar.content_type.model),
+                             ar.amount_original, Decimal(0)))
+        for p in PaymentHistory.objects.filter(customer=self.customer).select_related("ar_item__content_type"):
+            desc = f"Thu tiền {label_from_model(p.ar_item.content_type.model)} (AR #{p.ar_item_id})"
+            desc += f" - {method_label(p.paid_method)}"
+            timeline.append((p.created, 1, p.id, desc, Decimal(0), p.paid_amount))
+        timeline.sort(key=lambda x: x[:3])
+        rows, balance = [], Decimal(0)
+        for created, _, _, desc, debit, credit in timeline:
+            balance += debit - credit
+            rows.append((created, desc, debit, credit, max(balance, Decimal(0)), max(-balance, Decimal(0))))
+        return rows
+
+    def get(self, **params):
+        return self.client_api.get(self.URL, {"customer_id": self.customer.id, **params})
+
+    def pages(self, page_size):
+        pages, cursor = [], None
+        while True:
+            params = {"pageSize": page_size, **({"cursor": cursor} if cursor else {})}
+            data = self.get(**params).json()
+            pages.append([(parse_datetime(e["date"]), e["description"], Decimal(str(e["debit"])),
+                           Decimal(str(e["credit"])), Decimal(str(e["balance_debit"])),
+                           Decimal(str(e["balance_credit"]))) for e in data["entries"]])
+            cursor = data["next_cursor"]
+            if not cursor:
+                return pages
+
+    def test_matches_python_ledger_across_pages(self):
+        expected = self.python_ledger()
+        self.assertEqual(len(expected), 10)
+        for page_size in (3, 4, 50):
+            pages = self.pages(page_size)
+            self.assertEqual([row for page in pages for row in page], expected, page_size)
+        # trang 2 tiếp số dư của trang 1 (không bắt đầu lại từ 0)
+        first, second = self.pages(3)[:2]
+        self.assertEqual(second[0][4] - second[0][5], first[-1][4] - first[-1][5] + second[0][2] - second[0][3])
+
+    def test_tampered_cursor_is_rejected(self):
+        cursor = self.get(pageSize=3).json()["next_cursor"]
+        created, type_order, pk, balance = signing.loads(cursor, salt=CURSOR_SALT)
+        forged = signing.dumps([created, type_order, pk, "-1000000"], salt="other")
+        for bad in (cursor[:-2] + "xx", forged, "abc"):
+            self.assertEqual(self.get(pageSize=3, cursor=bad).status_code, 400, bad)
+
+
+class RevenueListAPITests(ARItemFixtures, TransactionTestCase):
+    URL = "/api/app-treatment/v1/revenue/"
+
+    def test_summary_matches_rows_when_rollup_is_stale(self):
+        allocate_payment(customer_id=self.customer.id, amount=Decimal("150"), paid_method="cash")
+        PaymentHistory.objects.filter(paid_amount=Decimal("50")).update(paid_amount=Decimal("40"))
+        RevenueDaily.objects.all().delete()
+        today = date.today().isoformat()
+
+        data = self.client_api.get(self.URL, {"startDate": today, "endDate": today}).json()
+        self.assertEqual(Decimal(str(data["summary"]["total_revenue"])),
+                         sum(Decimal(str(r["paid_amount"])) for r in data["results"]))
+        self.assertEqual(Decimal(str(data["summary"]["total_revenue"])), Decimal("140"))
+
+
+class PayrollCloseAPITests(TreatmentFixtures, TransactionTestCase):
+    URL = "/api/app-treatment/v1/payroll/close/"
+
+    def setUp(self):
+        super().setUp()
+        self.period = prev_month(month_start(date.today())).strftime("%Y-%m")
+
+    def api_for(self, user):
+        api = APIClient()
+        api.force_authenticate(user)
+        return api
+
+    def test_close_requires_admin(self):
+        ctv = User.objects.create(username="ctv")
+        resp = self.api_for(ctv).post(self.URL, {"period": self.period}, format="json")
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(self.api_for(ctv).get(self.URL).status_code, 200)
+
+        profile_admin = User.objects.create(username="manager")
+        UserProfile.objects.create(user=profile_admin, is_admin=True)
+        resp = self.api_for(profile_admin).post(self.URL, {"period": self.period}, format="json")
+        self.assertEqual(resp.status_code, 201, resp.content)
+
+    def test_recompute_keeps_original_closer(self):
+        resp = self.client_api.post(self.URL, {"period": self.period}, format="json")
+        self.assertEqual(resp.status_code, 201, resp.content)
+        other = User.objects.create(username="admin2", is_staff=True)
+        resp = self.api_for(other).post(self.URL, {"period": self.period, "recompute": True}, format="json")
+        self.assertEqual(resp.status_code, 201, resp.content)
+
+        run = PayrollRun.objects.get()
+        self.assertEqual(run.closed_by_id, self.admin.id)
+        self.assertEqual(run.recomputed_by_id, other.id)
+        self.assertEqual(run.recompute_count, 1)
+        self.assertIsNotNone(run.recomputed_at)
+
+
+class RollupConsistencyTests(TreatmentFixtures, TransactionTestCase):
+    """Mọi bảng gộp do signal duy trì phải trùng với lệnh rebuild_* sau khi tạo / sửa / xoá dữ liệu nguồn."""
+
+    def setUp(self):
+        super().setUp()
+        self.expert = HrUserProfile.objects.create(full_name="E", type="employee")
+        self.ctv = HrUserProfile.objects.create(full_name="CTV", type="collaborator", code="CTV1")
+        self.actor = LeadSourceActor.objects.create(source=LeadSource.objects.create(name="FB"), name="Ads")
+        self.referral = Referral.objects.create(customer=self.customer, ref_type="hr", ref_hr=self.ctv)
+        self.other = Customer.objects.create(name="Lê Bình", mobile="0900000002")
+        self.day = date.today() + timedelta(days=1)
+        self.tr = self.create_request([
+            self.session_payload(self.day, [
+                {"techical_setting_id": ts.id, "has_come": True, "expert_ids": [self.expert.id]}
+                for ts in self.techniques[:2]]),
+            self.session_payload(self.day + timedelta(days=1), [
+                {"techical_setting_id": self.techniques[2].id, "expert_ids": [self.expert.id]}]),
+        ])
+        self.other_ar = ARItem.objects.create(customer=self.other, content_type=ContentType.objects.get_for_model(Customer),
+                                              object_id=self.other.id, amount_original=Decimal("300"))
+
+    def assertRollupsMatchRebuild(self):
+        self.assertMatchesRebuild(RevenueDaily, "rebuild_revenue_daily", DIMENSIONS + ("amount", "payment_count"),
+                                  amount=0, payment_count=0)
+        self.assertMatchesRebuild(ReferralAttribution, "rebuild_referral_attribution",
+                                  ("ref_kind", "ref_id", "day", "customers", "invoices", "revenue"),
+                                  customers=0, invoices=0, revenue=0)
+        self.assertMatchesRebuild(CustomerBalance, "rebuild_customer_balances",
+                                  ("customer_id", "total_billed", "total_paid", "open_ar_count", "last_payment_at"))
+        self.assertMatchesRebuild(BillTotals, "rebuild_bill_totals",
+                                  ("bill_id", "total_service_amount", "total_product_amount", "total_amount"))
+        self.assertMatchesRebuild(TreatmentUsageFact, "rebuild_usage_facts",
+                                  ("treatment_request_id", "package_price", "final_price", "total_sessions",
+                                   "used_sessions", "paid_amount"))
+        self.assertMatchesRebuild(TechniqueExecutionDaily, "rebuild_technique_daily",
+                                  TechniqueExecutionDailyTests.FIELDS)
+
+    def test_create_update_delete(self):
+        allocate_payment(customer_id=self.customer.id, amount=Decimal("500"), paid_method="cash")
+        payment = PaymentHistory.objects.create(customer=self.other, ar_item=self.other_ar,
+                                                paid_amount=Decimal("50"), paid_method="transfer")
+        self.assertRollupsMatchRebuild()
+        self.assertTrue(ReferralAttribution.objects.filter(ref_kind="hr", ref_id=self.ctv.id).exists())
+
+        # sửa: đổi người giới thiệu, dời lịch, bỏ đánh dấu đã thực hiện, đổi giá gói
+        self.referral.ref_type, self.referral.ref_hr, self.referral.ref_actor = "actor", None, self.actor
+        self.referral.save()
+        booking = TreatmentSession.objects.filter(treatment_request=self.tr).order_by("index_no")[0].booking
+        booking.receiving_day = self.day + timedelta(days=5)
+        booking.save()
+        item = SessionTechicalSetting.objects.filter(session__treatment_request=self.tr, has_come=True).first()
+        item.has_come = False
+        item.save()
+        Referral.objects.create(customer=self.other, ref_type="actor", ref_actor=self.actor)
+        self.assertRollupsMatchRebuild()
+
+        # xoá: 1 khoản thu (PaymentHistory.delete() bị chặn, chỉ xoá qua queryset / CASCADE), 1 dòng kỹ thuật,
+        # referral, phiếu công nợ (CASCADE khoản thu của nó)
+        PaymentHistory.objects.filter(pk=payment.pk).delete()
+        SessionTechicalSetting.objects.filter(session__treatment_request=self.tr, has_come=True).first().delete()
+        self.referral.delete()
+        self.assertRollupsMatchRebuild()
+        ARItem.objects.get(pk=self.other_ar.pk).delete()
+        self.assertRollupsMatchRebuild()
+
+
+class PayrollRunTests(TreatmentFixtures, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.expert = HrUserProfile.objects.create(full_name="E", type="employee", email="e@x.vn")
+        self.period = prev_month(month_start(date.today()))
+        self.start, self.end = self.period, next_month(self.period) - timedelta(days=1)
+        self.create_request([self.session_payload(self.period + timedelta(days=9), [
+            {"techical_setting_id": ts.id, "has_come": True, "expert_ids": [self.expert.id]}
+            for ts in self.techniques])])
+
+    def payroll(self):
+        # so theo giá trị Decimal (sqlite không giữ số chữ số thập phân của SUM)
+        return [{k: Decimal(v) if k in ("total_amount", "salary") else v for k, v in row.items()}
+                for row in get_performance_payroll(self.start.isoformat(), self.end.isoformat())]
+
+    def test_closed_period_serves_frozen_snapshot(self):
+        live = self.payroll()
+        run = close_period(self.period)
+        self.assertEqual(self.payroll(), live)
+        self.assertEqual(run.line_count, PayrollRun.objects.get().lines.count())
+
+        # đổi giá sau khi chốt: kỳ đã chốt không đổi cho tới khi chốt lại
+        self.techniques[0].price = 1000
+        self.techniques[0].save()
+        self.assertEqual(self.payroll(), live)
+        close_period(self.period)
+        self.assertNotEqual(self.payroll(), live)
+
+    def detail_total(self, start, end):
+        return sum((r["technique_price"] * r["execution_count"]
+                    for r in get_expert_technique_detail(self.expert.id, start, end)), Decimal(0))
+
+    def test_closed_period_detail_uses_frozen_prices(self):
+        run = close_period(self.period)
+        line = run.lines.get(hr_id=self.expert.id)
+        self.assertEqual(self.detail_total(self.start, self.end), line.total_amount)
+
+        self.techniques[0].price = 1000
+        self.techniques[0].save()
+        self.assertEqual(self.detail_total(self.start, self.end), line.total_amount)
+        # khoảng không trùng kỳ đã chốt vẫn dùng giá hiện tại
+        self.assertEqual(self.detail_total(self.start, self.end + timedelta(days=1)), Decimal(1000 + 20 + 30))
+
+        run = close_period(self.period)
+        self.assertEqual(self.detail_total(self.start, self.end), run.lines.get(hr_id=self.expert.id).total_amount)
+        self.assertEqual(self.detail_total(self.start, self.end), Decimal(1050))
@@ -3,8 +3,9 @@ from . import views
 from rest_framework.routers import DefaultRouter
 
 from .views import ClinicalExaminationViewSet, DiagnosisMedicineViewSet, ExaminationOrderViewSet, TreatmentRequestAPIView, UserServiceStatsListView, ExpertTechniqueDetailAPIView
-from .views_payroll import PayrollAPIView
-from .views_accounting import RevenueListAPI, ARDetailByCustomerAPI, ARSummaryAPI, UnrealizedRevenueAPI
+from .views_payroll import PayrollAPIView, PayrollCloseAPIView
+from .views_schedule import ScheduleAvailabilityAPI, ScheduleConflictsAPI
+from .views_accounting import RevenueListAPI, RevenueDashboardAPI, ARDetailByCustomerAPI, ARSummaryAPI, UnrealizedRevenueAPI
 
 app_name = 'app_treatment'
 router = DefaultRouter()
@@ -34,11 +35,15 @@ urlpatterns = [
     ),
     path("users/service-stats/", UserServiceStatsListView.as_view(), name="user-service-stats-list"),
     path('v1/payroll/', PayrollAPIView.as_view(), name='payroll'),
+    path('v1/payroll/close/', PayrollCloseAPIView.as_view(), name='payroll-close'),
     path('v1/treatment/payroll/experts/<int:expert_id>/technique-details/',
          ExpertTechniqueDetailAPIView.as_view(),
          name='expert-technique-details'),
     path('v1/revenue/', RevenueListAPI.as_view(), name='revenue'),
+    path('v1/revenue/dashboard/', RevenueDashboardAPI.as_view(), name='revenue-dashboard'),
     path('v1/ar-detail/', ARDetailByCustomerAPI.as_view(), name='ar-detail'),
     path('v1/ar-summary/', ARSummaryAPI.as_view(), name='ar-summary'),
     path('v1/revenue-unrealized/', UnrealizedRevenueAPI.as_view(), name="revenue-unrealized"),
+    path('v1/schedule/availability/', ScheduleAvailabilityAPI.as_view(), name='schedule-availability'),
+    path('v1/schedule/conflicts/', ScheduleConflictsAPI.as_view(), name='schedule-conflicts'),
 ]
@@ -4,7 +4,7 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q, Value, OuterRef, Subquery, F
+from django.db.models import Q, Value, OuterRef, Subquery, F, Count, Max, Sum
 from django.db import transaction
 from rest_framework.views import APIView
 from rest_framework import generics
@@ -14,13 +14,22 @@ from django.db.models.functions import Coalesce
 from collections import defaultdict
 from typing import Optional
 import time
+import hashlib
+from django.utils.http import quote_etag
+from django.utils.dateparse import parse_date
 
-from app_home.pagination import CustomPagination
+from app_home.mixins import SparseFieldsMixin
+from app_customer.search import search_customers
+from app_home.pagination import CustomPagination, KeysetPagination, KeysetLimitOffsetPagination
 from app_home.views import CollaboratorReadOnlyPermission
-from .services.payroll import get_performance_payroll
+from .services.payroll import get_performance_payroll, get_expert_technique_detail
+from .services.bill_totals import bill_session_annotations
+from .services.ar_periods import day_range
+from .services.user_service_stats import user_service_stats
 
 from .serializers import (
     ARItemSerializer,
+    PaymentAllocateSerializer,
 )
 
 from app_treatment.models import Bill, Booking, DoctorProcess, DoctorHealthCheck, ServiceAssign,ReExamination
@@ -35,11 +44,20 @@ from app_product.models import TechicalSetting
 from .docs import *
 @extend_schema(tags=["app_treatment"])
 @booking_schema()
-class BookingViewSet(viewsets.ModelViewSet):
+class BookingViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = Booking.objects.all()
     serializer_class = BookingSerializer
-    pagination_class = CustomPagination
+    pagination_class = KeysetPagination  # ?page= như cũ, ?cursor= keyset trên (created, id)
     permission_classes = [IsAuthenticated, CollaboratorReadOnlyPermission]
+    # ?fields= / ?omit=: 3 field phác đồ dùng chung prefetch TR mới nhất (TR -> buổi -> kỹ thuật, 4 query / trang)
+    sparse_field_costs = {
+        'customer_info': {'select_related': ('customer',)},
+        'lead_status_code': {'select_related': ('customer', 'customer__lead_status')},
+        'contact_date': {'select_related': ('customer',)},
+        'treating_doctor': {'prefetch_related': ('customer__treatment_requests',)},
+        'latest_plan_type': {'prefetch_related': ('customer__treatment_requests',)},
+        'latest_plan_status': {'prefetch_related': ('customer__treatment_requests',)},
+    }
 
     def get_queryset(self):
         """
@@ -85,8 +103,7 @@ class BookingViewSet(viewsets.ModelViewSet):
             
         if search_term:
             filters &= (
-                Q(customer__name__icontains=search_term) |
-                Q(customer__code__icontains=search_term) |
+                Q(customer__in=search_customers(search_term)) |
                 Q(user__username__icontains=search_term) |
                 Q(note__icontains=search_term)
             )
@@ -213,6 +230,73 @@ class BookingViewSet(viewsets.ModelViewSet):
         self.perform_update(serializer)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    CALENDAR_MAX_DAYS = 62
+
+    @action(detail=False, methods=['get'], url_path='calendar')
+    def calendar(self, request):
+        """
+        Lịch lễ tân gọn: booking trong [startDate, endDate] gom theo ngày, chỉ các cột cần hiển thị
+        (values(), không serializer lồng). Hỗ trợ ETag: client gửi If-None-Match -> 304 nếu không đổi
+        (kể cả tên / mã / SĐT khách), chi phí 1 query aggregate trên index (receiving_day, set_date).
+        Lọc thêm: customer, type / types (csv), is_treatment, has_come.
+        """
+        params = request.query_params
+        start = parse_date(params.get('startDate') or '')
+        end = parse_date(params.get('endDate') or '')
+        if not start or not end:
+            return Response({"detail": "startDate & endDate are required"}, status=status.HTTP_400_BAD_REQUEST)
+        if start > end or (end - start).days >= self.CALENDAR_MAX_DAYS:
+            return Response({"detail": f"Khoảng ngày không hợp lệ (tối đa {self.CALENDAR_MAX_DAYS} ngày)."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        qs = Booking.objects.filter(receiving_day__range=[start, end])
+        if params.get('customer'):
+            qs = qs.filter(customer_id=params.get('customer'))
+        types = [t.strip().lower() for t in params.getlist('type') + (params.get('types') or '').split(',')]
+        types = sorted({t for t in types if t in dict(Booking.BOOKING_TYPE)})
+        if types:
+            qs = qs.filter(type__in=types)
+        for flag in ('is_treatment', 'has_come'):
+            val = str(params.get(flag, '')).strip().lower()
+            if val in ('true', '1', 'yes'):
+                qs = qs.filter(**{flag: True})
+            elif val in ('false', '0', 'no'):
+                qs = qs.filter(**{flag: False})
+
+        # ETag = dấu vân tay của tập booking (số dòng, id lớn nhất, mốc sửa cuối của booking và khách) + bộ lọc
+        fp = qs.aggregate(n=Count('id'), max_id=Max('id'), last=Max('updated'), customer_last=Max('customer__updated'))
+        raw = "|".join([request.get_full_path(), str(fp['n']), str(fp['max_id']),
+                        *(fp[k].isoformat() if fp[k] else '' for k in ('last', 'customer_last'))])
+        etag = quote_etag(hashlib.md5(raw.encode()).hexdigest())
+        if etag in [e.strip() for e in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            resp = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            days = defaultdict(list)
+            for b in (qs.order_by('receiving_day', 'set_date', 'id')
+                        .values('id', 'receiving_day', 'set_date', 'type', 'has_come', 'is_treatment', 'note',
+                                'customer_id', 'customer__code', 'customer__name', 'customer__mobile')):
+                days[b['receiving_day']].append({
+                    "id": b['id'],
+                    "time": b['set_date'].strftime('%H:%M') if b['set_date'] else None,
+                    "type": b['type'],
+                    "has_come": b['has_come'],
+                    "is_treatment": b['is_treatment'],
+                    "note": b['note'],
+                    "customer_id": b['customer_id'],
+                    "customer_code": b['customer__code'],
+                    "customer_name": b['customer__name'],
+                    "mobile": b['customer__mobile'],
+                })
+            resp = Response({
+                "startDate": start,
+                "endDate": end,
+                "total": fp['n'],
+                "days": [{"date": d, "bookings": days[d]} for d in sorted(days)],
+            })
+        resp['ETag'] = etag
+        resp['Cache-Control'] = 'private, no-cache'
+        return resp
+
     @action(detail=True, methods=['patch'], url_path="update-has-come")
     def update_has_come(self, request, pk=None):
         booking = self.get_object()
@@ -328,9 +412,7 @@ class DoctorHealthCheckViewSet(viewsets.ModelViewSet):
         filters = Q()
         if search_term:
             search_filters = (
-                Q(customer__name__icontains=search_term)|
-                Q(customer__code__icontains=search_term)|
-                Q(customer__mobile__icontains=search_term)|
+                Q(customer__in=search_customers(search_term))|
                 Q(customer__email__icontains=search_term)
             )
             filters &= search_filters
@@ -555,17 +637,56 @@ class ServiceAssignViewSet(viewsets.ModelViewSet):
 
 @extend_schema(tags=["app_treatment"])
 @bill_schema()
-class BillViewSet(viewsets.ModelViewSet):
-    active_dp_qs = DoctorProcess.objects.filter(is_active=True).order_by("-version", "-id")
+class BillViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
+    # process mới nhất trước -> BillListSerializer.get_doctor_process_details lấy phần tử đầu
+    latest_dp_qs = (
+        DoctorProcess.objects
+        .select_related("customer", "parent", "doctor_profile", "medicine_discount")
+        .prefetch_related("diagnosis_medicines")
+        .order_by("-id")
+    )
     queryset = (
         Bill.objects
-        .select_related("customer")
-        .prefetch_related(Prefetch("customer__doctor_process", queryset=active_dp_qs))
+        .select_related("customer", "totals", "customer__balance", "customer__doctor_health_check__doctor")
+        .prefetch_related(
+            Prefetch("customer__doctor_process", queryset=latest_dp_qs, to_attr="doctor_processes_latest"),
+            Prefetch("customer__booking_set", queryset=Booking.objects.only("id", "receiving_day", "customer_id").order_by("id")),
+            "customer__customer_introducers_set__introducer",
+            "customer__customer_introducers_set__commission",
+        )
         .order_by("-created")
     )
     serializer_class = BillListSerializer
-    pagination_class = CustomPagination
+    pagination_class = KeysetPagination  # ?page= như cũ, ?cursor= keyset trên (created, id)
     permission_classes = [IsAuthenticated]
+    # ?fields= / ?omit=: customer_details kéo 3 prefetch, doctor_process_details 2 query / trang,
+    # mỗi field buổi là 1 subquery tương quan trên từng dòng Bill
+    _customer_details_costs = {
+        'select_related': ('customer',),
+        'prefetch_related': ('customer__booking_set',
+                             'customer__customer_introducers_set__introducer',
+                             'customer__customer_introducers_set__commission'),
+    }
+    sparse_field_costs = {
+        'customer_details': _customer_details_costs,
+        'doctor_process_details': {'prefetch_related': ('customer__doctor_process',)},
+        'doctor': {'select_related': ('customer__doctor_health_check__doctor',)},
+        'total_amount': {'select_related': ('totals',)},
+        'total_amount_real': {'select_related': ('totals',)},
+        'total_product_amount': {'select_related': ('totals',)},
+        'total_service_amount': {'select_related': ('totals',)},
+        'package_services_total': {'select_related': ('totals',)},
+        'amount_remaining': {'select_related': ('customer__balance',)},
+        'customer_total_billed': {'select_related': ('customer__balance',)},
+        'customer_total_paid': {'select_related': ('customer__balance',)},
+        'technical_used_total': {'annotate': ('technical_used_total_value',)},
+        'treatment_sessions_remaining': {'annotate': ('sessions_remaining_count',)},
+        'treatment_sessions_done': {'annotate': ('sessions_done_count',)},
+        'uncompleted_sessions_tlcbs': {'annotate': ('sessions_tlcb_remaining_count',)},
+        'completed_sessions_tlcbs': {'annotate': ('sessions_tlcb_done_count',)},
+        'uncompleted_sessions_tldss': {'annotate': ('sessions_tlds_remaining_count',)},
+        'completed_sessions_tldss': {'annotate': ('sessions_tlds_done_count',)},
+    }
 
     def get_queryset(self):
         customer_id = self.request.query_params.get('customer_id')
@@ -576,23 +697,20 @@ class BillViewSet(viewsets.ModelViewSet):
 
         filters = Q()
         if start_date and end_date:
-            filters &= Q(created__date__range=[start_date, end_date])
+            filters &= day_range('created', parse_date(start_date), parse_date(end_date))
 
         # Ưu tiên ID; nếu không có ID thì dùng tên (search tự do)
         if customer_id:
             filters &= Q(customer_id=customer_id)
         elif customer:
             s = customer.strip()
-            # mở rộng: tên, mã KH, số ĐT
-            filters &= (
-                Q(customer__name__icontains=s) |
-                Q(customer__code__icontains=s) |
-                Q(customer__mobile__icontains=s)
-            )
+            # mở rộng: tên (không dấu), mã KH, số ĐT
+            filters &= Q(customer__in=search_customers(s))
 
         qs = (
             self.queryset
             .filter(filters)
+            .annotate(**self.sparse_annotations(bill_session_annotations()))
             .annotate(
                 source_type = F('payments__ar_item__content_type__model'),
                 source_id   = F('payments__ar_item__object_id'),
@@ -624,28 +742,26 @@ class BillViewSet(viewsets.ModelViewSet):
             return Response([])
 
         # (Optional) Lọc khoảng thời gian thanh toán nếu muốn: ?paymentStart=YYYY-MM-DD&paymentEnd=YYYY-MM-DD
-        pay_start = request.query_params.get('paymentStart')
-        pay_end   = request.query_params.get('paymentEnd')
-
-        pay_filter = {'customer_id__in': customer_ids}
-        if pay_start:
-            pay_filter['created__date__gte'] = pay_start
-        if pay_end:
-            pay_filter['created__date__lte'] = pay_end
+        pay_start = parse_date(request.query_params.get('paymentStart') or '')
+        pay_end   = parse_date(request.query_params.get('paymentEnd') or '')
 
-        # 2) Lấy ARItem để suy loại dịch vụ sử dụng
-        ar_items = (ARItem.objects
+        # 2) Lấy loại chứng từ công nợ (content_type) đã phát sinh của từng KH
+        ar_types = (ARItem.objects
                     .filter(customer_id__in=customer_ids)
-                    .select_related('content_type')
-                    .only('customer_id', 'content_type'))
+                    .values_list('customer_id', 'content_type__model')
+                    .order_by()
+                    .distinct())
 
-        # 3) Lấy PaymentHistory để tổng tiền + lần gần nhất
-        payments = PaymentHistory.objects.filter(**pay_filter).only('customer_id', 'paid_amount', 'created')
+        # 3) Tổng tiền + lần gần nhất: gộp trong SQL theo KH (khoảng ngày dạng >= / < để dùng index (customer, created))
+        payments = (PaymentHistory.objects
+                    .filter(day_range('created', pay_start, pay_end), customer_id__in=customer_ids)
+                    .values('customer_id')
+                    .annotate(total=Sum('paid_amount'), latest=Max('created'))
+                    .order_by())
 
         # 4) Map loại dịch vụ từ content_type.model
         type_map = defaultdict(set)
-        for ar in ar_items:
-            model = getattr(ar.content_type, 'model', None)
+        for customer_id, model in ar_types:
             if model == 'doctorprocess':
                 label = 'đơn thuốc'
             elif model == 'treatmentrequest':
@@ -654,16 +770,14 @@ class BillViewSet(viewsets.ModelViewSet):
                 label = 'xuất vật tư'
             else:
                 label = model or 'khác'
-            type_map[ar.customer_id].add(label)
+            type_map[customer_id].add(label)
 
         # 5) Tổng tiền & lần thanh toán gần nhất
-        total_paid_map = defaultdict(Decimal)
+        total_paid_map = {}
         latest_paid_map = {}
         for p in payments:
-            amt = p.paid_amount or Decimal('0')
-            total_paid_map[p.customer_id] += amt
-            if p.customer_id not in latest_paid_map or p.created > latest_paid_map[p.customer_id]:
-                latest_paid_map[p.customer_id] = p.created
+            total_paid_map[p['customer_id']] = p['total'] or Decimal('0')
+            latest_paid_map[p['customer_id']] = p['latest']
 
         # 6) Build output (mỗi KH chỉ 1 dòng)
         out = []
@@ -705,7 +819,7 @@ class BillViewSet(viewsets.ModelViewSet):
 
         pay_filters = Q(customer_id=customer_id)
         if start_date and end_date:
-            pay_filters &= Q(created__date__range=[start_date, end_date])
+            pay_filters &= day_range('created', parse_date(start_date), parse_date(end_date))
 
         payments = (PaymentHistory.objects
                     .filter(pay_filters)
@@ -771,6 +885,7 @@ class PaymentHistoryViewSet(viewsets.ModelViewSet):
     queryset = PaymentHistory.objects.select_related('ar_item','customer')
     serializer_class = PaymentHistorySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetLimitOffsetPagination  # ?limit/offset như cũ, ?cursor= keyset
 
     def get_queryset(self):
         qs = super().get_queryset()
@@ -784,6 +899,17 @@ class PaymentHistoryViewSet(viewsets.ModelViewSet):
         if method: qs = qs.filter(paid_method=method)
         return qs.order_by('-created')
 
+    @action(detail=False, methods=['post'], url_path='allocate')
+    def allocate(self, request):
+        """
+        Thu gộp: 1 Bill, 1 PaymentHistory / ARItem, khoá các ARItem trong 1 transaction.
+        Body: {customer, amount, paid_method, ar_items?: [id,...], strategy?: 'fifo', note?}
+        """
+        serializer = PaymentAllocateSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        bill = serializer.save()
+        return Response(serializer.to_representation(bill), status=status.HTTP_201_CREATED)
+
 @extend_schema(tags=["app_treatment"])
 class TreatmentRequestAPIView(APIView):
     serializer_class = TreatmentRequestSerializer
@@ -808,14 +934,24 @@ class TreatmentRequestAPIView(APIView):
 
 @extend_schema(tags=["app_treatment"])
 @treatment_request_schema()
-class TreatmentRequestViewSet(viewsets.ModelViewSet):
+class TreatmentRequestViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = TreatmentRequest.objects.all()
     serializer_class = TreatmentRequestSerializer
     permission_classes = [IsAuthenticated]
-    
+    # ?fields= / ?omit=: treatment_sessions (2 query / dòng) và spent_amount (1 query / dòng) là field đắt nhất
+    sparse_field_costs = {
+        'customer_details': {'select_related': ('customer',)},
+        'doctor_name': {'select_related': ('doctor_profile',)},
+        'service': {'select_related': ('service',)},
+        'service_name': {'select_related': ('service',)},
+        'package_price_original': {'select_related': ('service',)},
+        'package_price_final': {'select_related': ('service', 'discount')},
+        'treatment_sessions': {'prefetch_related': ('treatment_sessions__booking',)},
+    }
+
     def get_queryset(self):
         qs = (super().get_queryset()
-              .select_related('service', 'doctor_profile', 'discount')
+              .select_related('service', 'doctor_profile', 'discount', 'customer')
               .prefetch_related('treatment_sessions__booking'))  # ✅ đúng related_name
 
         customer_id = self.request.query_params.get('customer_id')
@@ -1123,11 +1259,47 @@ class UserServiceStatsListView(generics.ListAPIView):
     """
     GET /api/users/service-stats/?start=2025-08-01&end=2025-08-31
     Trả về danh sách tất cả user + số phác đồ TLCB, TLDS
+    Thống kê cả danh sách là 1 query GROUP BY (cache theo start/end), ghép với trang user trong bộ nhớ.
     """
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('user_profile__hr_profile').order_by('id')
     serializer_class = UserServiceStatsSerializer
     permission_classes = [IsAuthenticated]
 
+    def service_stats(self):
+        if not hasattr(self, '_service_stats'):
+            start = parse_date(self.request.query_params.get('start') or '')
+            end = parse_date(self.request.query_params.get('end') or '')
+            self._service_stats = user_service_stats(start, end)
+        return self._service_stats
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        params = self.request.query_params
+        search = (params.get('search') or '').strip()
+        if search:
+            qs = qs.filter(
+                Q(username__icontains=search) | Q(first_name__icontains=search) |
+                Q(last_name__icontains=search) | Q(email__icontains=search)
+            )
+        is_active = params.get('is_active')
+        if is_active in ('true', 'false'):
+            qs = qs.filter(is_active=(is_active == 'true'))
+
+        service_type = params.get('service_type')
+        has_activity = params.get('has_activity')
+        if service_type in ('TLCB', 'TLDS'):
+            field = f'total_{service_type.lower()}'
+            qs = qs.filter(id__in=[uid for uid, s in self.service_stats().items() if s[field]])
+        if has_activity in ('true', 'false'):
+            active = list(self.service_stats())
+            qs = qs.filter(id__in=active) if has_activity == 'true' else qs.exclude(id__in=active)
+        return qs
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['service_stats'] = self.service_stats()
+        return context
+
 class PayrollAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -1148,65 +1320,29 @@ class ExpertTechniqueDetailAPIView(APIView):
         if start > end:
             return Response({"detail": "startDate must be <= endDate"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # ⚙️ Đồng bộ cửa sổ thời gian với payroll:
-        # - receiving_day ∈ [start, end]  OR  treatment_request.created_at::date ∈ [start, end]
-        time_filter = (
-            Q(session__booking__receiving_day__range=(start, end)) |
-            Q(session__treatment_request__created_at__date__range=(start, end))
-        )
-
-        base = (
-            SessionTechicalSetting.objects
-            .select_related("session", "session__booking", "techical_setting", "expert")
-            .filter(
-                has_come=True,
-                expert_id=expert_id,
-            )
-            .filter(time_filter)
-        )
-
-        if ttype in ("TLCB", "TLDS"):
-            base = base.filter(techical_setting__type=ttype)
-
-        rows = (
-            base.values(
-                "session__booking__customer_id",
-                "session__booking__customer__name",
-                "session__booking__customer__code",
-                "session__booking__receiving_day",
-                "techical_setting__name",
-                "techical_setting__type",
-            )
-            .annotate(count=Count("id"))
-            .order_by(
-                "session__booking__customer__name",
-                "-session__booking__receiving_day",
-                "techical_setting__name",
-            )
-        )
+        # Cùng nguồn với payroll: bảng tổng hợp TechniqueExecutionDaily
+        rows = get_expert_technique_detail(expert_id, start, end, ttype)
 
         groups_map = {}
         for r in rows:
-            cid   = r["session__booking__customer_id"]
-            cname = r["session__booking__customer__name"]
-            ccode = r["session__booking__customer__code"]
-            ctype = r["techical_setting__type"] or None
+            cid   = r["customer_id"]
+            ctype = r["technique_type"]
 
             key = (cid, ctype)
             if key not in groups_map:
                 groups_map[key] = {
-                    "customer": {"id": cid, "name": cname, "code": ccode},
+                    "customer": {"id": cid, "name": r["customer_name"], "code": r["customer_code"]},
                     "treatment_type": ctype,
                     "total_count": 0,
                     "details": [],
                 }
 
             groups_map[key]["details"].append({
-                "date": r["session__booking__receiving_day"],
-                "technique_name": r["techical_setting__name"],
-                "count": r["count"],
+                "date": r["day"],
+                "technique_name": r["technique_name"],
+                "count": r["execution_count"],
             })
-            groups_map[key]["total_count"] += r["count"]
+            groups_map[key]["total_count"] += r["execution_count"]
 
         groups = list(groups_map.values())
 
@@ -1232,6 +1368,7 @@ class ARItemViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = ARItem.objects.all().select_related("customer", "content_type")
     serializer_class = ARItemSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetLimitOffsetPagination  # ?limit/offset như cũ, ?cursor= keyset
 
     def get_queryset(self):
         qs = super().get_queryset()
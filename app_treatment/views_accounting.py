@@ -1,38 +1,76 @@
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from django.db.models import Q, Sum, Count
+from django.db.models import Q, Sum, Count, F, ExpressionWrapper
 from django.contrib.contenttypes.models import ContentType
-from app_customer.models import Customer
+from app_customer.models import Customer, Referral
+from app_customer.search import search_customers
+from app_home.models import LeadSource, LeadSourceActor
+from app_hr.models import HrUserProfile
 from typing import Optional
 from decimal import Decimal
+from datetime import timedelta
 from collections import defaultdict
 
 from django.utils.dateparse import parse_date
 
-from app_treatment.models import TreatmentRequest, TreatmentSession, ARItem, PaymentHistory, SessionTechicalSetting
-from django.db.models.functions import Coalesce
+from app_treatment.models import TreatmentRequest, TreatmentSession, ARItem, PaymentHistory, SessionTechicalSetting, TreatmentUsageFact, \
+    RevenueDaily
+from app_treatment.services.ar_periods import DEC, ar_summary_annotations, day_range, day_start
+from app_treatment.services.ar_ledger import ledger_page, ledger_totals, label_from_model, method_label
+from app_home.pagination import CustomPagination
+from app_home.exports import ExportMixin
+from django.db.models.functions import Coalesce, TruncMonth, TruncWeek
 from app_product.models import ServiceTreatmentPackage, TreatmentPackage
 
-class RevenueListAPI(APIView):
+REVENUE_EXPORT_COLUMNS = (
+    ("created", "Ngày thu"),
+    ("customer_name", "Khách hàng"),
+    ("mobile", "Số điện thoại"),
+    ("invoice_type", "Loại hóa đơn"),
+    ("ar_item_id", "AR #"),
+    ("paid_method", "Hình thức"),
+    ("paid_amount", "Số tiền"),
+)
+AR_SUMMARY_EXPORT_COLUMNS = (
+    ("customer_code", "Mã KH"),
+    ("customer_name", "Khách hàng"),
+    ("opening_debit", "Nợ đầu kỳ"),
+    ("period_debit", "Phát sinh Nợ"),
+    ("period_credit", "Phát sinh Có"),
+    ("ending_debit", "Nợ cuối kỳ"),
+)
+UNREALIZED_EXPORT_COLUMNS = (
+    ("customer_code", "Mã KH"),
+    ("customer_name", "Khách hàng"),
+    ("mobile", "Số điện thoại"),
+    ("usage_status", "Buổi đã dùng"),
+    ("total_package_price", "Giá gói"),
+    ("total_paid", "Đã thanh toán"),
+    ("used_amount", "Đã sử dụng"),
+    ("unused_amount", "Chưa thực hiện"),
+)
+
+class RevenueListAPI(ExportMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        start = request.query_params.get("startDate")
-        end   = request.query_params.get("endDate")
+        start = parse_date(request.query_params.get("startDate") or "")
+        end   = parse_date(request.query_params.get("endDate") or "")
         cid   = request.query_params.get("customer_id")
         pm    = request.query_params.get("paid_method")
         q     = (request.query_params.get("searchTerm") or "").strip()
 
         filters = Q()
         if start and end:
-            filters &= Q(created__date__range=[start, end])
+            # khoảng datetime nửa mở để dùng được index (created); __date bọc cột trong hàm DATE()
+            filters &= day_range("created", start, end)
         if cid:
             filters &= Q(customer_id=cid)
         if pm:
             filters &= Q(paid_method=pm)
         if q:
-            filters &= Q(customer__name__icontains=q) | Q(customer__mobile__icontains=q)
+            filters &= Q(customer__in=search_customers(q))
 
         qs = (PaymentHistory.objects
               .select_related("customer","ar_item")
@@ -52,26 +90,41 @@ class RevenueListAPI(APIView):
                 }.get(m, m.title())
             return ct_map[ctid]
 
-        rows = [{
-            "customer_id": p.customer_id,
-            "customer_name": getattr(p.customer, "name", None),
-            "mobile": getattr(p.customer, "mobile", None),
-            "ar_item_id": p.ar_item_id,
-            "invoice_type": _invoice_type(p.ar_item),
-            "paid_method": p.paid_method,
-            "paid_amount": p.paid_amount,
-            "created": p.created,
-        } for p in qs]
-
-        total_rev = qs.aggregate(s=Sum("paid_amount"))["s"] or 0
+        def _row(p):
+            return {
+                "customer_id": p.customer_id,
+                "customer_name": getattr(p.customer, "name", None),
+                "mobile": getattr(p.customer, "mobile", None),
+                "ar_item_id": p.ar_item_id,
+                "invoice_type": _invoice_type(p.ar_item),
+                "paid_method": p.paid_method,
+                "paid_amount": p.paid_amount,
+                "created": p.created,
+            }
+
+        fmt = self.export_format(request)
+        if fmt:
+            rows = (_row(p) for p in qs.iterator(chunk_size=self.export_chunk_size))
+            return self.export_response(fmt, rows, REVENUE_EXPORT_COLUMNS, "doanh-thu")
+
+        rows = [_row(p) for p in qs]
+
+        # tổng cộng từ chính các dòng trả về (cùng nguồn PaymentHistory, không thêm query)
+        total_rev = sum((r["paid_amount"] or 0 for r in rows), Decimal("0"))
         return Response({"results": rows, "summary": {"total_revenue": total_rev}})
 
-class ARSummaryAPI(APIView):
+class ARSummaryAPI(ExportMixin, APIView):
+    """
+    Tổng hợp công nợ theo khách hàng trong [startDate, endDate].
+    Đầu kỳ = số dư snapshot tháng đã khoá gần nhất + phát sinh từ sau kỳ đó tới trước startDate
+    (xem services.ar_periods / `manage.py close_ar_periods`).
+    Chỉ trả khách có đầu kỳ hoặc phát sinh khác 0; phân trang (page, pageSize) và tổng cộng tính trong SQL.
+    """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        start = request.query_params.get("startDate")
-        end   = request.query_params.get("endDate")
+        start = parse_date(request.query_params.get("startDate") or "")
+        end   = parse_date(request.query_params.get("endDate") or "")
         q     = (request.query_params.get("searchTerm") or "").strip()
 
         if not (start and end):
@@ -79,453 +132,260 @@ class ARSummaryAPI(APIView):
 
         cust_qs = Customer.objects.all()
         if q:
-            cust_qs = cust_qs.filter(Q(name__icontains=q)|Q(mobile__icontains=q)|Q(code__icontains=q))
-
-        cust_ids = list(cust_qs.values_list("id", flat=True)) or [-1]
-
-        # trước kỳ
-        ar_before = (ARItem.objects
-                     .filter(customer_id__in=cust_ids, created__date__lt=start)
-                     .values("customer_id").annotate(s=Sum("amount_original")))
-        pay_before = (PaymentHistory.objects
-                      .filter(customer_id__in=cust_ids, created__date__lt=start)
-                      .values("customer_id").annotate(s=Sum("paid_amount")))
-
-        # trong kỳ
-        ar_period = (ARItem.objects
-                     .filter(customer_id__in=cust_ids, created__date__range=[start,end])
-                     .values("customer_id").annotate(s=Sum("amount_original")))
-        pay_period = (PaymentHistory.objects
-                      .filter(customer_id__in=cust_ids, created__date__range=[start,end])
-                      .values("customer_id").annotate(s=Sum("paid_amount")))
-
-        # map nhanh
-        def m(qs): return {r["customer_id"]: r["s"] or 0 for r in qs}
-        m_ar_b, m_pay_b = m(ar_before), m(pay_before)
-        m_ar_p, m_pay_p = m(ar_period), m(pay_period)
-
-        rows, sum_open, sum_deb, sum_cre, sum_end = [], 0,0,0,0
-        for c in cust_qs:
-            opening = (m_ar_b.get(c.id,0) - m_pay_b.get(c.id,0)) or 0
-            period_debit  = m_ar_p.get(c.id,0) or 0
-            period_credit = m_pay_p.get(c.id,0) or 0
-            ending = opening + period_debit - period_credit
-
-            rows.append({
-                "customer_id": c.id,
+            cust_qs = search_customers(q, cust_qs)
+
+        qs = (cust_qs
+              .annotate(**ar_summary_annotations(start, end))
+              .annotate(opening_debit=ExpressionWrapper(
+                  F("opening_base") + F("opening_debit_delta") - F("opening_credit_delta"), output_field=DEC))
+              .annotate(ending_debit=ExpressionWrapper(
+                  F("opening_debit") + F("period_debit") - F("period_credit"), output_field=DEC))
+              .exclude(opening_debit=0, period_debit=0, period_credit=0)
+              .order_by("name", "id"))
+
+        fmt = self.export_format(request)
+        if fmt:
+            rows = ({
                 "customer_code": c.code,
                 "customer_name": c.name,
-                "opening_debit": opening,
-                "period_debit": period_debit,
-                "period_credit": period_credit,
-                "ending_debit": ending,
-            })
-            sum_open += opening; sum_deb += period_debit; sum_cre += period_credit; sum_end += ending
-
-        return Response({
-            "results": rows,
-            "summary": {
-                "opening_debit": sum_open,
-                "period_debit": sum_deb,
-                "period_credit": sum_cre,
-                "ending_debit": sum_end
-            }
-        })
+                "opening_debit": c.opening_debit,
+                "period_debit": c.period_debit,
+                "period_credit": c.period_credit,
+                "ending_debit": c.ending_debit,
+            } for c in qs.only("id", "code", "name").iterator(chunk_size=self.export_chunk_size))
+            return self.export_response(fmt, rows, AR_SUMMARY_EXPORT_COLUMNS, f"cong-no-{start}-{end}")
+
+        keys = ("opening_debit", "period_debit", "period_credit", "ending_debit")
+        totals = qs.aggregate(**{f"total_{k}": Sum(k) for k in keys})
+
+        rows_qs = qs.values("id", "code", "name", "opening_debit", "period_debit", "period_credit", "ending_debit")
+        paginator = CustomPagination()
+        page = paginator.paginate_queryset(rows_qs, request, view=self)
+        rows = [{
+            "customer_id": r["id"],
+            "customer_code": r["code"],
+            "customer_name": r["name"],
+            "opening_debit": r["opening_debit"],
+            "period_debit": r["period_debit"],
+            "period_credit": r["period_credit"],
+            "ending_debit": r["ending_debit"],
+        } for r in page]
+
+        response = paginator.get_paginated_response(rows)
+        response.data["summary"] = {k: totals[f"total_{k}"] or Decimal("0") for k in keys}
+        return response
         
 class ARDetailByCustomerAPI(APIView):
+    """
+    Sổ chi tiết công nợ 1 khách hàng: AR = Nợ, PaymentHistory = Có, số dư luỹ kế tính trong DB.
+    Phân trang keyset: trang đầu trả opening_balance + summary; trang sau truyền `cursor` = next_cursor.
+    """
     permission_classes = [IsAuthenticated]
+    default_page_size = 50
+    max_page_size = 500
 
     def get(self, request):
         cid   = request.query_params.get("customer_id")
-        start = request.query_params.get("startDate")
-        end   = request.query_params.get("endDate")
+        start = parse_date(request.query_params.get("startDate") or "")
+        end   = parse_date(request.query_params.get("endDate") or "")
+        cursor = request.query_params.get("cursor")
         if not cid:
             return Response({"detail": "customer_id is required"}, status=400)
-
-        # ----- 1) Lọc AR theo thời gian (đÂY là phát sinh NỢ) -----
-        ar_filters = Q(customer_id=cid)
-        if start and end:
-            ar_filters &= Q(created__date__range=[start, end])
-        elif start:
-            ar_filters &= Q(created__date__gte=start)
-        elif end:
-            ar_filters &= Q(created__date__lte=end)
-
-        ar_qs = (
-            ARItem.objects
-            .filter(ar_filters)
-            .select_related("content_type")
-            .only("id", "created", "amount_original", "description", "content_type")
-            .order_by("created", "id")
-        )
-
-        # ----- 2) Lọc payments theo thời gian (đÂY là phát sinh CÓ) -----
-        pmt_filters = Q(ar_item_id__in=ar_qs.values("id"))
-        if start and end:
-            pmt_filters &= Q(created__date__range=[start, end])
-        elif start:
-            pmt_filters &= Q(created__date__gte=start)
-        elif end:
-            pmt_filters &= Q(created__date__lte=end)
-
-        # Lấy thêm model của AR để mô tả loại chứng từ ở dòng thu
-        pmt_qs = (
-            PaymentHistory.objects
-            .filter(pmt_filters)
-            .select_related("ar_item__content_type")
-            .values(
-                "id",
-                "ar_item_id",
-                "paid_amount",
-                "paid_method",           # 'cash' | 'transfer'
-                "created",
-                "ar_item__content_type__model",
-            )
-        )
-
-        # ----- 3) Helper map loại chứng từ -----
-        def label_from_model(model: Optional[str]) -> str:
-            if model == "doctorprocess":
-                return "Đơn thuốc"
-            if model == "treatmentrequest":
-                return "Phác đồ"
-            if model in ("materialissue", "warehouseissue", "issuematerial", "stockout"):
-                return "Xuất vật tư"
-            return "Khác"
-
-        def method_label(m: Optional[str]) -> str:
-            if m == "cash":
-                return "Tiền mặt"
-            if m == "transfer":
-                return "Chuyển khoản"
-            return m or ""
-
-        # ----- 4) Gom timeline: AR = debit, Payment = credit -----
-        timeline = []
-        for ar in ar_qs:
-            model = getattr(getattr(ar, "content_type", None), "model", None)
-            # Diễn giải AR ưu tiên description có sẵn, fallback theo loại
-            ar_desc = ar.description or label_from_model(model) or "Phát sinh công nợ"
-            timeline.append({
-                "date": ar.created,
-                "type_order": 0,            # AR trước payment cùng thời điểm
-                "id": ar.id,
-                "description": ar_desc,
-                "debit": float(ar.amount_original or 0),
-                "credit": 0.0,
-            })
-
-        for p in pmt_qs:
-            model = p.get("ar_item__content_type__model")
-            kind  = label_from_model(model)
-            mth   = method_label(p.get("paid_method"))
-            desc  = f"Thu tiền {kind} (AR #{p['ar_item_id']})"
-            # Optional: thêm phương thức trong ngoặc
-            if mth:
-                desc += f" - {mth}"
-            timeline.append({
-                "date": p["created"],
-                "type_order": 1,
-                "id": p["id"],
-                "description": desc,
-                "debit": 0.0,
-                "credit": float(p["paid_amount"] or 0),
-            })
-
-        # ----- 5) Sort theo (date, type_order, id) -----
-        timeline.sort(key=lambda x: (x["date"] or "", x["type_order"], x["id"]))
-
-        # ----- 6) Tính running balance + tổng trong kỳ -----
-        entries = []
-        total_debit = 0.0
-        total_credit = 0.0
-        balance = 0.0  # >0: dư nợ; <0: dư có
-
-        for ev in timeline:
-            d = float(ev["debit"] or 0)
-            c = float(ev["credit"] or 0)
-            total_debit += d
-            total_credit += c
-            balance += (d - c)
-
-            entries.append({
-                "date": ev["date"],
-                "description": ev["description"],
-                "debit": d,
-                "credit": c,
-                "balance_debit": balance if balance > 0 else 0.0,
-                "balance_credit": (-balance) if balance < 0 else 0.0,
-            })
-
-        return Response({
-            "customer_id": int(cid),
-            "entries": entries,
-            "summary": {
-                "total_debit": total_debit,        # ✅ tổng Nợ trong kỳ (theo filter)
-                "total_credit": total_credit,      # ✅ tổng Có trong kỳ (theo filter)
-                "ending_debit": balance if balance > 0 else 0.0,
-                "ending_credit": (-balance) if balance < 0 else 0.0,
+        try:
+            cid = int(cid)
+            page_size = int(request.query_params.get("pageSize") or self.default_page_size)
+        except ValueError:
+            return Response({"detail": "customer_id / pageSize không hợp lệ"}, status=400)
+        page_size = max(1, min(page_size, self.max_page_size))
+
+        try:
+            page = ledger_page(cid, start=start, end=end, cursor=cursor, page_size=page_size)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=400)
+
+        data = {
+            "customer_id": cid,
+            "entries": page["entries"],
+            "next_cursor": page["next_cursor"],
+        }
+        if not cursor:
+            opening = page["opening_balance"]
+            total_debit, total_credit = ledger_totals(cid, start, end)
+            ending = opening + total_debit - total_credit
+            data["opening_balance"] = opening
+            data["summary"] = {
+                "opening_debit": opening if opening > 0 else Decimal("0"),
+                "opening_credit": -opening if opening < 0 else Decimal("0"),
+                "total_debit": total_debit,        # tổng Nợ trong kỳ (theo filter)
+                "total_credit": total_credit,      # tổng Có trong kỳ (theo filter)
+                "ending_debit": ending if ending > 0 else Decimal("0"),
+                "ending_credit": -ending if ending < 0 else Decimal("0"),
             }
-        })
+        return Response(data)
         
-class UnrealizedRevenueAPI(APIView):
+class UnrealizedRevenueAPI(ExportMixin, APIView):
+    """
+    Doanh thu chưa thực hiện theo khách hàng, đọc từ TreatmentUsageFact (1 dòng / phác đồ):
+    lọc theo ngày tạo phác đồ + tìm khách, GROUP BY khách hàng trong SQL.
+    """
     permission_classes = [IsAuthenticated]
 
-    # =========================
-    # Helpers
-    # =========================
-    def _get_treatment_package_prices(self, tr_queryset):
-        """
-        Tính giá trị gói (price) và số buổi (sessions) cho từng TreatmentRequest.
-        - Giá lấy từ ServiceTreatmentPackage theo (service_id, treatment_package_id).
-        - KHÔNG còn truy vấn 'service__price' (field này không tồn tại trên Service).
-        - Nếu không có STP -> price = 0.
-        """
-        # Preload bảng STP cho các (service_id, treatment_package_id) cần dùng
-        stp_map = {}
-        stp_qs = ServiceTreatmentPackage.objects.filter(
-            service_id__in=tr_queryset.values_list('service_id', flat=True),
-            treatment_package_id__in=tr_queryset.values_list('treatment_package_id', flat=True)
-        ).values('service_id', 'treatment_package_id', 'price')
-
-        for stp in stp_qs:
-            stp_map[(stp['service_id'], stp['treatment_package_id'])] = stp['price']
-
-        # Lấy dữ liệu cần thiết từ TR — CHỈ lấy field có thật
-        # (bỏ 'service__price' để tránh FieldError)
-        tr_data = tr_queryset.select_related('service', 'treatment_package').values(
-            'id',
-            'service_id',
-            'treatment_package_id',
-            'treatment_package__value',  # số buổi
-        )
-
-        result = {}
-        for tr in tr_data:
-            tr_id = tr['id']
-            service_id = tr['service_id']
-            package_id = tr['treatment_package_id']
-
-            # Số buổi từ gói
-            total_sessions = int(tr.get('treatment_package__value') or 0)
-
-            # Giá từ ServiceTreatmentPackage (nếu có)
-            total_price = Decimal('0')
-            if service_id and package_id:
-                price_val = stp_map.get((service_id, package_id))
-                if price_val is not None:
-                    # price_val có thể là Decimal/float/int; ép về Decimal chuẩn
-                    total_price = Decimal(str(price_val))
-
-            # Nếu treatment_package trống nhưng model có selected_package_id (fallback hiếm)
-            # → dùng value của TreatmentPackage + tìm STP theo selected_package_id
-            if (not package_id) and hasattr(tr_queryset.model, 'selected_package_id'):
-                # Trường hợp này chỉ hữu dụng nếu instance có selected_package_id thực tế.
-                # Ta sẽ xử lý ở vòng for instance trong .get() để có access instance attribute.
-                pass
-
-            result[tr_id] = {
-                'price': total_price,
-                'sessions': total_sessions
-            }
-
-        return result
-
-    def _get_used_sessions_count(self, tr_ids):
-        """
-        Số buổi đã phát sinh = số buổi có ÍT NHẤT 1 kỹ thuật has_come=True
-        (đếm DISTINCT session_id theo từng TreatmentRequest).
-        """
-        return dict(
-            SessionTechicalSetting.objects
-            .filter(session__treatment_request_id__in=tr_ids, has_come=True)
-            .values('session__treatment_request_id')
-            .annotate(cnt=Count('session_id', distinct=True))
-            .values_list('session__treatment_request_id', 'cnt')
-        )
-        
-    def _get_payment_amounts(self, tr_ids):
-        """
-        Tổng tiền đã thanh toán cho từng TreatmentRequest
-        (thông qua ARItem có content_type = TreatmentRequest).
-        """
-        ct_tr = ContentType.objects.get_for_model(TreatmentRequest)
-        return dict(
-            PaymentHistory.objects
-            .filter(ar_item__content_type=ct_tr, ar_item__object_id__in=tr_ids)
-            .values('ar_item__object_id')
-            .annotate(total_paid=Coalesce(Sum('paid_amount'), Decimal('0')))
-            .values_list('ar_item__object_id', 'total_paid')
-        )
-
-    def _calculate_used_amount(self, package_price: Decimal, total_sessions: int, used_sessions: int) -> Decimal:
-        """
-        Tiền đã sử dụng = (giá gói / tổng buổi) * số buổi đã thực hiện.
-        """
-        if not package_price or not total_sessions:
-            return Decimal('0')
-        # Dùng Decimal để tránh sai số
-        unit = package_price / Decimal(str(total_sessions))
-        return unit * Decimal(str(used_sessions))
-
-    # =========================
-    # GET
-    # =========================
     def get(self, request):
         # Parse params
-        start = request.query_params.get("startDate")
-        end = request.query_params.get("endDate")
+        start = parse_date(request.query_params.get("startDate") or "")
+        end = parse_date(request.query_params.get("endDate") or "")
         search_term = (request.query_params.get("searchTerm") or "").strip()
 
-        # Build filters (TR dùng created_at)
+        # Build filters (ngày tạo phác đồ, so sánh theo khoảng datetime để dùng index)
         filters = Q()
         if start:
-            d = parse_date(start)
-            if d:
-                filters &= Q(created_at__date__gte=d)
+            filters &= Q(tr_created_at__gte=day_start(start))
         if end:
-            d = parse_date(end)
-            if d:
-                filters &= Q(created_at__date__lte=d)
+            filters &= Q(tr_created_at__lt=day_start(end + timedelta(days=1)))
         if search_term:
-            filters &= (
-                Q(customer__name__icontains=search_term) |
-                Q(customer__code__icontains=search_term) |
-                Q(customer__mobile__icontains=search_term)
-            )
-
-        # Query TR
-        tr_queryset = (
-            TreatmentRequest.objects
-            .select_related("customer", "service", "treatment_package")
-            .filter(filters)
-            .order_by('customer_id', 'id')
-        )
-
-        if not tr_queryset.exists():
-            return Response({
-                "results": [],
-                "summary": {
-                    "total_package_price": Decimal('0'),
-                    "total_paid": Decimal('0'),
-                    "used_amount": Decimal('0'),
-                    "unused_amount": Decimal('0'),
-                }
-            })
-
-        tr_ids = list(tr_queryset.values_list("id", flat=True))
+            filters &= Q(customer__in=search_customers(search_term))
 
-        # Tính price & sessions (theo STP map), và used_sessions, paid amounts
-        package_info_map = self._get_treatment_package_prices(tr_queryset)
-        used_sessions_map = self._get_used_sessions_count(tr_ids)
-        payment_amounts = self._get_payment_amounts(tr_ids)
+        facts = TreatmentUsageFact.objects.filter(filters)
 
         # Gom theo khách hàng
-        customer_data = defaultdict(lambda: {
-            "customer_id": None,
-            "customer_code": None,
-            "customer_name": None,
-            "mobile": None,
-            "total_sessions": 0,
-            "used_sessions": 0,
-            "total_package_price": Decimal('0'),
-            "total_paid": Decimal('0'),
-            "used_amount": Decimal('0'),
-        })
-
-        # Tổng cộng
-        summary_totals = {
-            "total_package_price": Decimal('0'),
-            "total_paid": Decimal('0'),
-            "used_amount": Decimal('0'),
-        }
+        rows_qs = (
+            facts
+            .values("customer_id", "customer__code", "customer__name", "customer__mobile")
+            .annotate(
+                total_sessions=Sum("total_sessions"),
+                used_sessions=Sum("used_sessions"),
+                total_package_price=Sum("package_price"),
+                total_paid=Sum("paid_amount"),
+                used_amount=Sum("used_amount"),
+            )
+            .order_by("customer__name", "customer_id")
+        )
 
-        # Duyệt từng TR instance để xử lý fallback selected_package_id (nếu có)
-        for tr in tr_queryset:
-            tr_id = tr.id
-            cid = tr.customer_id
-            cust = tr.customer
-
-            # Info mặc định từ map
-            info = package_info_map.get(tr_id, {'price': Decimal('0'), 'sessions': 0})
-            package_price = Decimal(info['price'] or 0)
-            package_sessions = int(info['sessions'] or 0)
-
-            # Fallback hiếm: nếu model có selected_package_id và chưa có sessions/price từ map
-            # Lúc này access trực tiếp attribute từ instance.
-            if package_sessions == 0 and getattr(tr, "selected_package_id", None):
-                # Lấy số buổi (value) từ TreatmentPackage
-                pkg_val = TreatmentPackage.objects.filter(
-                    id=tr.selected_package_id
-                ).values_list('value', flat=True).first()
-                package_sessions = int(pkg_val or 0)
-
-                # Lấy giá từ STP theo selected_package_id (nếu có Service)
-                if tr.service_id:
-                    stp_price = ServiceTreatmentPackage.objects.filter(
-                        service_id=tr.service_id,
-                        treatment_package_id=tr.selected_package_id
-                    ).values_list('price', flat=True).first()
-                    if stp_price is not None:
-                        package_price = Decimal(str(stp_price))
-
-            # Số buổi đã dùng theo nghiệp vụ cũ
-            used_sessions = int(used_sessions_map.get(tr_id, 0))
-
-            # Tổng đã thanh toán của TR
-            paid_amount = Decimal(payment_amounts.get(tr_id, Decimal('0')) or 0)
-
-            # Tiền đã sử dụng
-            used_amount = self._calculate_used_amount(package_price, package_sessions, used_sessions)
-
-            # Khởi tạo block khách hàng nếu lần đầu
-            if customer_data[cid]["customer_id"] is None:
-                customer_data[cid].update({
-                    "customer_id": cid,
-                    "customer_code": getattr(cust, "code", None),
-                    "customer_name": getattr(cust, "name", None),
-                    "mobile": getattr(cust, "mobile", None),
-                })
-
-            # Cộng dồn theo khách hàng
-            customer_data[cid]["total_sessions"] += package_sessions
-            customer_data[cid]["used_sessions"] += used_sessions
-            customer_data[cid]["total_package_price"] += package_price
-            customer_data[cid]["total_paid"] += paid_amount
-            customer_data[cid]["used_amount"] += used_amount
-
-            # Cộng dồn summary
-            summary_totals["total_package_price"] += package_price
-            summary_totals["total_paid"] += paid_amount
-            summary_totals["used_amount"] += used_amount
-
-        # Build results
-        results = []
-        for c in customer_data.values():
-            unused_amount = c["total_paid"] - c["used_amount"]
+        def _row(r):
+            unused_amount = r["total_paid"] - r["used_amount"]
             if unused_amount < 0:
                 unused_amount = Decimal('0')
+            return {
+                "customer_id": r["customer_id"],
+                "customer_code": r["customer__code"],
+                "customer_name": r["customer__name"],
+                "mobile": r["customer__mobile"],
+                "total_sessions": r["total_sessions"],
+                "used_sessions": r["used_sessions"],
+                "total_package_price": r["total_package_price"],
+                "total_paid": r["total_paid"],
+                "used_amount": r["used_amount"],
+                "usage_status": f'{r["used_sessions"]}/{r["total_sessions"]}',
+                "unused_amount": unused_amount,
+            }
 
-            results.append({
-                **c,
-                "usage_status": f'{c["used_sessions"]}/{c["total_sessions"]}',
-                "unused_amount": unused_amount
-            })
+        fmt = self.export_format(request)
+        if fmt:
+            rows = (_row(r) for r in rows_qs.iterator(chunk_size=self.export_chunk_size))
+            return self.export_response(fmt, rows, UNREALIZED_EXPORT_COLUMNS, "doanh-thu-chua-thuc-hien")
 
-        # Sort theo tên KH
-        results.sort(key=lambda x: (x["customer_name"] or "").lower())
+        results = [_row(r) for r in rows_qs]
 
-        # Summary: unused
-        summary_unused = summary_totals["total_paid"] - summary_totals["used_amount"]
+        # Tổng cộng
+        totals = facts.aggregate(
+            total_package_price=Sum("package_price"),
+            total_paid=Sum("paid_amount"),
+            used_amount=Sum("used_amount"),
+        )
+        totals = {k: v or Decimal('0') for k, v in totals.items()}
+        summary_unused = totals["total_paid"] - totals["used_amount"]
         if summary_unused < 0:
             summary_unused = Decimal('0')
 
         return Response({
             "results": results,
             "summary": {
-                "total_package_price": summary_totals["total_package_price"],
-                "total_paid": summary_totals["total_paid"],
-                "used_amount": summary_totals["used_amount"],
+                "total_package_price": totals["total_package_price"],
+                "total_paid": totals["total_paid"],
+                "used_amount": totals["used_amount"],
                 "unused_amount": summary_unused,
             }
-        })
\ No newline at end of file
+        })
+
+
+class RevenueDashboardAPI(APIView):
+    """
+    Biểu đồ doanh thu thực thu đọc từ RevenueDaily (không quét PaymentHistory).
+    Tham số: startDate, endDate (bắt buộc), interval = day|week|month (mặc định day),
+    groupBy = paid_method|source|lead_source|ref_type|ref_hr|ref_actor (tuỳ chọn).
+    """
+    permission_classes = [IsAuthenticated]
+
+    INTERVALS = {"day": None, "week": TruncWeek, "month": TruncMonth}
+    GROUP_FIELDS = {
+        "paid_method": "paid_method",
+        "source": "source_ct_id",
+        "lead_source": "lead_source_id",
+        "ref_type": "ref_type",
+        "ref_hr": "ref_hr_id",
+        "ref_actor": "ref_actor_id",
+    }
+
+    def _labels(self, group_by, keys):
+        keys = [k for k in keys if k]
+        if group_by == "paid_method":
+            return {k: method_label(k) for k in keys}
+        if group_by == "ref_type":
+            return dict(Referral.REF_TYPE)
+        if group_by == "source":
+            return {k: label_from_model(ContentType.objects.get_for_id(k).model) for k in keys}
+        if group_by == "lead_source":
+            return dict(LeadSource.objects.filter(id__in=keys).values_list("id", "name"))
+        if group_by == "ref_hr":
+            return {p.id: str(p) for p in HrUserProfile.objects.filter(id__in=keys)}
+        if group_by == "ref_actor":
+            return dict(LeadSourceActor.objects.filter(id__in=keys).values_list("id", "name"))
+        return {}
+
+    def get(self, request):
+        start = parse_date(request.query_params.get("startDate") or "")
+        end   = parse_date(request.query_params.get("endDate") or "")
+        if not start or not end:
+            return Response({"detail": "startDate & endDate are required"}, status=400)
+        if start > end:
+            return Response({"detail": "startDate phải <= endDate"}, status=400)
+        interval = request.query_params.get("interval") or "day"
+        if interval not in self.INTERVALS:
+            return Response({"detail": f"interval phải là một trong {list(self.INTERVALS)}"}, status=400)
+        group_by = request.query_params.get("groupBy") or None
+        if group_by and group_by not in self.GROUP_FIELDS:
+            return Response({"detail": f"groupBy phải là một trong {list(self.GROUP_FIELDS)}"}, status=400)
+
+        qs = RevenueDaily.objects.filter(day__range=[start, end])
+        trunc = self.INTERVALS[interval]
+        qs = qs.annotate(period=trunc("day") if trunc else F("day"))
+        dims = ["period"] + ([self.GROUP_FIELDS[group_by]] if group_by else [])
+        rows = list(qs.values(*dims)
+                      .annotate(amount=Sum("amount"), payment_count=Sum("payment_count"))
+                      .order_by(*dims))
+
+        labels = self._labels(group_by, {r[dims[1]] for r in rows}) if group_by else {}
+        series = []
+        for r in rows:
+            period = r["period"]
+            item = {
+                "period": period.date() if hasattr(period, "date") else period,
+                "amount": r["amount"] or Decimal("0"),
+                "payment_count": r["payment_count"] or 0,
+            }
+            if group_by:
+                key = r[dims[1]]
+                item["key"] = key or None
+                item["label"] = labels.get(key) or ("Không rõ" if not key else str(key))
+            series.append(item)
+
+        totals = qs.aggregate(total_amount=Sum("amount"), total_count=Sum("payment_count"))
+        return Response({
+            "interval": interval,
+            "groupBy": group_by,
+            "series": series,
+            "summary": {
+                "total_revenue": totals["total_amount"] or Decimal("0"),
+                "payment_count": totals["total_count"] or 0,
+            },
+        })
@@ -1,8 +1,13 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework import status
+from app_home.views import AdminPermission
+from .models import PayrollRun
+from .services.ar_periods import month_start
 from .services.payroll import get_performance_payroll
-from datetime import date
+from .services.payroll_runs import close_period
+from datetime import date, datetime
 
 class PayrollAPIView(APIView):
     permission_classes = [IsAuthenticated]
@@ -21,3 +26,47 @@ class PayrollAPIView(APIView):
 
         data = get_performance_payroll(start, end, user_type=user_type, department_id=department_id, search=search)
         return Response(data)
+
+
+def _run_data(run):
+    return {
+        "period": run.period.strftime("%Y-%m"),
+        "line_count": run.line_count,
+        "total_salary": str(run.total_salary),
+        "closed_by": run.closed_by_id,
+        "closed_at": run.closed_at,
+        "recomputed_by": run.recomputed_by_id,
+        "recomputed_at": run.recomputed_at,
+        "recompute_count": run.recompute_count,
+    }
+
+
+class PayrollCloseAPIView(APIView):
+    """
+    GET  -> danh sách kỳ lương đã chốt
+    POST {"period": "YYYY-MM", "recompute": false} -> chốt kỳ (tháng đã kết thúc);
+         kỳ đã chốt chỉ tính lại khi recompute=true; chỉ admin (UserProfile.is_admin / is_staff)
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_permissions(self):
+        if self.request.method == "POST":
+            return [IsAuthenticated(), (IsAdminUser | AdminPermission)()]
+        return super().get_permissions()
+
+    def get(self, request):
+        return Response([_run_data(run) for run in PayrollRun.objects.all()])
+
+    def post(self, request):
+        try:
+            period = datetime.strptime(str(request.data.get("period") or ""), "%Y-%m").date()
+        except ValueError:
+            return Response({"detail": "period phải có dạng YYYY-MM"}, status=status.HTTP_400_BAD_REQUEST)
+        if period >= month_start(date.today()):
+            return Response({"detail": "Chỉ chốt được tháng đã kết thúc."}, status=status.HTTP_400_BAD_REQUEST)
+        recompute = str(request.data.get("recompute", "")).lower() in ("1", "true")
+        if not recompute and PayrollRun.objects.filter(period=period).exists():
+            return Response({"detail": "Kỳ lương đã chốt (gửi recompute=true để chốt lại)."},
+                            status=status.HTTP_409_CONFLICT)
+        run = close_period(period, closed_by=request.user)
+        return Response(_run_data(run), status=status.HTTP_201_CREATED)
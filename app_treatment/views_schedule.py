@@ -0,0 +1,99 @@
+from rest_framework.views import APIView
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from django.utils.dateparse import parse_date
+
+from app_hr.models import HrUserProfile
+from app_product.models import TechicalSetting
+from app_treatment.services.scheduling import day_schedule, hhmm
+
+
+def _int_param(request, name):
+    raw = request.query_params.get(name)
+    if raw in (None, ""):
+        return None
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return False
+
+
+def _interval(iv):
+    return {
+        "item_id": iv.item_id,
+        "session_id": iv.session_id,
+        "customer_id": iv.customer_id,
+        "start": hhmm(iv.start),
+        "end": hhmm(iv.end),
+    }
+
+
+class ScheduleAvailabilityAPI(APIView):
+    """
+    Khung giờ trống trong ngày cho 1 kỹ thuật, đọc từ chỉ mục lịch trong bộ nhớ (services.scheduling).
+    Tham số: date (bắt buộc), duration (phút) hoặc techical_setting_id,
+    expert_id (tuỳ chọn, mặc định mọi CTV), room (tuỳ chọn; đi kèm expert_id thì lấy giao của cả hai).
+    Mỗi slot: start = giờ bắt đầu sớm nhất, latest_start = giờ bắt đầu muộn nhất vẫn đủ thời lượng.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        day = parse_date(request.query_params.get("date") or "")
+        if not day:
+            return Response({"detail": "date is required (YYYY-MM-DD)"}, status=400)
+        duration = _int_param(request, "duration")
+        ts_id = _int_param(request, "techical_setting_id")
+        expert_id = _int_param(request, "expert_id")
+        room = (request.query_params.get("room") or "").strip() or None
+        if duration is False or ts_id is False or expert_id is False:
+            return Response({"detail": "duration / techical_setting_id / expert_id phải là số"}, status=400)
+        if not duration and ts_id:
+            duration = TechicalSetting.objects.filter(pk=ts_id).values_list("duration", flat=True).first()
+        if not duration or duration <= 0:
+            return Response({"detail": "Cần duration > 0 hoặc techical_setting_id có thời lượng"}, status=400)
+
+        schedule = day_schedule(day)
+
+        def _slots(**kw):
+            return [{"start": hhmm(s), "latest_start": hhmm(e - duration), "end": hhmm(e)}
+                    for s, e in schedule.available_starts(duration, **kw)]
+
+        if room and not expert_id:
+            return Response({"date": day, "duration": duration, "room": room, "slots": _slots(room=room)})
+
+        experts = HrUserProfile.objects.filter(type="collaborator")
+        if expert_id:
+            experts = experts.filter(pk=expert_id)
+        result = [{
+            "expert_id": pk,
+            "full_name": name,
+            "slots": _slots(expert_id=pk, room=room),
+        } for pk, name in experts.order_by("full_name", "id").values_list("id", "full_name")]
+        return Response({"date": day, "duration": duration, "room": room, "experts": result})
+
+
+class ScheduleConflictsAPI(APIView):
+    """
+    Các cặp kỹ thuật chồng giờ trong ngày theo chuyên gia và theo phòng.
+    Tham số: date (bắt buộc), expert_id / room (tuỳ chọn, chỉ xét đối tượng đó).
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        day = parse_date(request.query_params.get("date") or "")
+        if not day:
+            return Response({"detail": "date is required (YYYY-MM-DD)"}, status=400)
+        expert_id = _int_param(request, "expert_id")
+        if expert_id is False:
+            return Response({"detail": "expert_id phải là số"}, status=400)
+        room = (request.query_params.get("room") or "").strip() or None
+
+        found = day_schedule(day).conflicts(expert_id=expert_id, room=room)
+        experts = [{"expert_id": k, "a": _interval(a), "b": _interval(b)} for k, a, b in found["experts"]]
+        rooms = [{"room": k, "a": _interval(a), "b": _interval(b)} for k, a, b in found["rooms"]]
+        return Response({
+            "date": day,
+            "experts": experts,
+            "rooms": rooms,
+            "total": len(experts) + len(rooms),
+        })